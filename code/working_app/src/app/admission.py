@@ -0,0 +1,189 @@
+# Finding Ghosts in Your Data
+# Admission control for the detection endpoints.
+# The cost of a call depends on its detector and size far more than on anything else:  univariate
+# detection on a few dozen points is nearly free, while LOCI is cubic up to 1000 rows and KernelCPD builds
+# a quadratic cost matrix.  Before a call runs, we estimate its CPU time and memory from the same
+# thresholds the models use, and admit it, hold it until there is room, or turn it away.
+
+import os
+import asyncio
+from collections import namedtuple
+from . import lazy
+from .models import planner, pool
+
+# Streaming detection runs in this process, so the module is loaded for the call anyway.
+streaming_timeseries = lazy.module(__package__ + ".models.streaming_timeseries")
+
+Cost = namedtuple("Cost", ["cpu_seconds", "memory_bytes"])
+NO_COST = Cost(0.0, 0)
+
+# Rough costs, measured on one core.  They only need to be right to within a small factor.  Multivariate and
+# single time series detection take their CPU time from the latency-budget planner.
+UNIVARIATE_SECONDS_PER_ROW = 2e-4
+KERNEL_CPD_BYTES_PER_PAIR = 20
+MULTI_TIMESERIES_SECONDS_PER_ROW = 1e-6
+BOCPD_SECONDS_PER_ROW_RUN = 8e-7
+BYTES_PER_ROW = 1024
+
+class Rejected(Exception):
+    def __init__(self, status_code, message, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+def estimate_univariate(num_rows, keywords):
+    return Cost(UNIVARIATE_SECONDS_PER_ROW * num_rows, BYTES_PER_ROW * num_rows)
+
+def estimate_multivariate(num_rows, keywords):
+    # Ask the planner which tests the call will run, so that a latency budget which drops LOCI or narrows
+    # the COF sweep lowers the estimate as well.  COF and LOCI both hold an n x n distance matrix.
+    n_neighbors = keywords.get("n_neighbors", 10)
+    if num_rows < 16:
+        n_neighbors = min(n_neighbors, 5)
+    plan = planner.plan_multivariate(num_rows, n_neighbors, keywords.get("latency_budget_ms"))
+    return Cost(plan["estimated_ms"] / 1000.0, 16 * num_rows**2 + BYTES_PER_ROW * num_rows)
+
+def estimate_single_timeseries(num_rows, keywords):
+    # Multi-resolution search, which a latency budget may switch on, is close to linear from 1000 records
+    # on; otherwise KernelCPD is quadratic.
+    plan = planner.plan_single_timeseries(num_rows, planner.KERNELS, planner.PENALTIES,
+        keywords.get("multi_resolution", False), keywords.get("latency_budget_ms"))
+    if plan["multi_resolution"] and num_rows >= 1000:
+        return Cost(plan["estimated_ms"] / 1000.0, BYTES_PER_ROW * num_rows)
+    return Cost(plan["estimated_ms"] / 1000.0, KERNEL_CPD_BYTES_PER_PAIR * num_rows**2 + BYTES_PER_ROW * num_rows)
+
+def estimate_single_timeseries_stream(num_rows, keywords):
+    # Each point updates a run-length distribution of at most MAX_RUN_LENGTH entries, and the series state
+    # does not grow with the update, so both CPU time and memory are linear.
+    return Cost(BOCPD_SECONDS_PER_ROW_RUN * streaming_timeseries.MAX_RUN_LENGTH * num_rows, BYTES_PER_ROW * num_rows)
+
+def estimate_multi_timeseries(num_rows, keywords):
+    return Cost(MULTI_TIMESERIES_SECONDS_PER_ROW * num_rows, BYTES_PER_ROW * num_rows)
+
+# Detectors by name, so that estimating a cost does not import the models.
+ESTIMATES = {
+    "detect_univariate_statistical": estimate_univariate,
+    "detect_univariate_statistical_sweep": estimate_univariate,
+    "detect_multivariate_statistical": estimate_multivariate,
+    "detect_multivariate_statistical_sweep": estimate_multivariate,
+    "detect_single_timeseries": estimate_single_timeseries,
+    "detect_single_timeseries_sweep": estimate_single_timeseries,
+    "detect_single_timeseries_stream": estimate_single_timeseries_stream,
+    "detect_multi_timeseries": estimate_multi_timeseries,
+    "detect_multi_timeseries_sweep": estimate_multi_timeseries,
+    "detect_multi_timeseries_window": estimate_multi_timeseries,
+}
+
+def estimate_cost(detect, data):
+    # detect is a detector wrapped in functools.partial, and data is a DataFrame, or a dictionary of
+    # DataFrames for batch detection.  Anything else costs nothing, so it is always admitted.
+    keywords = {}
+    while hasattr(detect, "func"):
+        keywords = { **detect.keywords, **keywords }
+        # Time buckets wrap another detector.  Aggregation only shrinks the data, so the raw size is an upper bound.
+        detect = keywords.pop("detect", detect.func)
+    name = getattr(detect, "__name__", None)
+    if name == "detect_single_timeseries_batch":
+        costs = [estimate_single_timeseries(len(df), keywords) for df in data.values()]
+        return Cost(sum(c.cpu_seconds for c in costs), max((c.memory_bytes for c in costs), default=0) * pool.get_num_workers())
+    if name not in ESTIMATES or not hasattr(data, "__len__"):
+        return NO_COST
+    return ESTIMATES[name](len(data), keywords)
+
+def get_memory_size():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return 8 * 2**30
+
+class AdmissionController:
+    def __init__(self, cpu_budget, memory_budget, max_request_seconds, max_waiting, max_wait_seconds):
+        self.cpu_budget = cpu_budget
+        self.memory_budget = memory_budget
+        self.max_request_seconds = max_request_seconds
+        self.max_waiting = max_waiting
+        self.max_wait_seconds = max_wait_seconds
+        # Like the endpoint limiters, this is only touched from the event loop.
+        self.condition = asyncio.Condition()
+        self.running = 0
+        self.waiting = 0
+        self.cpu_in_flight = 0.0
+        self.memory_in_flight = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+
+    def fits(self, cost):
+        # A call which fits within the budgets on its own always runs when nothing else is.
+        return self.running == 0 or (self.cpu_in_flight + cost.cpu_seconds <= self.cpu_budget
+            and self.memory_in_flight + cost.memory_bytes <= self.memory_budget)
+
+    def reject(self, status_code, message, retry_after=None):
+        self.rejected += 1
+        raise Rejected(status_code, message, retry_after)
+
+    async def admit(self, cost):
+        if cost == NO_COST:
+            return
+        if cost.memory_bytes > self.memory_budget or cost.cpu_seconds > self.max_request_seconds:
+            self.reject(503, f"This call would need about {cost.cpu_seconds:.0f} seconds and {cost.memory_bytes / 2**20:.0f} MB, "
+                f"more than this server allows for one call ({self.max_request_seconds:.0f} seconds and {self.memory_budget / 2**20:.0f} MB).  "
+                "Send less data, or submit it as a job.")
+        async with self.condition:
+            if not self.fits(cost):
+                if self.waiting >= self.max_waiting:
+                    self.reject(429, f"There are already {self.waiting} calls waiting to run.  Try again later.", retry_after=5)
+                self.waiting += 1
+                self.queued += 1
+                try:
+                    async with asyncio.timeout(self.max_wait_seconds):
+                        await self.condition.wait_for(lambda: self.fits(cost))
+                except asyncio.TimeoutError:
+                    self.reject(503, f"The server is busy and this call waited {self.max_wait_seconds:.0f} seconds without room to run.  Try again later.", retry_after=30)
+                finally:
+                    self.waiting -= 1
+            self.running += 1
+            self.cpu_in_flight += cost.cpu_seconds
+            self.memory_in_flight += cost.memory_bytes
+            self.admitted += 1
+
+    def release(self, cost):
+        if cost == NO_COST:
+            return
+        self.running -= 1
+        self.cpu_in_flight -= cost.cpu_seconds
+        self.memory_in_flight -= cost.memory_bytes
+        asyncio.ensure_future(self.notify())
+
+    async def notify(self):
+        async with self.condition:
+            self.condition.notify_all()
+
+    def get_status(self):
+        return { "running": self.running, "waiting": self.waiting,
+            "cpu_seconds_in_flight": self.cpu_in_flight, "cpu_budget_seconds": self.cpu_budget,
+            "memory_bytes_in_flight": self.memory_in_flight, "memory_budget_bytes": self.memory_budget,
+            "admitted": self.admitted, "queued": self.queued, "rejected": self.rejected }
+
+def get_default_max_request_seconds():
+    # Admit by default every call the detectors have always taken without a budget.  The costliest of these
+    # is multivariate detection on 1000 rows, the most LOCI runs on.
+    return max(120.0, estimate_multivariate(1000, {}).cpu_seconds)
+
+_controller = None
+
+def get_controller():
+    # DETECTOR_CPU_BUDGET_SECONDS caps the estimated CPU time of the calls running at once (by default, a
+    # minute per worker), and DETECTOR_MEMORY_BUDGET_BYTES their estimated memory (by default, half of the
+    # machine's).  No one call may take longer than DETECTOR_MAX_REQUEST_SECONDS (by default, as long as
+    # LOCI on 1000 rows); longer work belongs in a job.  At most DETECTOR_MAX_WAITING calls wait for room,
+    # for up to DETECTOR_MAX_WAIT_SECONDS each.
+    global _controller
+    if _controller is None:
+        _controller = AdmissionController(
+            float(os.environ.get("DETECTOR_CPU_BUDGET_SECONDS", 60 * pool.get_num_workers())),
+            int(os.environ.get("DETECTOR_MEMORY_BUDGET_BYTES", get_memory_size() // 2)),
+            float(os.environ.get("DETECTOR_MAX_REQUEST_SECONDS", get_default_max_request_seconds())),
+            int(os.environ.get("DETECTOR_MAX_WAITING", 100)),
+            float(os.environ.get("DETECTOR_MAX_WAIT_SECONDS", 60)))
+    return _controller
@@ -0,0 +1,132 @@
+# Finding Ghosts in Your Data
+# Micro-batching for small detection calls.
+# A univariate call on a few dozen points spends more time getting to and from a worker process than it
+# does in the detector.  When many such calls arrive at once, we hold each one for a few milliseconds,
+# then send everything that came in for the same detector to a worker as one group.  The group runs
+# through the model's grouped pipeline, which shares the vectorized parts of the work, and each caller
+# gets back exactly the response it would have had on its own.
+
+import os
+import sys
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
+from . import admission, execution, metrics, serialization
+from .models import pool
+
+# Detectors with a grouped pipeline, by name, and the name of that pipeline in the same module.
+GROUPED = {
+    "detect_univariate_statistical": "detect_univariate_statistical_group",
+}
+# Only small inputs gain from sharing a trip to a worker, and the grouped pipelines are built for them.
+MAX_BATCH_ROWS = 200
+
+def get_max_size():
+    return max(1, int(os.environ.get("DETECTOR_BATCH_MAX_SIZE", 16)))
+
+def get_max_wait_seconds():
+    # How long the first call in a batch waits for others to join it.  0, the default, turns
+    # micro-batching off, so that a lone call never waits.
+    return max(0.0, float(os.environ.get("DETECTOR_BATCH_MAX_WAIT_MS", 0))) / 1000.0
+
+def run_group(calls):
+    # Runs in a worker process.  calls is a list of (detect, df) pairs, all for the same detector.
+    # Returns, for each call, its response body and the tests it ran, or the exception it raised.
+    func = calls[0][0].func
+    group = getattr(sys.modules[func.__module__], GROUPED[func.__name__])
+    results = []
+    for result in group([(df, detect.keywords) for (detect, df) in calls]):
+        if isinstance(result, Exception):
+            results.append(result)
+        else:
+            tests_run = { test: 1 for (test, ran) in metrics.get_tests_run(result[2]).items() if ran }
+            results.append((serialization.detection_json(*result, False), tests_run))
+    return results
+
+class PendingCall:
+    def __init__(self, detect, df, cost, future):
+        self.detect = detect
+        self.df = df
+        self.cost = cost
+        self.future = future
+
+class MicroBatcher:
+    # Only touched from the event loop, like the endpoint limiters.
+    def __init__(self, endpoint, max_size, max_wait_seconds):
+        self.endpoint = endpoint
+        self.max_size = max_size
+        self.max_wait_seconds = max_wait_seconds
+        self.pending = []
+        self.timer = None
+
+    def add(self, detect, df, cost):
+        loop = asyncio.get_running_loop()
+        call = PendingCall(detect, df, cost, loop.create_future())
+        self.pending.append(call)
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_wait_seconds, self.flush)
+        return call.future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        calls = []
+        for call in self.pending:
+            # A caller who left while waiting here no longer holds anything but its admission.
+            if call.future.done():
+                admission.get_controller().release(call.cost)
+            else:
+                calls.append(call)
+        self.pending = []
+        if calls:
+            asyncio.ensure_future(self.run(calls))
+
+    async def run(self, calls):
+        # The batch takes one slot for the endpoint, and gives back every caller's admission when it finishes.
+        try:
+            future = await execution.submit(None, self.endpoint, pool.get_executor(), [call.cost for call in calls],
+                run_group, [(call.detect, call.df) for call in calls])
+            results = await asyncio.wrap_future(future)
+        except BaseException as e:
+            if isinstance(e, BrokenProcessPool):
+                pool.reset_executor()
+            results = [e] * len(calls)
+        for (call, result) in zip(calls, results):
+            if call.future.done():
+                continue
+            if isinstance(result, BaseException):
+                call.future.set_exception(result)
+            else:
+                call.future.set_result(result)
+
+_batchers = {}
+
+def get_batcher(endpoint, name):
+    batcher = _batchers.get((endpoint, name))
+    if batcher is None:
+        batcher = MicroBatcher(endpoint, get_max_size(), get_max_wait_seconds())
+        _batchers[(endpoint, name)] = batcher
+    return batcher
+
+def can_batch(f, args):
+    # Plain JSON detection of a small input, without debug output, by a detector with a grouped pipeline.
+    if f is not serialization.detect_json or len(args) != 3 or get_max_wait_seconds() <= 0:
+        return False
+    (detect, df, debug) = args
+    return (not debug and getattr(detect, "func", None) is not None and detect.func.__name__ in GROUPED
+        and hasattr(df, "columns") and len(df) <= MAX_BATCH_ROWS)
+
+async def run_batched(request, endpoint, f, *args):
+    # Takes the same arguments as execution.run_in_process, and runs the call there unless it can share a batch.
+    if not can_batch(f, args):
+        return await execution.run_in_process(request, endpoint, f, *args)
+    (detect, df, debug) = args
+    # Each call is admitted on its own, before it joins a batch.
+    cost = await execution.admit(request, args)
+    future = get_batcher(endpoint, detect.func.__name__).add(detect, df, cost)
+    # If the client leaves, this cancels its future, and the batch leaves it out or drops its result.
+    (body, tests_run) = await execution.until_disconnected(request, future)
+    metrics.record_call(request, endpoint, args, tests_run)
+    return body
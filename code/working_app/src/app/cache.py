@@ -0,0 +1,205 @@
+# Finding Ghosts in Your Data
+# Result cache for the detection endpoints.
+# Dashboards often send the same data with the same parameters several times within a few minutes, and
+# each call would otherwise rerun every test in the ensemble.  We key each response on a hash of the input
+# data and everything that shapes the response, and keep recent responses in memory, with an optional disk
+# tier which several server processes can share.
+
+import os
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from functools import partial
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from starlette.concurrency import run_in_threadpool
+
+DEFAULT_MAX_BYTES = 256 * 2**20
+DEFAULT_TTL_SECONDS = 300
+
+class ResultCache:
+    def __init__(self, max_bytes, ttl_seconds, directory=None):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.directory = directory
+        # Entries are (expires, body), oldest use first.
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self.remove(key)
+        body = self.read_disk(key, now)
+        with self.lock:
+            if body is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self.put_memory(key, body, now)
+        return body
+
+    def put(self, key, body):
+        now = time.time()
+        self.put_memory(key, body, now)
+        self.write_disk(key, body)
+
+    def put_memory(self, key, body, now):
+        # A response bigger than the whole cache would only push everything else out.
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (now + self.ttl_seconds, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        (expires, body) = self.entries.pop(key)
+        self.size -= len(body)
+
+    def read_disk(self, key, now):
+        if self.directory is None:
+            return None
+        path = os.path.join(self.directory, key)
+        try:
+            if os.path.getmtime(path) + self.ttl_seconds <= now:
+                return None
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def write_disk(self, key, body):
+        # Write to a temporary file and rename it, so another process never reads half a response.
+        if self.directory is None:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            (fd, temp_path) = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+            os.replace(temp_path, os.path.join(self.directory, key))
+        except OSError:
+            # The disk tier is only an optimization, so a full or read-only disk is not an error.
+            pass
+
+    def get_stats(self):
+        with self.lock:
+            return { "hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes, "ttl_seconds": self.ttl_seconds,
+                "directory": self.directory }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+_cache = None
+
+def get_cache():
+    # DETECTOR_CACHE_MAX_BYTES and DETECTOR_CACHE_TTL_SECONDS size the in-memory cache, and setting
+    # DETECTOR_CACHE_DIR adds a disk tier in that directory.  A size of 0 turns caching off.
+    global _cache
+    if _cache is None:
+        _cache = ResultCache(int(os.environ.get("DETECTOR_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+            float(os.environ.get("DETECTOR_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS)), os.environ.get("DETECTOR_CACHE_DIR"))
+    return _cache
+
+def describe(value):
+    # A stable description of a detector call's settings.  The repr of a function includes its address,
+    # which differs between processes, so name functions by module and qualified name instead.
+    if isinstance(value, partial):
+        return ("partial", describe(value.func), tuple(describe(a) for a in value.args),
+            tuple((k, describe(v)) for (k, v) in sorted(value.keywords.items())))
+    if callable(value):
+        return (value.__module__, value.__qualname__)
+    if isinstance(value, (list, tuple)):
+        return tuple(describe(v) for v in value)
+    return repr(value)
+
+def hash_strings(h, column):
+    # Hash the Arrow string buffers directly; pandas would factorize the column first, which is slow
+    # when every key is different.  A sliced array's offsets start partway in, so rebase them on zero.
+    array = pa.array(column, type=pa.large_string(), from_pandas=True)
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    offsets = np.frombuffer(array.buffers()[1], dtype=np.int64)[array.offset:array.offset + len(array) + 1]
+    h.update((offsets - offsets[0]).tobytes())
+    if array.buffers()[2] is not None:
+        h.update(memoryview(array.buffers()[2])[offsets[0]:offsets[-1]])
+    h.update(np.packbits(array.is_null().to_numpy(zero_copy_only=False)).tobytes())
+
+def normalize_number(x):
+    return float(x) if isinstance(x, (int, float, np.number)) and not isinstance(x, bool) else x
+
+def hash_column(h, column):
+    # Hash the values rather than their representation, so the same data hashes the same way whether it
+    # arrived as JSON rows, JSON columns, Arrow, or CSV.
+    if column.dtype.kind == "M":
+        h.update(pd.DatetimeIndex(pd.to_datetime(column, utc=True)).as_unit("ns").asi8.tobytes())
+    elif column.dtype.kind in "biuf":
+        h.update(column.to_numpy(dtype=np.float64).tobytes())
+    elif len(column) > 0 and isinstance(column.iloc[0], (list, np.ndarray)):
+        # Multivariate rows are lists of numbers, strings, or missing values.  Numbers hash as floats, so that
+        # 1 and 1.0 match the way they do in a numeric column.
+        hash_strings(h, column.map(lambda v: repr([normalize_number(x) for x in v])))
+    else:
+        hash_strings(h, column.astype(str))
+
+def update_hash(h, value):
+    if isinstance(value, pd.DataFrame):
+        h.update(repr(("frame", len(value), list(value.columns))).encode("utf-8"))
+        for column in value.columns:
+            hash_column(h, value[column])
+    elif isinstance(value, dict):
+        h.update(repr(("dict", len(value))).encode("utf-8"))
+        for (k, v) in sorted(value.items()):
+            update_hash(h, k)
+            update_hash(h, v)
+    else:
+        h.update(repr(describe(value)).encode("utf-8"))
+        h.update(b"\0")
+
+def get_key(*parts):
+    h = hashlib.blake2b(digest_size=20)
+    for part in parts:
+        update_hash(h, part)
+    return h.hexdigest()
+
+def to_bytes(body):
+    return body.encode("utf-8") if isinstance(body, str) else body
+
+async def cached(use_cache, run, *args):
+    # run is one of the execution.run_* functions and args are its arguments:  the request, then the
+    # endpoint name, encoding function, detector, data, and response options, which together decide the
+    # response body.  Bodies are always bytes, so that the disk tier can hold them as they are.  Debug
+    # responses carry the timings and memory use of the run that made them, so a cached copy would pass
+    # off stale numbers as fresh; those always run.
+    debug = len(args) > 5 and args[5] is True
+    if not use_cache or debug or get_cache().max_bytes <= 0:
+        return to_bytes(await run(*args))
+    # Hashing a large input takes a moment, so keep it off the event loop.
+    key = await run_in_threadpool(get_key, *args[1:])
+    body = get_cache().get(key)
+    if body is None:
+        body = to_bytes(await run(*args))
+        get_cache().put(key, body)
+    return body
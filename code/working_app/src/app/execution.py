@@ -0,0 +1,131 @@
+# Finding Ghosts in Your Data
+# Execution layer for the API.
+# Detectors are CPU-bound and hold the GIL, so running them on FastAPI's thread pool lets one slow
+# request (LOCI, KernelCPD) stall every other caller.  Instead, async handlers hand detector calls to
+# worker processes and await the results, with a limit on how many calls each endpoint has in flight.
+
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from . import admission, metrics
+from .models import pool
+
+# How often to check whether a client has gone away while its call waits or runs.
+DISCONNECT_POLL_SECONDS = 0.1
+
+class ClientDisconnected(Exception):
+    pass
+
+class EndpointLimiter:
+    def __init__(self, limit):
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit)
+        self.waiting = 0
+        self.running = 0
+
+    def release(self):
+        self.running -= 1
+        self.semaphore.release()
+
+# Limiters are only touched from the event loop, so they need no lock.
+_limiters = {}
+_thread_executor = None
+
+def get_limit(endpoint):
+    # DETECTOR_MAX_CONCURRENT sets the limit for every endpoint, and DETECTOR_MAX_CONCURRENT_<ENDPOINT>
+    # (such as DETECTOR_MAX_CONCURRENT_MULTIVARIATE) overrides it for one.  By default, each endpoint
+    # may use every worker.
+    default = int(os.environ.get("DETECTOR_MAX_CONCURRENT", pool.get_num_workers()))
+    return max(1, int(os.environ.get("DETECTOR_MAX_CONCURRENT_" + endpoint.upper(), default)))
+
+def get_limiter(endpoint):
+    limiter = _limiters.get(endpoint)
+    if limiter is None:
+        limiter = EndpointLimiter(get_limit(endpoint))
+        _limiters[endpoint] = limiter
+    return limiter
+
+def get_queue_status():
+    return { endpoint: { "limit": limiter.limit, "running": limiter.running, "waiting": limiter.waiting }
+        for (endpoint, limiter) in _limiters.items() }
+
+def get_thread_executor():
+    global _thread_executor
+    if _thread_executor is None:
+        _thread_executor = ThreadPoolExecutor(thread_name_prefix="detector")
+    return _thread_executor
+
+async def run_in_process(request, endpoint, f, *args):
+    # f and its arguments go to another process, so they must be picklable:  module-level functions,
+    # or functools.partial objects built from them.
+    try:
+        return await run(request, endpoint, pool.get_executor(), f, *args)
+    except BrokenProcessPool:
+        pool.reset_executor()
+        raise
+
+async def run_in_thread(request, endpoint, f, *args):
+    # For calls which must stay in this process, such as those that keep state for a series between
+    # calls, or those that fan work out to the process pool themselves.
+    return await run(request, endpoint, get_thread_executor(), f, *args)
+
+async def run(request, endpoint, executor, f, *args):
+    cost = await admit(request, args)
+    # The tests the detector ran come back with its response, for the metrics.
+    future = await submit(request, endpoint, executor, [cost], metrics.run_counting_tests, f, *args)
+    (body, tests_run) = await until_disconnected(request, asyncio.wrap_future(future))
+    metrics.record_call(request, endpoint, args, tests_run)
+    return body
+
+async def admit(request, args):
+    # Detection calls pass an encoding function, then the detector and its data, so admission control
+    # can estimate what the call will cost.  Other calls cost nothing and are always admitted.
+    cost = admission.estimate_cost(*args[:2]) if len(args) >= 2 else admission.NO_COST
+    await until_disconnected(request, admission.get_controller().admit(cost))
+    return cost
+
+async def submit(request, endpoint, executor, costs, f, *args):
+    # Wait for a slot for the endpoint, then hand f to the executor and return its future.  The slot,
+    # and the admitted costs of every call f covers, are released when f finishes.
+    controller = admission.get_controller()
+    limiter = get_limiter(endpoint)
+    limiter.waiting += 1
+    try:
+        await until_disconnected(request, limiter.semaphore.acquire())
+    except BaseException:
+        for cost in costs:
+            controller.release(cost)
+        raise
+    finally:
+        limiter.waiting -= 1
+
+    limiter.running += 1
+    loop = asyncio.get_running_loop()
+    def release():
+        limiter.release()
+        for cost in costs:
+            controller.release(cost)
+    try:
+        future = executor.submit(f, *args)
+    except BaseException:
+        release()
+        raise
+    # Hold the slot until the call really finishes.  If the client leaves while the call is still queued
+    # in the executor, cancelling it frees the slot right away; a call which has already started runs
+    # to completion and keeps counting against the limit until it does.
+    future.add_done_callback(lambda f: loop.call_soon_threadsafe(release))
+    return future
+
+async def until_disconnected(request, awaitable):
+    # Calls made for no one client in particular, such as a micro-batch, just wait.
+    task = asyncio.ensure_future(awaitable)
+    if request is None:
+        return await task
+    while True:
+        (done, pending) = await asyncio.wait({ task }, timeout=DISCONNECT_POLL_SECONDS)
+        if task in done:
+            return task.result()
+        # If the task finished while we checked, keep its result rather than losing it.
+        if await request.is_disconnected() and task.cancel():
+            raise ClientDisconnected()
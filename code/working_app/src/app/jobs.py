@@ -0,0 +1,147 @@
+# Finding Ghosts in Your Data
+# Background jobs for long detection calls.
+# A large multivariate run or a long KernelCPD series can take longer than a load balancer will hold a
+# connection open.  Callers can instead submit a job, get its ID right away, and poll for its status and
+# result.  Jobs run on the same worker processes as ordinary calls, and everything lives in this process,
+# so there is no broker to run.
+
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from . import metrics
+from .models import pool
+
+DEFAULT_MAX_QUEUED = 100
+DEFAULT_TTL_SECONDS = 3600
+DEFAULT_MAX_STORED = 1000
+
+class JobQueueFull(Exception):
+    pass
+
+class Job:
+    def __init__(self, endpoint):
+        self.job_id = uuid.uuid4().hex
+        self.endpoint = endpoint
+        self.status = "queued"
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.body = None
+        self.error = None
+        self.future = None
+
+    def is_finished(self):
+        return self.status in ("succeeded", "failed", "cancelled")
+
+class JobQueue:
+    def __init__(self, max_running, max_queued, ttl_seconds, max_stored):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.ttl_seconds = ttl_seconds
+        self.max_stored = max_stored
+        # Jobs in the order they came in, so the oldest finished jobs are the first to go.
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        # Each thread hands one job at a time to a worker process and waits for it, so the number of
+        # threads is the number of jobs running at once.
+        self.executor = ThreadPoolExecutor(max_workers=max_running, thread_name_prefix="job")
+
+    def submit(self, endpoint, in_process, f, *args):
+        # in_process says whether to send f to a worker process.  Calls which fan out to the process pool
+        # themselves run on the job thread instead.
+        with self.lock:
+            self.remove_expired(time.time())
+            num_queued = sum(1 for job in self.jobs.values() if job.status == "queued")
+            if num_queued >= self.max_queued:
+                raise JobQueueFull(f"There are already {num_queued} jobs waiting to run.  Try again later.")
+            job = Job(endpoint)
+            self.jobs[job.job_id] = job
+            job.future = self.executor.submit(self.run, job, in_process, f, *args)
+        return job
+
+    def run(self, job, in_process, f, *args):
+        with self.lock:
+            job.status = "running"
+            job.started_at = time.time()
+        try:
+            # Count the tests each job runs, the same as for direct calls.
+            if in_process:
+                (body, tests_run) = pool.get_executor().submit(metrics.run_counting_tests, f, *args).result()
+            else:
+                (body, tests_run) = metrics.run_counting_tests(f, *args)
+            metrics.record_tests(job.endpoint, tests_run)
+            (status, error) = ("succeeded", None)
+        except BrokenProcessPool:
+            pool.reset_executor()
+            (body, status, error) = (None, "failed", "A worker process stopped unexpectedly.")
+        except Exception as e:
+            (body, status, error) = (None, "failed", f"{type(e).__name__}: {e}")
+        with self.lock:
+            job.body = body.encode("utf-8") if isinstance(body, str) else body
+            job.status = status
+            job.error = error
+            job.finished_at = time.time()
+
+    def get(self, job_id):
+        with self.lock:
+            self.remove_expired(time.time())
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        # Only a job which has not started can be cancelled; a running one finishes and expires as usual.
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job.status == "queued" and job.future.cancel():
+                job.status = "cancelled"
+                job.finished_at = time.time()
+            return job
+
+    def remove_expired(self, now):
+        # Called with the lock held.  Finished jobs stay until they expire, or until too many have piled up.
+        finished = [job for job in self.jobs.values() if job.is_finished()]
+        for (i, job) in enumerate(finished):
+            if job.finished_at + self.ttl_seconds <= now or len(finished) - i > self.max_stored:
+                del self.jobs[job.job_id]
+
+    def get_queue_position(self, job):
+        # Called with the lock held.  Position 0 is next in line.
+        queued = [j.job_id for j in self.jobs.values() if j.status == "queued"]
+        return queued.index(job.job_id) if job.job_id in queued else None
+
+    def get_status(self, job):
+        with self.lock:
+            now = time.time()
+            status = { "job_id": job.job_id, "endpoint": job.endpoint, "status": job.status,
+                "submitted_at": job.submitted_at, "started_at": job.started_at, "finished_at": job.finished_at,
+                "queue_position": self.get_queue_position(job),
+                "elapsed_seconds": ((job.finished_at or now) - job.started_at) if job.started_at else 0.0 }
+            if job.error is not None:
+                status["error"] = job.error
+            if job.is_finished():
+                status["expires_at"] = job.finished_at + self.ttl_seconds
+            return status
+
+    def get_summary(self):
+        with self.lock:
+            counts = { "queued": 0, "running": 0, "succeeded": 0, "failed": 0, "cancelled": 0 }
+            for job in self.jobs.values():
+                counts[job.status] += 1
+            return { "jobs": counts, "max_running": self.max_running, "max_queued": self.max_queued, "ttl_seconds": self.ttl_seconds }
+
+_queue = None
+
+def get_queue():
+    # DETECTOR_JOB_WORKERS sets how many jobs run at once (by default, one per worker process),
+    # DETECTOR_JOB_QUEUE_SIZE how many may wait, and DETECTOR_JOB_TTL_SECONDS how long results stay
+    # around once a job finishes.
+    global _queue
+    if _queue is None:
+        _queue = JobQueue(int(os.environ.get("DETECTOR_JOB_WORKERS", pool.get_num_workers())),
+            int(os.environ.get("DETECTOR_JOB_QUEUE_SIZE", DEFAULT_MAX_QUEUED)),
+            float(os.environ.get("DETECTOR_JOB_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+            int(os.environ.get("DETECTOR_JOB_MAX_STORED", DEFAULT_MAX_STORED)))
+    return _queue
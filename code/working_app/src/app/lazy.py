@@ -0,0 +1,26 @@
+# Finding Ghosts in Your Data
+# Lazy imports for the detector modules.
+# Between them, the detectors pull in statsmodels, scipy.stats, scikit-posthocs, scikit-learn, pyod, and
+# ruptures, which take seconds to import.  A server which only ever answers time series calls should not
+# pay for LOCI, so the API refers to each detector module through a stand-in which imports the real
+# module the first time something asks for one of its attributes.
+
+import importlib
+
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        # Only called for attributes LazyModule does not have itself.  The import system has its own
+        # locks, so two threads asking at once still import the module only once.
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def is_loaded(self):
+        return self._module is not None
+
+def module(name):
+    return LazyModule(name)
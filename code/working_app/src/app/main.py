@@ -1,13 +1,34 @@
 # Finding Ghosts in Your Data
-from typing import Optional, List
-from fastapi import FastAPI
-from pydantic import BaseModel
+from typing import Optional, List, Dict, Union
+from fastapi import FastAPI, Request, Response, UploadFile, Query, HTTPException
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, model_validator
 import pandas as pd
-import json
 import datetime
-from app.models import univariate, multivariate, single_timeseries, multi_timeseries
+from functools import partial
+from contextlib import asynccontextmanager
+from app import admission, batching, cache, execution, jobs, lazy, metrics, serialization, tables, uploads
+from app.models import pool
+
+# Each detector module loads on the first call which needs it, so the server starts in about a second.
+univariate = lazy.module("app.models.univariate")
+multivariate = lazy.module("app.models.multivariate")
+single_timeseries = lazy.module("app.models.single_timeseries")
+multi_timeseries = lazy.module("app.models.multi_timeseries")
+sliding_multi_timeseries = lazy.module("app.models.sliding_multi_timeseries")
+streaming_timeseries = lazy.module("app.models.streaming_timeseries")
+time_buckets = lazy.module("app.models.time_buckets")
+
+# With DETECTOR_WARMUP set, load those detectors here and in every worker before taking any calls.
+@asynccontextmanager
+async def lifespan(app):
+    await run_in_threadpool(pool.warm_up)
+    yield
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
 
-app = FastAPI()
 @app.get("/")
 def doc():
     return {
@@ -15,31 +36,154 @@ def doc():
         "documentation": "If you want to see the OpenAPI specification, navigate to the /redoc/ path on this server."
     }
 
+# How many detector calls each endpoint has running and waiting, along with its limit, and how much of
+# the server's CPU and memory budgets the admitted calls are expected to use.
+@app.get("/status/queue")
+def get_queue_status():
+    return { "endpoints": execution.get_queue_status(), "admission": admission.get_controller().get_status() }
+
+# Result cache hits and misses.  Any detection call can skip the cache with use_cache=false.
+@app.get("/status/cache")
+def get_cache_status():
+    return cache.get_cache().get_stats()
+
+# Prometheus metrics.  This runs on the event loop, like every update to the metrics, so it needs no lock.
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+# Nobody is listening for a response once the client has gone, so just close out the request.
+@app.exception_handler(execution.ClientDisconnected)
+def handle_client_disconnected(request: Request, exc: execution.ClientDisconnected):
+    return Response(status_code=499)
+
+# Calls which would overload the server are turned away before they run:  429 when too many calls are already
+# waiting, and 503 when a call is too large for this server or has waited too long for room to run.
+@app.exception_handler(admission.Rejected)
+def handle_rejected(request: Request, exc: admission.Rejected):
+    headers = { "Retry-After": str(exc.retry_after) } if exc.retry_after is not None else None
+    return JSONResponse(status_code=exc.status_code, content={ "detail": str(exc) }, headers=headers)
+
+# A full job queue is a temporary condition, so tell the caller to come back rather than fail the job.
+@app.exception_handler(jobs.JobQueueFull)
+def handle_job_queue_full(request: Request, exc: jobs.JobQueueFull):
+    return JSONResponse(status_code=503, content={ "detail": str(exc) }, headers={ "Retry-After": "30" })
+
+# Every endpoint accepts either a list with one object per row or a columnar object with one list per field,
+# such as { "key": [...], "value": [...] }.  Columnar input skips building a model for every row.
+class Columnar_Input(BaseModel):
+    @model_validator(mode="after")
+    def check_column_lengths(self):
+        lengths = { name: len(column) for (name, column) in self.__dict__.items() }
+        if len(set(lengths.values())) > 1:
+            raise ValueError(f"Every column must have the same number of entries.  You sent {lengths}.")
+        return self
+
+def to_dataframe(input_data, columns):
+    if isinstance(input_data, list):
+        return pd.DataFrame((i.__dict__ for i in input_data), columns=columns)
+    return pd.DataFrame({ column: getattr(input_data, column) for column in columns })
+
+# Each detection endpoint also has a /sweep variant, which takes the same input but any number of
+# sensitivity_score and max_fraction_anomalies values, as in ?sensitivity_score=25&sensitivity_score=75.
+# It runs the tests once and returns the anomalies along with one threshold entry for each combination of
+# settings, holding is_anomaly (and anomaly_score, where that depends on the settings) for every row.
+
+# For bulk jobs, each detection endpoint also has a /table variant which takes the same columns as an
+# Apache Arrow IPC stream or a Parquet file, named by the Content-Type header.  Results come back as JSON
+# unless the Accept header asks for one of those formats instead; with debug, the weights and details
+# are in the table's schema metadata.
+async def read_table_request(request, columns):
+    df = tables.read_dataframe(await request.body(), request.headers.get("content-type"), columns)
+    return (df, tables.get_response_media_type(request.headers.get("accept")))
+
+# Each detection endpoint also has a /csv variant which takes a CSV file as multipart form data, along with
+# the name of the CSV column for each field, such as dt_column=Date and value_column=Close.  Without a key
+# column, each row's key is its row number.  Results come back the same way as from the /table variants.
+async def read_csv_request(request, file, columns):
+    # Parsing a large file takes a while, so keep it off the event loop.
+    df = await run_in_threadpool(uploads.read_csv_columns, file.file, columns)
+    return (df, tables.get_response_media_type(request.headers.get("accept")))
+
 # Univariate statistical anomaly detection
 # For more information on this, review chapters 6-8
 class Univariate_Statistical_Input(BaseModel):
     key: str
     value: float
 
+class Univariate_Statistical_Columnar_Input(Columnar_Input):
+    key: List[str]
+    value: List[float]
     
 @app.post("/detect/univariate")
-def post_univariate(
-    input_data: List[Univariate_Statistical_Input],
+async def post_univariate(
+    request: Request,
+    input_data: Union[List[Univariate_Statistical_Input], Univariate_Statistical_Columnar_Input],
     sensitivity_score: float = 50,
     max_fraction_anomalies: float = 1.0,
+    latency_budget_ms: Optional[float] = None,
+    use_cache: bool = True,
     debug: bool = False
 ):
-    df = pd.DataFrame(i.__dict__ for i in input_data)
+    df = to_dataframe(input_data, ["key", "value"])
 
-    (df, weights, details) = univariate.detect_univariate_statistical(df, sensitivity_score, max_fraction_anomalies)
+    detect = partial(univariate.detect_univariate_statistical, sensitivity_score=sensitivity_score, max_fraction_anomalies=max_fraction_anomalies, latency_budget_ms=latency_budget_ms)
     
     # If debug = False, include only key, value, is_anomaly, and anomaly_score.  Remove other values
-    results = { "anomalies": json.loads(df.to_json(orient='records')) }
-    
-    if (debug):
-        results.update({ "debug_weights": weights })
-        results.update({ "debug_details": details })
-    return results
+    body = await cache.cached(use_cache, batching.run_batched, request, "univariate", serialization.detect_json, detect, df, debug)
+    return serialization.json_response(body)
+
+@app.post("/detect/univariate/sweep")
+async def post_univariate_sweep(
+    request: Request,
+    input_data: Union[List[Univariate_Statistical_Input], Univariate_Statistical_Columnar_Input],
+    sensitivity_score: List[float] = Query([50]),
+    max_fraction_anomalies: List[float] = Query([1.0]),
+    latency_budget_ms: Optional[float] = None,
+    use_cache: bool = True,
+    debug: bool = False
+):
+    df = to_dataframe(input_data, ["key", "value"])
+
+    detect_sweep = partial(univariate.detect_univariate_statistical_sweep, sensitivity_scores=sensitivity_score, max_fraction_anomalies=max_fraction_anomalies, latency_budget_ms=latency_budget_ms)
+
+    body = await cache.cached(use_cache, execution.run_in_process, request, "univariate", serialization.detect_sweep_json, detect_sweep, df, debug)
+    return serialization.json_response(body)
+
+@app.post("/detect/univariate/table")
+async def post_univariate_table(
+    request: Request,
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    latency_budget_ms: Optional[float] = None,
+    use_cache: bool = True,
+    debug: bool = False
+):
+    (df, media_type) = await read_table_request(request, ["key", "value"])
+
+    detect = partial(univariate.detect_univariate_statistical, sensitivity_score=sensitivity_score, max_fraction_anomalies=max_fraction_anomalies, latency_budget_ms=latency_budget_ms)
+
+    body = await cache.cached(use_cache, execution.run_in_process, request, "univariate", tables.detect_table, detect, df, debug, media_type)
+    return tables.table_response(body, media_type)
+
+@app.post("/detect/univariate/csv")
+async def post_univariate_csv(
+    request: Request,
+    file: UploadFile,
+    value_column: str = "value",
+    key_column: Optional[str] = None,
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    latency_budget_ms: Optional[float] = None,
+    use_cache: bool = True,
+    debug: bool = False
+):
+    (df, media_type) = await read_csv_request(request, file, { "key": key_column, "value": value_column })
+
+    detect = partial(univariate.detect_univariate_statistical, sensitivity_score=sensitivity_score, max_fraction_anomalies=max_fraction_anomalies, latency_budget_ms=latency_budget_ms)
+
+    body = await cache.cached(use_cache, execution.run_in_process, request, "univariate", tables.detect_table, detect, df, debug, media_type)
+    return tables.table_response(body, media_type)
     
     
 # Multivariate anomaly detection with clustering and COPOD
@@ -47,25 +191,90 @@ def post_univariate(
 class Multivariate_Input(BaseModel):
     key: str
     vals: list = []
+
+class Multivariate_Columnar_Input(Columnar_Input):
+    key: List[str]
+    vals: List[list]
     
 @app.post("/detect/multivariate")
-def post_multivariate(
-    input_data: List[Multivariate_Input],
+async def post_multivariate(
+    request: Request,
+    input_data: Union[List[Multivariate_Input], Multivariate_Columnar_Input],
     sensitivity_score: float = 50,
     max_fraction_anomalies: float = 1.0,
     n_neighbors: int = 10,
+    latency_budget_ms: Optional[float] = None,
+    use_cache: bool = True,
     debug: bool = False
 ):
-    df = pd.DataFrame(i.__dict__ for i in input_data)
-    
-    (df, weights, details) = multivariate.detect_multivariate_statistical(df, sensitivity_score, max_fraction_anomalies, n_neighbors)
+    df = to_dataframe(input_data, ["key", "vals"])
     
-    results = { "anomalies": json.loads(df.to_json(orient='records')) }
+    detect = partial(multivariate.detect_multivariate_statistical, sensitivity_score=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies, n_neighbors=n_neighbors, latency_budget_ms=latency_budget_ms)
     
-    if (debug):
-        results.update({ "debug_weights": weights })
-        results.update({ "debug_details": details })
-    return results
+    body = await cache.cached(use_cache, execution.run_in_process, request, "multivariate", serialization.detect_json, detect, df, debug)
+    return serialization.json_response(body)
+
+@app.post("/detect/multivariate/sweep")
+async def post_multivariate_sweep(
+    request: Request,
+    input_data: Union[List[Multivariate_Input], Multivariate_Columnar_Input],
+    sensitivity_score: List[float] = Query([50]),
+    max_fraction_anomalies: List[float] = Query([1.0]),
+    n_neighbors: int = 10,
+    latency_budget_ms: Optional[float] = None,
+    use_cache: bool = True,
+    debug: bool = False
+):
+    df = to_dataframe(input_data, ["key", "vals"])
+
+    detect_sweep = partial(multivariate.detect_multivariate_statistical_sweep, sensitivity_scores=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies, n_neighbors=n_neighbors, latency_budget_ms=latency_budget_ms)
+
+    body = await cache.cached(use_cache, execution.run_in_process, request, "multivariate", serialization.detect_sweep_json, detect_sweep, df, debug)
+    return serialization.json_response(body)
+
+@app.post("/detect/multivariate/table")
+async def post_multivariate_table(
+    request: Request,
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    n_neighbors: int = 10,
+    latency_budget_ms: Optional[float] = None,
+    use_cache: bool = True,
+    debug: bool = False
+):
+    # vals is a list column, with one list of values per row.
+    (df, media_type) = await read_table_request(request, ["key", "vals"])
+
+    detect = partial(multivariate.detect_multivariate_statistical, sensitivity_score=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies, n_neighbors=n_neighbors, latency_budget_ms=latency_budget_ms)
+
+    body = await cache.cached(use_cache, execution.run_in_process, request, "multivariate", tables.detect_table, detect, df, debug, media_type)
+    return tables.table_response(body, media_type)
+
+@app.post("/detect/multivariate/csv")
+async def post_multivariate_csv(
+    request: Request,
+    file: UploadFile,
+    vals_columns: str,
+    key_column: Optional[str] = None,
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    n_neighbors: int = 10,
+    latency_budget_ms: Optional[float] = None,
+    use_cache: bool = True,
+    debug: bool = False
+):
+    # vals_columns is a comma-separated list of CSV columns, such as Open,High,Low,Close.
+    columns = { "key": key_column, "vals": [c.strip() for c in vals_columns.split(",")] }
+    (df, media_type) = await read_csv_request(request, file, columns)
+
+    detect = partial(multivariate.detect_multivariate_statistical, sensitivity_score=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies, n_neighbors=n_neighbors, latency_budget_ms=latency_budget_ms)
+
+    body = await cache.cached(use_cache, execution.run_in_process, request, "multivariate", tables.detect_table, detect, df, debug, media_type)
+    return tables.table_response(body, media_type)
     
 
 # Time series anomaly detection
@@ -74,24 +283,149 @@ class Single_TimeSeries_Input(BaseModel):
     key: str
     dt: datetime.datetime
     value: float
+
+class Single_TimeSeries_Columnar_Input(Columnar_Input):
+    key: List[str]
+    dt: List[datetime.datetime]
+    value: List[float]
     
 @app.post("/detect/timeseries/single")
-def post_time_series_single(
-    input_data: List[Single_TimeSeries_Input],
+async def post_time_series_single(
+    request: Request,
+    input_data: Union[List[Single_TimeSeries_Input], Single_TimeSeries_Columnar_Input],
     sensitivity_score: float = 50,
     max_fraction_anomalies: float = 1.0,
+    multi_resolution: bool = False,
+    aggregation_interval: Optional[str] = None,
+    aggregation_function: str = "mean",
+    latency_budget_ms: Optional[float] = None,
+    use_cache: bool = True,
     debug: bool = False
 ):
-    df = pd.DataFrame(i.__dict__ for i in input_data)
-    
-    (df, weights, details) = single_timeseries.detect_single_timeseries(df, sensitivity_score, max_fraction_anomalies)
+    df = to_dataframe(input_data, ["key", "dt", "value"])
     
-    results = { "anomalies": json.loads(df.to_json(orient='records', date_format='iso')) }
+    detect = partial(single_timeseries.detect_single_timeseries, sensitivity_score=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies, multi_resolution=multi_resolution, latency_budget_ms=latency_budget_ms)
+    if aggregation_interval is not None:
+        detect = partial(time_buckets.detect_with_time_buckets, detect=detect, aggregation_interval=aggregation_interval,
+            aggregation_function=aggregation_function)
     
-    if (debug):
-        results.update({ "debug_weights": weights })
-        results.update({ "debug_details": details })
-    return results
+    body = await cache.cached(use_cache, execution.run_in_process, request, "single_timeseries", serialization.detect_json, detect, df, debug, 'iso')
+    return serialization.json_response(body)
+
+@app.post("/detect/timeseries/single/sweep")
+async def post_time_series_single_sweep(
+    request: Request,
+    input_data: Union[List[Single_TimeSeries_Input], Single_TimeSeries_Columnar_Input],
+    sensitivity_score: List[float] = Query([50]),
+    max_fraction_anomalies: List[float] = Query([1.0]),
+    multi_resolution: bool = False,
+    latency_budget_ms: Optional[float] = None,
+    use_cache: bool = True,
+    debug: bool = False
+):
+    df = to_dataframe(input_data, ["key", "dt", "value"])
+
+    detect_sweep = partial(single_timeseries.detect_single_timeseries_sweep, sensitivity_scores=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies, multi_resolution=multi_resolution, latency_budget_ms=latency_budget_ms)
+
+    body = await cache.cached(use_cache, execution.run_in_process, request, "single_timeseries", serialization.detect_sweep_json, detect_sweep, df, debug, 'iso')
+    return serialization.json_response(body)
+
+@app.post("/detect/timeseries/single/table")
+async def post_time_series_single_table(
+    request: Request,
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    multi_resolution: bool = False,
+    aggregation_interval: Optional[str] = None,
+    aggregation_function: str = "mean",
+    latency_budget_ms: Optional[float] = None,
+    use_cache: bool = True,
+    debug: bool = False
+):
+    (df, media_type) = await read_table_request(request, ["key", "dt", "value"])
+
+    detect = partial(single_timeseries.detect_single_timeseries, sensitivity_score=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies, multi_resolution=multi_resolution, latency_budget_ms=latency_budget_ms)
+    if aggregation_interval is not None:
+        detect = partial(time_buckets.detect_with_time_buckets, detect=detect, aggregation_interval=aggregation_interval,
+            aggregation_function=aggregation_function)
+
+    body = await cache.cached(use_cache, execution.run_in_process, request, "single_timeseries", tables.detect_table, detect, df, debug, media_type, 'iso')
+    return tables.table_response(body, media_type)
+
+@app.post("/detect/timeseries/single/csv")
+async def post_time_series_single_csv(
+    request: Request,
+    file: UploadFile,
+    dt_column: str = "dt",
+    value_column: str = "value",
+    key_column: Optional[str] = None,
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    multi_resolution: bool = False,
+    aggregation_interval: Optional[str] = None,
+    aggregation_function: str = "mean",
+    latency_budget_ms: Optional[float] = None,
+    use_cache: bool = True,
+    debug: bool = False
+):
+    (df, media_type) = await read_csv_request(request, file, { "key": key_column, "dt": dt_column, "value": value_column })
+
+    detect = partial(single_timeseries.detect_single_timeseries, sensitivity_score=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies, multi_resolution=multi_resolution, latency_budget_ms=latency_budget_ms)
+    if aggregation_interval is not None:
+        detect = partial(time_buckets.detect_with_time_buckets, detect=detect, aggregation_interval=aggregation_interval,
+            aggregation_function=aggregation_function)
+
+    body = await cache.cached(use_cache, execution.run_in_process, request, "single_timeseries", tables.detect_table, detect, df, debug, media_type, 'iso')
+    return tables.table_response(body, media_type)
+
+# Batch single time series anomaly detection
+# Each series is independent, so we run them in parallel and return results keyed by series ID.
+@app.post("/detect/timeseries/single/batch")
+async def post_time_series_single_batch(
+    request: Request,
+    input_data: Dict[str, Union[List[Single_TimeSeries_Input], Single_TimeSeries_Columnar_Input]],
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    multi_resolution: bool = False,
+    use_cache: bool = True,
+    debug: bool = False
+):
+    series = { series_id: to_dataframe(points, ["key", "dt", "value"]) for series_id, points in input_data.items() }
+
+    detect_batch = partial(single_timeseries.detect_single_timeseries_batch, sensitivity_score=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies, multi_resolution=multi_resolution)
+
+    # The batch detector spreads its series across the process pool itself.
+    body = await cache.cached(use_cache, execution.run_in_thread, request, "single_timeseries_batch", serialization.detect_batch_json, detect_batch, series, debug, 'iso')
+    return serialization.json_response(body)
+
+# Streaming single time series anomaly detection
+# The server keeps state for each series_id, so each call only needs to send new points.
+@app.post("/detect/timeseries/single/stream/{series_id}")
+async def post_time_series_single_stream(
+    request: Request,
+    series_id: str,
+    input_data: Union[List[Single_TimeSeries_Input], Single_TimeSeries_Columnar_Input],
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    debug: bool = False
+):
+    df = to_dataframe(input_data, ["key", "dt", "value"])
+
+    detect = partial(streaming_timeseries.detect_single_timeseries_stream, series_id, sensitivity_score=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies)
+
+    # Series state lives in this process, so streaming detection runs here rather than in a worker.
+    body = await execution.run_in_thread(request, "single_timeseries_stream", serialization.detect_json, detect, df, debug, 'iso')
+    return serialization.json_response(body)
+
+@app.delete("/detect/timeseries/single/stream/{series_id}")
+def delete_time_series_single_stream(series_id: str):
+    return { "series_id": series_id, "deleted": streaming_timeseries.reset_series(series_id) }
     
 
 # Multiple time series anomaly detection
@@ -101,21 +435,261 @@ class Multi_TimeSeries_Input(BaseModel):
     series_key: str
     dt: datetime.datetime
     value: float
+
+class Multi_TimeSeries_Columnar_Input(Columnar_Input):
+    key: List[str]
+    series_key: List[str]
+    dt: List[datetime.datetime]
+    value: List[float]
     
 @app.post("/detect/timeseries/multiple")
-def post_time_series_multiple(
-    input_data: List[Multi_TimeSeries_Input],
+async def post_time_series_multiple(
+    request: Request,
+    input_data: Union[List[Multi_TimeSeries_Input], Multi_TimeSeries_Columnar_Input],
     sensitivity_score: float = 50,
     max_fraction_anomalies: float = 1.0,
+    aggregation_interval: Optional[str] = None,
+    aggregation_function: str = "mean",
+    sharded: bool = False,
+    use_cache: bool = True,
     debug: bool = False
 ):
-    df = pd.DataFrame(i.__dict__ for i in input_data)
+    df = to_dataframe(input_data, ["key", "series_key", "dt", "value"])
 
-    (df, weights, details) = multi_timeseries.detect_multi_timeseries(df, sensitivity_score, max_fraction_anomalies)
-    
-    results = { "anomalies": json.loads(df.to_json(orient='records', date_format='iso')) }
+    detect = partial(multi_timeseries.detect_multi_timeseries, sensitivity_score=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies, sharded=sharded)
+    if aggregation_interval is not None:
+        detect = partial(time_buckets.detect_with_time_buckets, detect=detect, aggregation_interval=aggregation_interval,
+            aggregation_function=aggregation_function, group_columns=["series_key"])
     
-    if (debug):
-        results.update({ "debug_weights": weights })
-        results.update({ "debug_details": details })
-    return results
+    # Sharded detection spreads its shards across the process pool itself.
+    if sharded:
+        body = await cache.cached(use_cache, execution.run_in_thread, request, "multi_timeseries", serialization.detect_json, detect, df, debug, 'iso')
+    else:
+        body = await cache.cached(use_cache, execution.run_in_process, request, "multi_timeseries", serialization.detect_json, detect, df, debug, 'iso')
+    return serialization.json_response(body)
+
+@app.post("/detect/timeseries/multiple/sweep")
+async def post_time_series_multiple_sweep(
+    request: Request,
+    input_data: Union[List[Multi_TimeSeries_Input], Multi_TimeSeries_Columnar_Input],
+    sensitivity_score: List[float] = Query([50]),
+    max_fraction_anomalies: List[float] = Query([1.0]),
+    use_cache: bool = True,
+    debug: bool = False
+):
+    df = to_dataframe(input_data, ["key", "series_key", "dt", "value"])
+
+    detect_sweep = partial(multi_timeseries.detect_multi_timeseries_sweep, sensitivity_scores=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies)
+
+    body = await cache.cached(use_cache, execution.run_in_process, request, "multi_timeseries", serialization.detect_sweep_json, detect_sweep, df, debug, 'iso')
+    return serialization.json_response(body)
+
+@app.post("/detect/timeseries/multiple/table")
+async def post_time_series_multiple_table(
+    request: Request,
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    aggregation_interval: Optional[str] = None,
+    aggregation_function: str = "mean",
+    sharded: bool = False,
+    use_cache: bool = True,
+    debug: bool = False
+):
+    (df, media_type) = await read_table_request(request, ["key", "series_key", "dt", "value"])
+
+    detect = partial(multi_timeseries.detect_multi_timeseries, sensitivity_score=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies, sharded=sharded)
+    if aggregation_interval is not None:
+        detect = partial(time_buckets.detect_with_time_buckets, detect=detect, aggregation_interval=aggregation_interval,
+            aggregation_function=aggregation_function, group_columns=["series_key"])
+
+    if sharded:
+        body = await cache.cached(use_cache, execution.run_in_thread, request, "multi_timeseries", tables.detect_table, detect, df, debug, media_type, 'iso')
+    else:
+        body = await cache.cached(use_cache, execution.run_in_process, request, "multi_timeseries", tables.detect_table, detect, df, debug, media_type, 'iso')
+    return tables.table_response(body, media_type)
+
+@app.post("/detect/timeseries/multiple/csv")
+async def post_time_series_multiple_csv(
+    request: Request,
+    file: UploadFile,
+    series_key_column: str = "series_key",
+    dt_column: str = "dt",
+    value_column: str = "value",
+    key_column: Optional[str] = None,
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    aggregation_interval: Optional[str] = None,
+    aggregation_function: str = "mean",
+    sharded: bool = False,
+    use_cache: bool = True,
+    debug: bool = False
+):
+    columns = { "key": key_column, "series_key": series_key_column, "dt": dt_column, "value": value_column }
+    (df, media_type) = await read_csv_request(request, file, columns)
+
+    detect = partial(multi_timeseries.detect_multi_timeseries, sensitivity_score=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies, sharded=sharded)
+    if aggregation_interval is not None:
+        detect = partial(time_buckets.detect_with_time_buckets, detect=detect, aggregation_interval=aggregation_interval,
+            aggregation_function=aggregation_function, group_columns=["series_key"])
+
+    if sharded:
+        body = await cache.cached(use_cache, execution.run_in_thread, request, "multi_timeseries", tables.detect_table, detect, df, debug, media_type, 'iso')
+    else:
+        body = await cache.cached(use_cache, execution.run_in_process, request, "multi_timeseries", tables.detect_table, detect, df, debug, media_type, 'iso')
+    return tables.table_response(body, media_type)
+
+# Sliding window multiple time series anomaly detection
+# The server keeps a window of recent points for each window_id, so each call only needs to send new points.
+# Each call still rescales and rescores the whole window, so its cost grows with window_size as well as with
+# the number of new points.
+@app.post("/detect/timeseries/multiple/window/{window_id}")
+async def post_time_series_multiple_window(
+    request: Request,
+    window_id: str,
+    input_data: Union[List[Multi_TimeSeries_Input], Multi_TimeSeries_Columnar_Input],
+    window_size: int,
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    debug: bool = False
+):
+    df = to_dataframe(input_data, ["key", "series_key", "dt", "value"])
+
+    detect = partial(sliding_multi_timeseries.detect_multi_timeseries_window, window_id, window_size=window_size,
+        sensitivity_score=sensitivity_score, max_fraction_anomalies=max_fraction_anomalies)
+
+    # Window state lives in this process, so sliding window detection runs here rather than in a worker.
+    body = await execution.run_in_thread(request, "multi_timeseries_window", serialization.detect_json, detect, df, debug, 'iso')
+    return serialization.json_response(body)
+
+@app.delete("/detect/timeseries/multiple/window/{window_id}")
+def delete_time_series_multiple_window(window_id: str):
+    return { "window_id": window_id, "deleted": sliding_multi_timeseries.reset_window(window_id) }
+
+
+# Background jobs
+# For calls which may take longer than a client or load balancer will wait, POST the same input and
+# parameters to /jobs/detect/... instead.  The response holds a job ID right away; poll /jobs/{job_id} for
+# its status, then fetch /jobs/{job_id}/result for the same body the direct call would have returned.
+@app.get("/jobs")
+def get_jobs_status():
+    return jobs.get_queue().get_summary()
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = jobs.get_queue().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"There is no job {job_id}.  It may have expired.")
+    return jobs.get_queue().get_status(job)
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(job_id: str):
+    job = jobs.get_queue().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"There is no job {job_id}.  It may have expired.")
+    if job.status != "succeeded":
+        raise HTTPException(status_code=409, detail=jobs.get_queue().get_status(job))
+    return serialization.json_response(job.body)
+
+@app.delete("/jobs/{job_id}")
+def delete_job(job_id: str):
+    job = jobs.get_queue().cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"There is no job {job_id}.  It may have expired.")
+    return jobs.get_queue().get_status(job)
+
+@app.post("/jobs/detect/univariate", status_code=202)
+def post_univariate_job(
+    input_data: Union[List[Univariate_Statistical_Input], Univariate_Statistical_Columnar_Input],
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    latency_budget_ms: Optional[float] = None,
+    debug: bool = False
+):
+    df = to_dataframe(input_data, ["key", "value"])
+
+    detect = partial(univariate.detect_univariate_statistical, sensitivity_score=sensitivity_score, max_fraction_anomalies=max_fraction_anomalies, latency_budget_ms=latency_budget_ms)
+
+    job = jobs.get_queue().submit("univariate", True, serialization.detect_json, detect, df, debug)
+    return jobs.get_queue().get_status(job)
+
+@app.post("/jobs/detect/multivariate", status_code=202)
+def post_multivariate_job(
+    input_data: Union[List[Multivariate_Input], Multivariate_Columnar_Input],
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    n_neighbors: int = 10,
+    latency_budget_ms: Optional[float] = None,
+    debug: bool = False
+):
+    df = to_dataframe(input_data, ["key", "vals"])
+
+    detect = partial(multivariate.detect_multivariate_statistical, sensitivity_score=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies, n_neighbors=n_neighbors, latency_budget_ms=latency_budget_ms)
+
+    job = jobs.get_queue().submit("multivariate", True, serialization.detect_json, detect, df, debug)
+    return jobs.get_queue().get_status(job)
+
+@app.post("/jobs/detect/timeseries/single", status_code=202)
+def post_time_series_single_job(
+    input_data: Union[List[Single_TimeSeries_Input], Single_TimeSeries_Columnar_Input],
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    multi_resolution: bool = False,
+    aggregation_interval: Optional[str] = None,
+    aggregation_function: str = "mean",
+    latency_budget_ms: Optional[float] = None,
+    debug: bool = False
+):
+    df = to_dataframe(input_data, ["key", "dt", "value"])
+
+    detect = partial(single_timeseries.detect_single_timeseries, sensitivity_score=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies, multi_resolution=multi_resolution, latency_budget_ms=latency_budget_ms)
+    if aggregation_interval is not None:
+        detect = partial(time_buckets.detect_with_time_buckets, detect=detect, aggregation_interval=aggregation_interval,
+            aggregation_function=aggregation_function)
+
+    job = jobs.get_queue().submit("single_timeseries", True, serialization.detect_json, detect, df, debug, 'iso')
+    return jobs.get_queue().get_status(job)
+
+@app.post("/jobs/detect/timeseries/single/batch", status_code=202)
+def post_time_series_single_batch_job(
+    input_data: Dict[str, Union[List[Single_TimeSeries_Input], Single_TimeSeries_Columnar_Input]],
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    multi_resolution: bool = False,
+    debug: bool = False
+):
+    series = { series_id: to_dataframe(points, ["key", "dt", "value"]) for series_id, points in input_data.items() }
+
+    detect_batch = partial(single_timeseries.detect_single_timeseries_batch, sensitivity_score=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies, multi_resolution=multi_resolution)
+
+    # The batch detector spreads its series across the process pool itself.
+    job = jobs.get_queue().submit("single_timeseries_batch", False, serialization.detect_batch_json, detect_batch, series, debug, 'iso')
+    return jobs.get_queue().get_status(job)
+
+@app.post("/jobs/detect/timeseries/multiple", status_code=202)
+def post_time_series_multiple_job(
+    input_data: Union[List[Multi_TimeSeries_Input], Multi_TimeSeries_Columnar_Input],
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    aggregation_interval: Optional[str] = None,
+    aggregation_function: str = "mean",
+    sharded: bool = False,
+    debug: bool = False
+):
+    df = to_dataframe(input_data, ["key", "series_key", "dt", "value"])
+
+    detect = partial(multi_timeseries.detect_multi_timeseries, sensitivity_score=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies, sharded=sharded)
+    if aggregation_interval is not None:
+        detect = partial(time_buckets.detect_with_time_buckets, detect=detect, aggregation_interval=aggregation_interval,
+            aggregation_function=aggregation_function, group_columns=["series_key"])
+
+    # Sharded detection spreads its shards across the process pool itself.
+    job = jobs.get_queue().submit("multi_timeseries", not sharded, serialization.detect_json, detect, df, debug, 'iso')
+    return jobs.get_queue().get_status(job)
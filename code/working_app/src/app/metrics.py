@@ -0,0 +1,211 @@
+# Finding Ghosts in Your Data
+# Prometheus metrics for the detection endpoints.
+# We count requests, and track latency and input size for each detection route, how often each test in
+# the ensembles actually runs, and a few gauges read at scrape time:  endpoint queues, admission control,
+# the result cache, background jobs, and this process's memory.  The text format is simple enough that
+# writing it ourselves saves a dependency.
+
+import os
+import time
+import resource
+import threading
+import contextvars
+from . import admission, cache, execution, jobs
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+ROW_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000, 10000000)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+UNMATCHED_ROUTE = "unmatched"
+
+# Nearly every update happens on the event loop, in the middleware or the execution layer, and scrapes run
+# there too, so histograms need no lock.  Background jobs finish on their own threads and add to the test
+# counter, so counters take a lock.
+class Counter:
+    def __init__(self, name, help, label_names):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{format_labels(self.label_names, labels)} {format_value(v)}" for (labels, v) in values]
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, label_names, buckets):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        # For each set of labels:  a count per bucket (not cumulative), then the sum of all observations.
+        self.values = {}
+
+    def observe(self, labels, value):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = [[0] * (len(self.buckets) + 1), 0.0]
+            self.values[labels] = entry
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        entry[0][i] += 1
+        entry[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for (labels, (counts, total)) in sorted(self.values.items()):
+            cumulative = 0
+            for (bound, count) in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else format_value(bound)
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names + ('le',), labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{escape(v)}"' for (n, v) in zip(names, values)) + "}"
+
+def format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+def sample(name, help, type, samples):
+    # samples is a list of (label names, label values, value), read fresh for each scrape.
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+    lines += [f"{name}{format_labels(names, labels)} {format_value(v)}" for (names, labels, v) in samples]
+    return lines
+
+def gauge(name, help, samples):
+    return sample(name, help, "gauge", samples)
+
+def counter(name, help, samples):
+    # For totals which another part of the service already keeps.
+    return sample(name, help, "counter", samples)
+
+requests_total = Counter("detector_requests_total", "Detection requests by route, method, and response status.", ("route", "method", "status"))
+request_seconds = Histogram("detector_request_duration_seconds", "Time to answer each detection request.", ("route",), LATENCY_BUCKETS)
+input_rows = Histogram("detector_input_rows", "Rows of input data in each detection call.", ("route",), ROW_BUCKETS)
+tests_total = Counter("detector_tests_run_total", "Times each test in an ensemble ran.", ("endpoint", "test"))
+
+def get_route(scope):
+    # The route template (such as /detect/timeseries/single/stream/{series_id}) rather than the path,
+    # so that IDs in paths do not each make a new series.  Requests which matched no route share one
+    # label, or anyone could make a new series for every made-up URL.
+    route = scope.get("route")
+    return getattr(route, "path", None) or UNMATCHED_ROUTE
+
+class MetricsMiddleware:
+    # A plain ASGI middleware, which adds less to each request than Starlette's BaseHTTPMiddleware.
+    def __init__(self, app, prefix="/detect"):
+        self.app = app
+        self.prefix = prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope.get("path", "").startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = [500]
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = get_route(scope)
+            requests_total.inc((route, scope.get("method", ""), str(status[0])))
+            request_seconds.observe((route,), time.perf_counter() - start)
+
+def get_num_rows(data):
+    # A DataFrame, or a dictionary of DataFrames for batch detection.  Anything else is not detector input.
+    if isinstance(data, dict) and all(hasattr(df, "columns") for df in data.values()):
+        return sum(len(df) for df in data.values())
+    return len(data) if hasattr(data, "columns") else None
+
+def record_call(request, endpoint, args, tests_run):
+    # args are what the execution layer passes to an encoding function:  the detector, then its data.
+    num_rows = get_num_rows(args[1]) if len(args) >= 2 else None
+    if num_rows is not None:
+        input_rows.observe((get_route(request.scope),), num_rows)
+    record_tests(endpoint, tests_run)
+
+def record_tests(endpoint, tests_run):
+    for (test, count) in tests_run.items():
+        tests_total.inc((endpoint, test), count)
+
+# Set in the process which runs a detector, so that the tests it ran can travel back with its response.
+_tests_run = contextvars.ContextVar("tests_run", default=None)
+
+def run_counting_tests(f, *args):
+    tests_run = {}
+    token = _tests_run.set(tests_run)
+    try:
+        return (f(*args), tests_run)
+    finally:
+        _tests_run.reset(token)
+
+def get_tests_run(details):
+    # Univariate detection keeps its tests under its test diagnostics; the others keep them at the top level.
+    if not isinstance(details, dict):
+        return {}
+    return details.get("Tests run") or details.get("Test diagnostics", {}).get("Tests Run") or {}
+
+def count_tests(result):
+    # result is a detector's (df, weights, details) or sweep tuple, or a dictionary of them for a batch.
+    tests_run = _tests_run.get()
+    if tests_run is None:
+        return
+    results = result.values() if isinstance(result, dict) else [result]
+    for r in results:
+        for (test, ran) in get_tests_run(r[2]).items():
+            if ran:
+                tests_run[test] = tests_run.get(test, 0) + 1
+
+def get_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # Elsewhere, fall back to the peak, which the kernel reports in kilobytes.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def render():
+    lines = []
+    for metric in (requests_total, request_seconds, input_rows, tests_total):
+        lines += metric.render()
+    queues = execution.get_queue_status()
+    lines += gauge("detector_endpoint_running", "Calls running for each endpoint.", [(("endpoint",), (e,), q["running"]) for (e, q) in sorted(queues.items())])
+    lines += gauge("detector_endpoint_waiting", "Calls waiting for a slot for each endpoint.", [(("endpoint",), (e,), q["waiting"]) for (e, q) in sorted(queues.items())])
+    lines += gauge("detector_endpoint_limit", "Calls each endpoint may run at once.", [(("endpoint",), (e,), q["limit"]) for (e, q) in sorted(queues.items())])
+    a = admission.get_controller().get_status()
+    lines += gauge("detector_admission_waiting", "Calls waiting for admission.", [((), (), a["waiting"])])
+    lines += gauge("detector_admission_cpu_seconds_in_flight", "Estimated CPU seconds of admitted calls.", [((), (), a["cpu_seconds_in_flight"])])
+    lines += counter("detector_admission_rejected_total", "Calls turned away by admission control.", [((), (), a["rejected"])])
+    c = cache.get_cache().get_stats()
+    lookups = c["hits"] + c["disk_hits"] + c["misses"]
+    lines += counter("detector_cache_lookups_total", "Result cache lookups by outcome.",
+        [(("result",), (r,), c[k]) for (r, k) in (("hit", "hits"), ("disk_hit", "disk_hits"), ("miss", "misses"))])
+    lines += gauge("detector_cache_hit_ratio", "Share of result cache lookups answered from memory or disk.", [((), (), (c["hits"] + c["disk_hits"]) / lookups if lookups else 0.0)])
+    lines += gauge("detector_cache_bytes", "Bytes held in the in-memory result cache.", [((), (), c["bytes"])])
+    j = jobs.get_queue().get_summary()
+    lines += gauge("detector_jobs", "Background jobs by status.", [(("status",), (s,), n) for (s, n) in j["jobs"].items()])
+    lines += gauge("process_resident_memory_bytes", "Resident memory size in bytes.", [((), (), get_rss_bytes())])
+    return "\n".join(lines) + "\n"
@@ -4,55 +4,133 @@
 
 import pandas as pd
 import numpy as np
-from pandas.core import base
-from tslearn.piecewise import SymbolicAggregateApproximation
+from scipy.stats import norm
+from functools import partial
+from . import pool, sweep, timing
 
 def detect_multi_timeseries(
     df,
     sensitivity_score,
-    max_fraction_anomalies
+    max_fraction_anomalies,
+    sharded=False
 ):
     weights = { "DIFFSTD": 1.0, "SAX": 1.0 }
 
-    # Ensure that everything is sorted by dt and series key
-    df = df.sort_values(["dt", "series_key"], axis=0, ascending=True)
-    
     num_series = len(df["series_key"].unique())
-    num_data_points = df['value'].count()
-    if (num_data_points / num_series < 15):
-        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, f"Must have a minimum of at least fifteen data points per time series for anomaly detection.  You sent {num_data_points} per series.")
-    elif (num_series < 2):
-        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, f"Must have a minimum of at least two time series for anomaly detection.  You sent {num_series} series.")
+    message = check_series(df)
+    if message is not None:
+        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, message)
     elif (max_fraction_anomalies <= 0.0 or max_fraction_anomalies > 1.0):
         return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a valid max fraction of anomalies, 0 < x <= 1.0.")
     elif (sensitivity_score <= 0 or sensitivity_score > 100 ):
         return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a valid sensitivity score, 0 < x <= 100.")
     else:
-        (df_tested, tests_run, diagnostics) = run_tests(df)
-        (df_scored, diag_scored) = score_results(df_tested, tests_run, sensitivity_score)
-        (df_out, diag_outliers) = determine_outliers(df_scored, max_fraction_anomalies)
+        with timing.stage("align_series"):
+            (row_order, values) = align_series(df)
+        if (sharded):
+            # Spread the series across worker processes, one shard per worker.
+            num_shards = min(pool.get_num_workers(), num_series)
+            # Shards run in other processes, so only the time spent waiting on them shows up here.
+            with timing.stage("run_tests_sharded"):
+                (tests, tests_run, diagnostics) = run_tests_sharded(values, num_shards)
+            with timing.stage("score_results_sharded"):
+                (scores, diag_scored, is_anomaly, diag_outliers) = score_results_sharded(tests, tests_run, sensitivity_score, max_fraction_anomalies, num_shards, ~np.isnan(values))
+        else:
+            with timing.stage("run_tests"):
+                (tests, tests_run, diagnostics) = run_tests(values)
+            with timing.stage("score_results"):
+                (scores, diag_scored) = score_results(tests, tests_run, sensitivity_score, ~np.isnan(values))
+            with timing.stage("determine_outliers"):
+                (is_anomaly, diag_outliers) = determine_outliers(scores["anomaly_score"], max_fraction_anomalies, ~np.isnan(values))
+        with timing.stage("unpivot_results"):
+            df_out = unpivot_results(df, row_order, tests, scores, is_anomaly)
         return (df_out, weights, { "message": "Result of single time series statistical tests.", "Tests run": tests_run, "Test diagnostics": diagnostics, "Outlier scoring": diag_scored, "Outlier determination": diag_outliers})
 
-def run_tests(df):
+def detect_multi_timeseries_sweep(
+    df,
+    sensitivity_scores,
+    max_fraction_anomalies
+):
+    # Run SAX and DIFFSTD once, then score and threshold with each combination of settings.  The sensitivity
+    # score goes into the anomaly score here, so each combination has its own anomaly scores as well as
+    # outliers, while the distances are the same for all of them.
+    weights = { "DIFFSTD": 1.0, "SAX": 1.0 }
+    combinations = sweep.get_combinations(sensitivity_scores, max_fraction_anomalies)
+    message = check_series(df) or sweep.check_combinations(combinations)
+    if message is not None:
+        return sweep.invalid(df, weights, message)
+    (row_order, values) = align_series(df)
+    valid = ~np.isnan(values)
+    present = row_order >= 0
+    (tests, tests_run, diagnostics) = run_tests(values)
+    thresholds = []
+    for (s, m) in combinations:
+        (scores, diag_scored) = score_results(tests, tests_run, s, valid)
+        (is_anomaly, diag_outliers) = determine_outliers(scores["anomaly_score"], m, valid)
+        thresholds.append(sweep.get_threshold(s, m, is_anomaly[present], scores["anomaly_score"][present]))
+    df_out = unpivot_results(df, row_order, tests, scores, is_anomaly).drop(columns=["diffstd_score", "sax_score", "anomaly_score", "is_anomaly"])
+    return (df_out, weights, { "message": "Result of single time series statistical tests.", "Tests run": tests_run, "Test diagnostics": diagnostics}, thresholds)
+
+def check_series(df):
+    num_series = len(df["series_key"].unique())
+    num_data_points = df['value'].count()
+    if (num_data_points / num_series < 15):
+        return f"Must have a minimum of at least fifteen data points per time series for anomaly detection.  You sent {num_data_points} per series."
+    elif (num_series < 2):
+        return f"Must have a minimum of at least two time series for anomaly detection.  You sent {num_series} series."
+    elif (df[['series_key', 'dt']].duplicated().any()):
+        return "Each time series may have at most one data point per dt."
+    return None
+
+def align_series(df):
+    # Place the long input (one row per series and point in time) onto a contiguous (series x time) grid,
+    # once.  The grid has one column for every dt in any series, so series which dropped points or
+    # started late still line up with the others by time.  Series keys become categorical codes and
+    # timestamps become positions in the sorted set of distinct dt values.  Categories are sorted, so
+    # series come out in series_key order.
+    series_codes = pd.Categorical(df['series_key']).codes
+    dt = pd.to_datetime(df['dt'], utc=True).to_numpy(dtype='datetime64[ns]').view('int64')
+    (times, time_codes) = np.unique(dt, return_inverse=True)
+    num_series = series_codes.max() + 1
+    # row_order[i][j] is the position in df of the ith series at the jth point in time, or -1 if that
+    # series has no point then.  Missing points have a value of NaN, and every test below skips NaNs.
+    row_order = np.full((num_series, times.shape[0]), -1)
+    row_order[series_codes, time_codes] = np.arange(df.shape[0])
+    values = np.where(row_order >= 0, df['value'].to_numpy(dtype=float)[row_order], np.nan)
+    return (row_order, values)
+
+def unpivot_results(df, row_order, tests, scores, is_anomaly):
+    # Rebuild the long format a single time at the end, one series after another, keeping only
+    # the points which were in the input.
+    (num_series, l) = row_order.shape
+    present = row_order >= 0
+    return df.iloc[row_order[present]].assign(
+        sax_distance=tests["sax_distance"][present],
+        segment_number=np.broadcast_to(tests["segment_number"], (num_series, l))[present],
+        diffstd_distance=tests["diffstd_distance"][present],
+        diffstd_score=scores["diffstd_score"][present],
+        sax_score=scores["sax_score"][present],
+        anomaly_score=scores["anomaly_score"][present],
+        is_anomaly=is_anomaly[present])
+
+def run_tests(values):
     tests_run = {
         "DIFFSTD": 1,
         "SAX": 1
     }
 
-    # Break out each series to operate on individually.
-    series = [y for x, y in df.groupby("series_key", as_index=False)]
+    # Each row of values is one series, in order by time.
     # Grab basic information:  number of series, length of series.
-    num_series = len(series)
-    l = len(series[0])
+    (num_series, l) = values.shape
 
     diagnostics = {
         "Number of time series": num_series,
         "Time series length": l
     }
 
-    # Perform SAX first while everything is still in individual series.
-    # This will add sax_distance to each point in each series.
-    (series, diag_sax) = check_sax(series, num_series, l)
+    # Perform SAX, which gives us a sax_distance for each point in each series.
+    with timing.stage("sax"):
+        (sax_distances, diag_sax) = check_sax(values, l)
     diagnostics["SAX"] = diag_sax    
 
     # Break out the series into segments of approximately 7 data points.
@@ -60,175 +138,376 @@ def run_tests(df):
     # We use integer math here to ensure no segment has just 1-2 records and no segment
     # is wildly unbalanced in size compared to the others.  At a minimum,
     # we should have 6 data points per segment.  At a maximum, we can end up with 10.
-    series_segments = [np.array_split(series[x], (l // 7)) for x in range(num_series)]
-    num_segments = len(series_segments[0])
-    num_records = df['key'].shape[0]
+    num_segments = l // 7
+    num_records = num_series * l
 
     diagnostics["Number of records"] = num_records
     diagnostics["Number of segments per time series"] = num_segments
 
-    segment_means = generate_segment_means(series_segments, num_series, num_segments)
-    diagnostics["Segment means"] = segment_means
-    segments_diffstd = check_diffstd(series_segments, segment_means, num_series, num_segments)
-    # Merge segments together as df.  Segments comes in as a list of lists, each of which contains a DataFrame.
-    # First, flatten out the list of lists, giving us a list of DataFrames.
-    flattened = [item for sublist in segments_diffstd for item in sublist]
-    # Next, concatenate the DataFrames together.
-    df = pd.concat(flattened)
-
-    return (df, tests_run, diagnostics)
-
-def generate_segment_means(series_segments, num_series, num_segments):
-    means = []
-    for j in range(num_segments):
-        C = [series_segments[i][j]['value'] for i in range(num_series)]
-        means.append([sum(x)/num_series for x in zip(*C)])
-    return means
-
-def diffstd(s1v, s2v):
-    # Find the differences between the two input segments.
-    dt = [x1 - x2 for (x1, x2) in zip(s1v, s2v)]
-    n = len(s1v)
-    mu = np.mean(dt)
-    # For each difference, square its distance from the mean.  This guarantees all numbers are positive.
-    diff2 = [(d-mu)**2 for d in dt]
-    # Sum the squared differences, divide by the number of data points (to get an average),
-    # and take the square root of the result.  This returns a single number, the DIFFSTD comparing
-    # these two segments.
-    return (np.sum(diff2)/n)**0.5
-
-def check_diffstd(series_segments, segment_means, num_series, num_segments):
-    # For each series, make a pairwise comparison against the average.
-    for i in range(num_series):
-        for j in range(num_segments):
-            series_segments[i][j]['segment_number'] = j
-            series_segments[i][j]['diffstd_distance'] = diffstd(series_segments[i][j]['value'], segment_means[j])
-    return series_segments
+    (segment_starts, segment_sizes) = generate_segment_bounds(l, num_segments)
+    segment_means = generate_segment_means(values)
+    diagnostics["Segment means"] = [segment_means[start:start + size].tolist() for (start, size) in zip(segment_starts, segment_sizes)]
+    with timing.stage("diffstd"):
+        (segment_numbers, diffstd_distances) = check_diffstd(values, segment_means, segment_starts, segment_sizes)
 
-def check_sax(series, num_series, l):
+    tests = {
+        "sax_distance": sax_distances,
+        "segment_number": segment_numbers,
+        "diffstd_distance": diffstd_distances
+    }
+    return (tests, tests_run, diagnostics)
+
+def generate_segment_bounds(l, num_segments):
+    # Split l points into num_segments segments the same way np.array_split does:
+    # the first (l % num_segments) segments get one extra point.
+    segment_sizes = np.full(num_segments, l // num_segments)
+    segment_sizes[:l % num_segments] += 1
+    segment_starts = np.concatenate([[0], np.cumsum(segment_sizes)[:-1]])
+    return (segment_starts, segment_sizes)
+
+def generate_segment_means(values):
+    # The mean across all series at each point in time, counting only the series which have a point then.
+    # Every point in time on the grid has at least one series.
+    return np.nansum(values, axis=0) / np.count_nonzero(~np.isnan(values), axis=0)
+
+def check_diffstd(values, segment_means, segment_starts, segment_sizes):
+    (segment_numbers, segment_diffstd) = calculate_segment_diffstd(values, segment_means, segment_starts, segment_sizes)
+    # Every point in a segment gets that segment's DIFFSTD.
+    return (segment_numbers, segment_diffstd[:, segment_numbers])
+
+def calculate_segment_diffstd(values, segment_means, segment_starts, segment_sizes):
+    # This is DIFFSTD for every series and segment at once:  the population standard deviation of the
+    # differences between each series and the segment means.
+    # For each series, make a pairwise comparison against the average.
+    segment_numbers = np.repeat(np.arange(segment_sizes.shape[0]), segment_sizes)
+    # Missing points count as a difference of zero and drop out of the point counts.
+    # A segment where a series has no points at all gets a DIFFSTD of zero.
+    valid = ~np.isnan(values)
+    differences = np.where(valid, values - segment_means, 0.0)
+    # reduceat sums each segment of each row, giving us a (series x segment) array.
+    counts = np.maximum(np.add.reduceat(valid, segment_starts, axis=1), 1)
+    mu = np.add.reduceat(differences, segment_starts, axis=1) / counts
+    diff2 = np.where(valid, (differences - mu[:, segment_numbers])**2, 0.0)
+    return (segment_numbers, (np.add.reduceat(diff2, segment_starts, axis=1) / counts)**0.5)
+
+def get_sax_segment_split(l):
     if (l < 100):
-        segment_split = 2
+        return 2
     elif (l < 1000):
-        segment_split = 3
+        return 3
     else:
-        segment_split = 5
+        return 5
+
+def check_sax(values, l):
+    segment_split = get_sax_segment_split(l)
 
     # The current recommendation for SAX is that you limit the alphabet size to 3-5, with 4 being
-    # the typical sweet spot.  We also want to normalize our input data, so scale = True.
+    # the typical sweet spot.  We also want to normalize our input data before converting it.
     # We determine each alphabet character based on 2-5 data points (depending on total data length)
-    sax = SymbolicAggregateApproximation(n_segments= l//segment_split, alphabet_size_avg=4, scale=True)
-
-    # slist is a list of lists:  one list per series, NOT per segment!
-    slist = [series[i]['value'].tolist() for i in range(num_series)]
+    n_segments = l // segment_split
+    alphabet_size = 4
+    num_series = values.shape[0]
 
-    # sax_data is an array containing a list (one per series) of lists (containing the "letter")
-    #    eg:  array([ [[1],[1],[1]], [[1],[0],[2]], [[2],[2],[1]] ])
-    # Note that tslearn doesn't use a letter-based alphabet but instead a numeric one:  0, 1, 2, 3.
-    sax_data = sax.fit_transform(slist)
+    # sax_data is an array containing one row per series, with one "letter" per segment.
+    #    eg:  array([ [1,1,1], [1,0,2], [2,2,1] ])
+    # As with tslearn, we use a numeric alphabet rather than a letter-based one:  0, 1, 2, 3.
+    (sax_data, breakpoints) = generate_sax_symbols(values, n_segments, alphabet_size, np.nanmean(values), np.nanstd(values))
 
-    # tslearn gives us the ability to perform pairwise comparisons of SAX results using a distance measure.
     # We will break things into fixed-size chunks of 4 letters, e.g. 1103 | 3111 | 2203
     # Then, we can perform 1-versus-all comparisons of each word versus the other words in the same position.
     word_size = 4
-    num_words = len(sax_data[0])//word_size
-
-    # Create a matrix which will hold the mean score of these pairwise comparisons.
-    m = np.empty((num_series, num_words))
-    for i in range(num_series):
-        for j in range(num_words):
-            # Calculate pairwise distances for each word of SAX results
-            # For example, given three series:
-            #  1103 | 1111 | 2203
-            #  1100 | 2111 | 2202
-            #  1211 | 3111 | 2201
-            # We would find the distance between 1103 and each of 1100 and 1211 and average it out.
-            # That result would go into m[0][0].
-            # m[0][1] would be the average distance between 1111 and 2111 / 3111, etc.
-            # The calculation here technically also includes the distance between 1103 and 1103, which is always 0.
-            # Therefore, we subtract 1 from num_series and we still get a good average.
-            m[i][j] = sum(sax.distance_sax(sax_data[i][j*word_size:(1+j)*word_size],sax_data[k][j*word_size:(1+j)*word_size])
-                for k in range(num_series))/(num_series-1)
-
+    num_words = n_segments//word_size
+
+    # Calculate pairwise distances for each word of SAX results
+    # For example, given three series:
+    #  1103 | 1111 | 2203
+    #  1100 | 2111 | 2202
+    #  1211 | 3111 | 2201
+    # We would find the distance between 1103 and each of 1100 and 1211 and average it out.
+    # That result would go into m[0][0].
+    # m[0][1] would be the average distance between 1111 and 2111 / 3111, etc.
+    # The calculation here technically also includes the distance between 1103 and 1103, which is always 0.
+    # Therefore, we subtract 1 from num_series and we still get a good average.
+    # With only alphabet_size^word_size possible words, rather than compare every pair of series, we count how
+    # many series have each word in each position and look up word-to-word distances in a table.
+    word_ids = generate_word_ids(sax_data, num_words, word_size, alphabet_size)
+    word_counts = generate_word_counts(word_ids, alphabet_size**word_size)
+    word_distances = generate_word_distances(breakpoints, word_size, l)
+    m = calculate_sax_matrix(word_ids, word_counts, word_distances, num_series)
+    return generate_sax_distances(m, l, segment_split, n_segments, word_size)
+
+def generate_sax_distances(m, l, segment_split, n_segments, word_size):
+    num_words = m.shape[1]
     diagnostics = {
         "Segment size per letter": segment_split,
-        "Number of segments":  l//segment_split,
+        "Number of segments":  n_segments,
         "Word size": word_size,
         "Number of words": num_words,
         "SAX matrix": m.tolist()
     }
 
     # Set the SAX distance for each section of each series.
-    for i in range(num_series):
-        # If we have "overflow" (e.g., 19 data points and segment_split=2, use the final word)
-        series[i]['sax_distance'] = [m[i][min(j//(word_size*segment_split), num_words-1)] for j,val in enumerate(series[0].index)]
-
-    return (series, diagnostics)
+    # If we have "overflow" (e.g., 19 data points and segment_split=2, use the final word)
+    word_numbers = np.minimum(np.arange(l)//(word_size*segment_split), num_words-1)
+    return (m[:, word_numbers], diagnostics)
+
+def generate_sax_symbols(values, n_segments, alphabet_size, mean, std):
+    # This follows tslearn's SymbolicAggregateApproximation with scale=True:  normalize by the mean
+    # and standard deviation of the entire dataset, average each segment (Piecewise Aggregate
+    # Approximation, or PAA), and then find which slice of the normal distribution each average falls in.
+    if std == 0.0:
+        std = 1.0
+    scaled = (values - mean) / std
+    # Each segment gets the same number of points.  Any remainder at the end is ignored.
+    # Missing points drop out of each average.
+    segment_size = values.shape[1] // n_segments
+    segments = scaled[:, :n_segments*segment_size].reshape(values.shape[0], n_segments, segment_size)
+    counts = np.count_nonzero(~np.isnan(segments), axis=2)
+    paa = fill_missing_segments(np.nansum(segments, axis=2) / np.maximum(counts, 1), counts > 0)
+    breakpoints = norm.ppf([float(a) / alphabet_size for a in range(1, alphabet_size)])
+    return (np.searchsorted(breakpoints, paa, side='right'), breakpoints)
+
+def fill_missing_segments(paa, present):
+    # A series with no points at all in a segment carries its previous segment forward,
+    # or takes the next segment if the gap is at the start.
+    positions = np.arange(paa.shape[1])
+    previous = np.maximum.accumulate(np.where(present, positions, 0), axis=1)
+    following = np.minimum.accumulate(np.where(present, positions, paa.shape[1] - 1)[:, ::-1], axis=1)[:, ::-1]
+    fill_from = np.where(np.take_along_axis(present, previous, axis=1), previous, following)
+    return np.take_along_axis(paa, fill_from, axis=1)
+
+def generate_word_ids(sax_data, num_words, word_size, alphabet_size):
+    # Treat each word as a base-alphabet_size number, giving a (series x word) array of IDs.
+    words = sax_data[:, :num_words*word_size].reshape(sax_data.shape[0], num_words, word_size)
+    place_values = alphabet_size ** np.arange(word_size - 1, -1, -1)
+    return words @ place_values
+
+def generate_word_counts(word_ids, num_possible_words):
+    # Count how many series have each possible word in each word position.
+    num_words = word_ids.shape[1]
+    counts = np.zeros((num_words, num_possible_words))
+    np.add.at(counts, (np.broadcast_to(np.arange(num_words), word_ids.shape), word_ids), 1)
+    return counts
+
+def generate_word_distances(breakpoints, word_size, l):
+    # MINDIST between SAX symbols:  adjacent symbols are 0 apart, and others are the gap between
+    # the breakpoints separating them.  We square these so we can sum them across a word.
+    alphabet_size = breakpoints.shape[0] + 1
+    r = np.arange(alphabet_size)
+    (high, low) = (np.maximum.outer(r, r), np.minimum.outer(r, r))
+    symbol_distances = np.where(high - low > 1, (breakpoints[np.maximum(high - 1, 0)] - breakpoints[np.minimum(low, alphabet_size - 2)])**2, 0.0)
+    # Broadcast the symbol table across every pair of words, one letter position at a time.
+    num_possible_words = alphabet_size**word_size
+    letters = (np.arange(num_possible_words)[:, None] // (alphabet_size ** np.arange(word_size - 1, -1, -1))) % alphabet_size
+    squared = symbol_distances[letters[:, None, :], letters[None, :, :]].sum(axis=2)
+    # As in tslearn, scale by the original series length over the length of the SAX representation (here, one word).
+    return np.sqrt(squared * float(l) / word_size)
+
+def calculate_sax_matrix(word_ids, word_counts, word_distances, num_series):
+    # For each word position, the total distance from each possible word to every series' word in that position.
+    total_distances = word_counts @ word_distances.T
+    num_words = word_ids.shape[1]
+    return total_distances[np.arange(num_words), word_ids] / (num_series - 1)
+
+def run_tests_sharded(values, num_shards):
+    # The same tests as run_tests(), but with per-series work split into shards of rows that can run
+    # in separate processes.  The cross-series parts of DIFFSTD and SAX only need a few statistics which
+    # we can add up across shards:  sums at each point in time (for segment means), the count, mean,
+    # and sum of squared deviations of all values (for SAX scaling), and how many series have each
+    # possible word in each word position (for average SAX distances).
+    tests_run = {
+        "DIFFSTD": 1,
+        "SAX": 1
+    }
+    (num_series, l) = values.shape
+    diagnostics = {
+        "Number of time series": num_series,
+        "Time series length": l,
+        "Number of shards": num_shards
+    }
+    shards = np.array_split(values, num_shards)
+
+    summaries = pool.map_in_pool(summarize_shard, shards)
+    segment_means = np.sum([summary[0] for summary in summaries], axis=0) / np.sum([summary[4] for summary in summaries], axis=0)
+    (count, mean, m2) = merge_moments([summary[1:4] for summary in summaries])
+    std = (m2 / count)**0.5
+
+    num_segments = l // 7
+    (segment_starts, segment_sizes) = generate_segment_bounds(l, num_segments)
+    segment_split = get_sax_segment_split(l)
+    n_segments = l // segment_split
+    alphabet_size = 4
+    word_size = 4
+    encode = partial(encode_shard, segment_means=segment_means, segment_starts=segment_starts, segment_sizes=segment_sizes,
+        n_segments=n_segments, alphabet_size=alphabet_size, word_size=word_size, mean=mean, std=std)
+    encoded = pool.map_in_pool(encode, shards)
+    word_ids = np.vstack([e[0] for e in encoded])
+    word_counts = np.sum([e[1] for e in encoded], axis=0)
+    diffstd_distances = np.vstack([e[2] for e in encoded])
+
+    breakpoints = norm.ppf([float(a) / alphabet_size for a in range(1, alphabet_size)])
+    word_distances = generate_word_distances(breakpoints, word_size, l)
+    m = calculate_sax_matrix(word_ids, word_counts, word_distances, num_series)
+    (sax_distances, diag_sax) = generate_sax_distances(m, l, segment_split, n_segments, word_size)
+    diagnostics["SAX"] = diag_sax
+    diagnostics["Number of records"] = num_series * l
+    diagnostics["Number of segments per time series"] = num_segments
+    diagnostics["Segment means"] = [segment_means[start:start + size].tolist() for (start, size) in zip(segment_starts, segment_sizes)]
 
-def score_results(df, tests_run, sensitivity_score):
-    # Calculate anomaly score for each series independently.
+    tests = {
+        "sax_distance": sax_distances,
+        "segment_number": np.repeat(np.arange(num_segments), segment_sizes),
+        "diffstd_distance": diffstd_distances
+    }
+    return (tests, tests_run, diagnostics)
+
+def summarize_shard(values):
+    # Squared deviations from the shard's own mean, rather than squares of the values, so that series far
+    # from zero do not lose their spread to rounding.
+    valid = ~np.isnan(values)
+    count = np.count_nonzero(valid)
+    mean = np.nansum(values) / count if count > 0 else 0.0
+    return (np.nansum(values, axis=0), count, mean, np.nansum((values - mean)**2), np.count_nonzero(valid, axis=0))
+
+def merge_moments(moments):
+    # Combine (count, mean, sum of squared deviations) from each shard with Chan et al.'s pairwise update,
+    # which gives the same standard deviation as np.nanstd over all of the values at once.
+    (count, mean, m2) = (0, 0.0, 0.0)
+    for (n, shard_mean, shard_m2) in moments:
+        if n == 0:
+            continue
+        delta = shard_mean - mean
+        total = count + n
+        mean += delta * n / total
+        m2 += shard_m2 + delta**2 * count * n / total
+        count = total
+    return (count, mean, m2)
+
+def encode_shard(values, segment_means, segment_starts, segment_sizes, n_segments, alphabet_size, word_size, mean, std):
+    (sax_data, breakpoints) = generate_sax_symbols(values, n_segments, alphabet_size, mean, std)
+    word_ids = generate_word_ids(sax_data, n_segments//word_size, word_size, alphabet_size)
+    word_counts = generate_word_counts(word_ids, alphabet_size**word_size)
+    (segment_numbers, diffstd_distances) = check_diffstd(values, segment_means, segment_starts, segment_sizes)
+    return (word_ids, word_counts, diffstd_distances)
+
+def score_results_sharded(tests, tests_run, sensitivity_score, max_fraction_anomalies, num_shards, valid):
+    # Scoring and outlier determination treat each series independently, so each shard can do both.
+    row_shards = np.array_split(np.arange(tests["diffstd_distance"].shape[0]), num_shards)
+    shard_tests = [({
+        "sax_distance": tests["sax_distance"][rows],
+        "segment_number": tests["segment_number"],
+        "diffstd_distance": tests["diffstd_distance"][rows]
+    }, valid[rows]) for rows in row_shards]
+    score = partial(score_shard, tests_run=tests_run, sensitivity_score=sensitivity_score, max_fraction_anomalies=max_fraction_anomalies)
+    results = pool.map_in_pool(score, shard_tests)
+
+    scores = { k: np.vstack([r[0][k] for r in results]) for k in ["diffstd_score", "sax_score", "anomaly_score"] }
+    is_anomaly = np.vstack([r[2] for r in results])
+    # Shards number their series from 0, so renumber them to match the full set.
+    diag_scored = { }
+    diag_outliers = { "Max fraction anomaly scores": [], "Sensitivity scores": [] }
+    for (rows, r) in zip(row_shards, results):
+        for i in range(rows.shape[0]):
+            diag_scored["Series " + str(rows[i])] = r[1]["Series " + str(i)]
+        for k in diag_outliers:
+            diag_outliers[k] += r[3][k]
+    return (scores, diag_scored, is_anomaly, diag_outliers)
+
+def score_shard(shard, tests_run, sensitivity_score, max_fraction_anomalies):
+    (tests, valid) = shard
+    (scores, diag_scored) = score_results(tests, tests_run, sensitivity_score, valid)
+    (is_anomaly, diag_outliers) = determine_outliers(scores["anomaly_score"], max_fraction_anomalies, valid)
+    return (scores, diag_scored, is_anomaly, diag_outliers)
+
+def score_results(tests, tests_run, sensitivity_score, point_counts=None):
+    # Calculate anomaly score for each series (row) independently.
     # This is because DIFFSTD distances are not normalized across series.
-    series = [y for x, y in df.groupby("series_key", as_index=False)]
-    num_series = len(series)
+    # Each column is usually one point in time.  point_counts, if set, says how many points each column
+    # stands for:  one count per column when a column covers several points which share the same distances,
+    # or a (series x time) mask when some series have no point at some times.
+    diffstd_distance = tests["diffstd_distance"]
+    num_series = diffstd_distance.shape[0]
     diagnostics = { }
 
-    for i in range(num_series):
-        # DIFFSTD doesn't have a hard cutoff point describing when something is (or is not) an outlier.
-        # Therefore, to reduce the number of results, we'll start with 1.5 * mean of diffstd distances as a max distance score.
-        diffstd_mean = series[i]['diffstd_distance'].mean()
-
-        # Subtract from 1.5 the sensitivity_score/100.0, so at 100 sensitivity, we use 0.5 * mean as a max distance from the mean.
-        # Ex:  if the mean is 10 and sensitivity_score is 0, we'll look for segments with DIFFSTD above (10 + 1.5*10) = 25
-        # With sensitivity_score 100, the cutoff score will be 15.
-        diffstd_sensitivity_threshold = diffstd_mean + ((1.5 - (sensitivity_score / 100.0)) * diffstd_mean)
-
-        # The diffstd_score is the percentage difference between the distance and the sensitivity threshold.
-        series[i]['diffstd_score'] = (series[i]['diffstd_distance'] - diffstd_sensitivity_threshold) / diffstd_sensitivity_threshold
-
-        # SAX also doesn't have a hard cutoff point so we will use a rule of thumb here as well.
-        # Some divergence is noticeable at approximately 2.5 and major divergence is notable at about 3-4.
-        # If we multiply by 15, we can calculate the percentage of this score versus (100 - sensitivity_score).
-        # This will not necessarily put us on the same scale as DIFFSTD but will ensure that for higher sensitivity
-        # scores, 1.5 will trigger with a SAX score > 0, indicating at least a small outlier.
-        # Also, cap the threshold at a floor value of 25.0 to prevent absurd results.
-        sax_sensitivity_threshold = max(100.0 - sensitivity_score, 25.0)
-        series[i]['sax_score'] = ((series[i]['sax_distance'] * 15.0) - sax_sensitivity_threshold) / sax_sensitivity_threshold
-
-        # Our anomaly score is the sum of diffstd_score and sax_score.  Because DIFFSTD and SAX
-        # split data different ways, this helps us at the margin with determining *which* data points in the series
-        # are the biggest outliers, as the intersection of high SAX + high DIFFSTD will be the most likely culprits.
-        series[i]['anomaly_score'] = series[i]['sax_score'] + series[i]['diffstd_score']
+    # DIFFSTD doesn't have a hard cutoff point describing when something is (or is not) an outlier.
+    # Therefore, to reduce the number of results, we'll start with 1.5 * mean of diffstd distances as a max distance score.
+    diffstd_mean = np.average(diffstd_distance, axis=1, weights=point_counts, keepdims=True)
 
+    # Subtract from 1.5 the sensitivity_score/100.0, so at 100 sensitivity, we use 0.5 * mean as a max distance from the mean.
+    # Ex:  if the mean is 10 and sensitivity_score is 0, we'll look for segments with DIFFSTD above (10 + 1.5*10) = 25
+    # With sensitivity_score 100, the cutoff score will be 15.
+    diffstd_sensitivity_threshold = diffstd_mean + ((1.5 - (sensitivity_score / 100.0)) * diffstd_mean)
+
+    # The diffstd_score is the percentage difference between the distance and the sensitivity threshold.
+    diffstd_score = (diffstd_distance - diffstd_sensitivity_threshold) / diffstd_sensitivity_threshold
+
+    # SAX also doesn't have a hard cutoff point so we will use a rule of thumb here as well.
+    # Some divergence is noticeable at approximately 2.5 and major divergence is notable at about 3-4.
+    # If we multiply by 15, we can calculate the percentage of this score versus (100 - sensitivity_score).
+    # This will not necessarily put us on the same scale as DIFFSTD but will ensure that for higher sensitivity
+    # scores, 1.5 will trigger with a SAX score > 0, indicating at least a small outlier.
+    # Also, cap the threshold at a floor value of 25.0 to prevent absurd results.
+    sax_sensitivity_threshold = max(100.0 - sensitivity_score, 25.0)
+    sax_score = ((tests["sax_distance"] * 15.0) - sax_sensitivity_threshold) / sax_sensitivity_threshold
+
+    # Our anomaly score is the sum of diffstd_score and sax_score.  Because DIFFSTD and SAX
+    # split data different ways, this helps us at the margin with determining *which* data points in the series
+    # are the biggest outliers, as the intersection of high SAX + high DIFFSTD will be the most likely culprits.
+    anomaly_score = sax_score + diffstd_score
+
+    for i in range(num_series):
         diagnostics["Series " + str(i)] = {
-            "Mean DIFFSTD distance": diffstd_mean,
-            "DIFFSTD sensitivity threshold": diffstd_sensitivity_threshold,
+            "Mean DIFFSTD distance": diffstd_mean[i, 0],
+            "DIFFSTD sensitivity threshold": diffstd_sensitivity_threshold[i, 0],
             "SAX sensitivity threshold": sax_sensitivity_threshold
         }
 
-    return (pd.concat(series), diagnostics)
+    scores = {
+        "diffstd_score": diffstd_score,
+        "sax_score": sax_score,
+        "anomaly_score": anomaly_score
+    }
+    return (scores, diagnostics)
 
 def determine_outliers(
-    df,
-    max_fraction_anomalies
+    anomaly_score,
+    max_fraction_anomalies,
+    point_counts=None
 ):
-    series = [y for x, y in df.groupby("series_key", as_index=False)]
-
+    # anomaly_score is a (series x time) array, so each row is a series.
     # Get the 100-Nth percentile of anomaly score.
     # Ex:  if max_fraction_anomalies = 0.1, get the
     # 90th percentile anomaly score.
-    max_fraction_anomaly_scores = [np.quantile(s['anomaly_score'], 1.0 - max_fraction_anomalies) for s in series]
-    diagnostics = {"Max fraction anomaly scores":  max_fraction_anomaly_scores }
+    if point_counts is None:
+        max_fraction_anomaly_scores = np.quantile(anomaly_score, 1.0 - max_fraction_anomalies, axis=1)
+    else:
+        max_fraction_anomaly_scores = calculate_weighted_quantile(anomaly_score, point_counts, 1.0 - max_fraction_anomalies)
+    diagnostics = {"Max fraction anomaly scores":  max_fraction_anomaly_scores.tolist() }
 
     # When scoring outliers, we made 0.01 the sensitivity threshold, as 0 means no differences.
     # If the max fraction anomaly score is greater than 0, it means that we have MORE outliers
     # than our max_fraction_anomalies supports, and therefore we
     # need to cut it off before we get down to our sensitivity score.
     # Otherwise, sensitivity score stays the same and we operate as normal.
-    sensitivity_thresholds = [max(0.01, mfa) for mfa in max_fraction_anomaly_scores]
-    diagnostics["Sensitivity scores"] = sensitivity_thresholds
+    sensitivity_thresholds = np.maximum(0.01, max_fraction_anomaly_scores)
+    diagnostics["Sensitivity scores"] = sensitivity_thresholds.tolist()
 
     # We treat segments as outliers, not individual data points.  Mark each segment with a sufficiently large
     # anomaly score as an outlier for subsequent review.
-    for i in range(len(series)):
-        series[i]['is_anomaly'] = [score >= sensitivity_thresholds[i] for score in series[i]['anomaly_score']]
-
-    return (pd.concat(series), diagnostics)
+    return (anomaly_score >= sensitivity_thresholds[:, np.newaxis], diagnostics)
+
+def calculate_weighted_quantile(anomaly_score, point_counts, q):
+    # The same as np.quantile(np.repeat(anomaly_score, point_counts, axis=1), q, axis=1), without
+    # building the repeated array.  With linear interpolation, the quantile sits between the points
+    # at positions floor(q*(n-1)) and ceil(q*(n-1)) of each sorted row.
+    # point_counts may be one count per column or one per cell, such as a mask of which points exist.
+    point_counts = np.broadcast_to(point_counts, anomaly_score.shape).astype(int)
+    position = q * (point_counts.sum(axis=1, keepdims=True) - 1)
+    (lower, upper) = (np.floor(position), np.ceil(position))
+    order = np.argsort(anomaly_score, axis=1)
+    sorted_scores = np.take_along_axis(anomaly_score, order, axis=1)
+    cumulative_counts = np.cumsum(np.take_along_axis(point_counts, order, axis=1), axis=1)
+    last = anomaly_score.shape[1] - 1
+    lower_scores = np.take_along_axis(sorted_scores, np.minimum((cumulative_counts <= lower).sum(axis=1, keepdims=True), last), axis=1)
+    upper_scores = np.take_along_axis(sorted_scores, np.minimum((cumulative_counts <= upper).sum(axis=1, keepdims=True), last), axis=1)
+    return (lower_scores + (position - lower) * (upper_scores - lower_scores))[:, 0]
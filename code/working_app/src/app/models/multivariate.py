@@ -4,19 +4,19 @@
 
 import pandas as pd
 import numpy as np
-from pandas.core import base
 from pyod.models.cof import COF
 from pyod.models.loci import LOCI
 from pyod.models.copod import COPOD
-from pyod.models.combination import aom, moa, average, median, maximization, majority_vote
-from pyod.utils.data import evaluate_print
+from pyod.models.combination import median, majority_vote
 from sklearn.preprocessing import OrdinalEncoder
+from . import planner, sweep, timing
 
 def detect_multivariate_statistical(
     df,
     sensitivity_score,
     max_fraction_anomalies,
-    n_neighbors
+    n_neighbors,
+    latency_budget_ms=None
 ):
     # Unlike univariate ensembling, we don't weight any of
     # our multivariate ensemble specially.  We do need a
@@ -24,10 +24,7 @@ def detect_multivariate_statistical(
     # COF has a minimum threshold of 1.35 (estimated by us).
     # LOCI has a threshold of 3.0 (estimated by paper authors).
     weights = { "cof": 1.0, "loci": 1.0, "copod": 1.0 }
-    # For COPOD, we get 2.3 from -ln(0.10).  This is a little low but because
-    # we're adding the median COPOD value in the calculation, this puts us
-    # well above the expected median.
-    sensitivity_factors = { "cof": 1.35, "loci": 3.0, "copod":2.3 }
+    sensitivity_factors = get_sensitivity_factors()
 
     num_data_points = df['vals'].count()
     if (num_data_points < 15):
@@ -47,16 +44,63 @@ def detect_multivariate_statistical(
         # where we look at an incomplete range.
         if num_data_points < 16:
             n_neighbors = min(n_neighbors, 5)
-        (df_encoded, diagnostics) = encode_string_data(df)
-        (df_tested, tests_run, diagnostics) = run_tests(df_encoded, max_fraction_anomalies, n_neighbors)
-        (df_out, diag_outliers) = determine_outliers(df_tested, tests_run, sensitivity_factors, sensitivity_score, max_fraction_anomalies)
+        with timing.stage("encode_string_data"):
+            (df_encoded, diagnostics) = encode_string_data(df)
+        plan = planner.plan_multivariate(num_data_points, n_neighbors, latency_budget_ms)
+        with timing.stage("run_tests"):
+            (df_tested, tests_run, diagnostics) = run_tests(df_encoded, max_fraction_anomalies, n_neighbors, plan)
+        with timing.stage("determine_outliers"):
+            (is_anomaly, diag_outliers) = determine_outliers(df_tested['anomaly_score'].to_numpy(), df_tested['anomaly_score_copod'].to_numpy(),
+                tests_run, sensitivity_factors, sensitivity_score, max_fraction_anomalies)
+            df_out = df_tested.assign(is_anomaly=is_anomaly)
         return (df_out, weights, { "message": "Result of multivariate statistical tests.", "Tests run": tests_run, "Test diagnostics": diagnostics, "Outlier determination": diag_outliers})
 
+def detect_multivariate_statistical_sweep(
+    df,
+    sensitivity_scores,
+    max_fraction_anomalies,
+    n_neighbors,
+    latency_budget_ms=None
+):
+    # Run the tests once, then threshold the same anomaly scores with each combination of settings.
+    # COF's raw labels (is_raw_anomaly_cof) use the first max fraction of anomalies; the anomaly score does not.
+    combinations = sweep.get_combinations(sensitivity_scores, max_fraction_anomalies)
+    message = sweep.check_combinations(combinations)
+    if message is not None:
+        return sweep.invalid(df, {}, message)
+    (df_out, weights, details) = detect_multivariate_statistical(df, *combinations[0], n_neighbors, latency_budget_ms)
+    if isinstance(details, str):
+        return sweep.invalid(df, weights, details)
+    # As in detect_multivariate_statistical, the max fraction of anomalies tops out at 0.5.
+    anomaly_score = df_out['anomaly_score'].to_numpy()
+    anomaly_score_copod = df_out['anomaly_score_copod'].to_numpy()
+    thresholds = [sweep.get_threshold(s, m, determine_outliers(anomaly_score, anomaly_score_copod, details["Tests run"], get_sensitivity_factors(), s, min(m, 0.5))[0])
+        for (s, m) in combinations]
+    # Outlier determination differs for each combination, so leave out the first one's.
+    del details["Outlier determination"]
+    return (df_out.drop(columns='is_anomaly'), weights, details, thresholds)
+
+def get_sensitivity_factors():
+    # For COPOD, we get 2.3 from -ln(0.10).  This is a little low but because
+    # we're adding the median COPOD value in the calculation, this puts us
+    # well above the expected median.
+    return { "cof": 1.35, "loci": 3.0, "copod":2.3 }
+
 def encode_string_data(df):
     # df comes in with two columns:  key and vals.
     # We want to break out the list in vals and turn it into a set of columns.
     # Column names don't matter here.
-    df2 = pd.DataFrame([pd.Series(x) for x in df.vals])
+    # When every row is a list of numbers of the same length, we can build all columns in one step.
+    # Otherwise, fall back to one Series per row, which pads short rows and handles strings.
+    try:
+        vals = np.array(df['vals'].tolist())
+    except ValueError:
+        # Rows have different lengths.
+        vals = None
+    if (vals is not None and vals.ndim == 2 and vals.dtype.kind in "iuf"):
+        df2 = pd.DataFrame(vals)
+    else:
+        df2 = pd.DataFrame([pd.Series(x) for x in df.vals])
     string_cols = df2.select_dtypes(include=[object]).columns.values
     diagnostics = { "Number of string columns in input": len(string_cols) }
     if (len(string_cols) > 0):
@@ -80,12 +124,12 @@ def encode_string_data(df):
 
     return (pd.concat([df, df2], axis=1), diagnostics)
 
-def run_tests(df, max_fraction_anomalies, n_neighbors):
+def run_tests(df, max_fraction_anomalies, n_neighbors, plan=None):
     num_records = df['key'].shape[0]
-    if (num_records > 1000):
-        run_loci = 0
-    else:
-        run_loci = 1
+    # plan comes from the latency-budget planner.  Without one, LOCI runs on up to 1000 records.
+    if plan is None:
+        plan = planner.plan_multivariate(num_records, n_neighbors)
+    run_loci = plan["loci"]
 
     tests_run = {
         "cof": 1,
@@ -95,22 +139,22 @@ def run_tests(df, max_fraction_anomalies, n_neighbors):
     diagnostics = {
         "Number of records": num_records
     }
+    if plan["latency_budget_ms"] is not None:
+        diagnostics["Plan"] = plan
     # Remove key and vals, leaving the split-out and encoded versions of values.
     # Bring them back in as an array, as that's what our tests will require.
     col_array = df.drop(["key", "vals"], axis=1).to_numpy()
 
     # Determine numbers of neighbors
-    # Ensure we have n_neighbors at least 5 below the number of records.
-    # Ensure we have a boundary on number of tests.  100 above n_neighbors is a bit arbitrary
-    # if we have extremely large datasets but should be fine for 1k-10k.
-    n_neighbor_range = range(n_neighbors, min(num_records - 5, n_neighbors + 100), 5)
+    n_neighbor_range = plan["cof_n_neighbors"]
     n_neighbor_range_len = len(n_neighbor_range)
 
     # COF
     labels_cof = np.zeros([num_records, n_neighbor_range_len])
     scores_cof = np.zeros([num_records, n_neighbor_range_len])
     for idx,n in enumerate(n_neighbor_range):
-        (labels_cof[:, idx], scores_cof[:, idx], diag_idx) = check_cof(col_array, max_fraction_anomalies=max_fraction_anomalies, n_neighbors=n)
+        with timing.stage("cof"):
+            (labels_cof[:, idx], scores_cof[:, idx], diag_idx) = check_cof(col_array, max_fraction_anomalies=max_fraction_anomalies, n_neighbors=n)
         k = "Neighbors_" + str(n)
         diagnostics[k] = diag_idx
 
@@ -121,14 +165,16 @@ def run_tests(df, max_fraction_anomalies, n_neighbors):
 
     # LOCI
     if (run_loci == 1):
-        (labels_loci, scores_loci, diag_loci) = check_loci(col_array)
+        with timing.stage("loci"):
+            (labels_loci, scores_loci, diag_loci) = check_loci(col_array)
         df["is_raw_anomaly_loci"] = labels_loci
         anomaly_score = anomaly_score + scores_loci
         diagnostics["LOCI"] = diag_loci
         df["anomaly_score_loci"] = scores_loci
 
     # COPOD
-    (labels_copod, scores_copod, diag_copod) = check_copod(col_array)
+    with timing.stage("copod"):
+        (labels_copod, scores_copod, diag_copod) = check_copod(col_array)
     df["is_raw_anomaly_copod"] = labels_copod
     diagnostics["COPOD"] = diag_copod
     df["anomaly_score_copod"] = scores_copod
@@ -165,30 +211,33 @@ def check_copod(col_array):
     return (clf.labels_, clf.decision_scores_, diagnostics)
 
 def determine_outliers(
-    df,
+    anomaly_score,
+    anomaly_score_copod,
     tests_run,
     sensitivity_factors,
     sensitivity_score,
     max_fraction_anomalies
 ):
+    # The scores are arrays, one entry per row, and we return whether each row is an outlier.
+    # Like pandas, the median and second-largest score skip any missing scores.
     # Need to multiply this because we don't know up-front if we ran, e.g., LOCI.
     tested_sensitivity_factors = {sf: sensitivity_factors.get(sf, 0) * tests_run.get(sf, 0) for sf in set(sensitivity_factors).union(tests_run)}
     # COPOD typically has a fairly consistent spread but the median point may be quite different,
     # so we will start from the median and add our sensitivity factor to it.
-    median_copod = df["anomaly_score_copod"].median()
+    median_copod = np.nanmedian(anomaly_score_copod)
     sensitivity_threshold = sum([tested_sensitivity_factors[w] for w in tested_sensitivity_factors]) + median_copod
     diagnostics = { "Sensitivity threshold": sensitivity_threshold, "COPOD Median": median_copod }
     # Convert sensitivity score to be approximately the same
     # scale as anomaly score.  Note that sensitivity score is "reversed",
     # such that 100 is the *most* sensitive.
     # Multiply this by the second-largest anomaly score to scale appropriately.
-    second_largest = df['anomaly_score'].nlargest(2).iloc[1]
+    second_largest = np.sort(anomaly_score[~np.isnan(anomaly_score)])[-2]
     sensitivity_score = (100 - sensitivity_score) * second_largest / 100.0
     diagnostics["Raw sensitivity score"] = sensitivity_score
     # Get the 100-Nth percentile of anomaly score.
     # Ex:  if max_fraction_anomalies = 0.1, get the
     # 90th percentile anomaly score.
-    max_fraction_anomaly_score = np.quantile(df['anomaly_score'], 1.0 - max_fraction_anomalies)
+    max_fraction_anomaly_score = np.quantile(anomaly_score, 1.0 - max_fraction_anomalies)
     diagnostics["Max fraction anomaly score"] = max_fraction_anomaly_score
     # If the max fraction anomaly score is greater than
     # the sensitivity score, it means that we have MORE outliers
@@ -198,4 +247,4 @@ def determine_outliers(
     if max_fraction_anomaly_score > sensitivity_score and max_fraction_anomalies < 1.0:
         sensitivity_score = max_fraction_anomaly_score
     diagnostics["Sensitivity score"] = sensitivity_score
-    return (df.assign(is_anomaly=df['anomaly_score'] > np.max([sensitivity_score, sensitivity_threshold])), diagnostics)
+    return (anomaly_score > np.max([sensitivity_score, sensitivity_threshold]), diagnostics)
@@ -0,0 +1,126 @@
+# Finding Ghosts in Your Data
+# Latency-budget planning
+# Each detector decides which tests to run from the size of its input alone:  LOCI up to 1000 rows,
+# Gaussian mixtures from 15 rows, a COF sweep of up to 20 neighbor counts, and 17 penalties for each of
+# three kernels.  When a caller gives us a latency budget, we estimate what each test would cost and pick
+# the most complete set of tests which fits, giving up the most expensive work first.  Tests we leave out
+# get no weight, the same as tests which the size rules skip.
+
+import math
+
+# Rough costs, measured on one core.  They only need to be right to within a small factor.
+UNIVARIATE_SECONDS = 1e-2
+UNIVARIATE_SECONDS_PER_ROW = 2e-5
+GAUSSIAN_MIXTURE_FIT_SECONDS = 4e-3
+GAUSSIAN_MIXTURE_SECONDS_PER_ROW_COMPONENT = 1e-6
+GAUSSIAN_MIXTURE_CHECK_SECONDS = 3e-2
+GAUSSIAN_MIXTURE_CHECK_SECONDS_PER_ROW = 3e-4
+COF_SECONDS_PER_PAIR = 1.4e-7
+COF_SECONDS_PER_ROW_NEIGHBOR = 7.5e-6
+COPOD_SECONDS_PER_ROW = 1e-5
+# LOCI measured with three columns at 100 to 400 rows, where it took 0.9 to 61 seconds.
+LOCI_SECONDS_PER_ROW = 1e-3
+LOCI_SECONDS_PER_TRIPLE = 9e-7
+KERNEL_CPD_SECONDS_PER_PAIR = 7e-9
+MULTI_RESOLUTION_SECONDS_PER_ROW = 1e-6
+
+# The full grid single time series detection searches when there is no budget.
+KERNELS = { "linear", "rbf", "cosine" }
+PENALTIES = { 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 20, 50, 80, 100, 200, 500, 800, 1000 }
+
+# Never plan fewer than this many penalties, or the sensitivity score has too little to work with.
+MIN_PENALTIES = 3
+# Kernels in the order we keep them, cheapest first.
+KERNEL_ORDER = ["linear", "cosine", "rbf"]
+
+def get_plan(tests, estimated_seconds, latency_budget_ms):
+    # Record counts often arrive as NumPy integers; keep the plan in plain Python types for serialization.
+    estimated_seconds = float(estimated_seconds)
+    plan = dict(tests)
+    plan["estimated_ms"] = round(estimated_seconds * 1000.0, 1)
+    plan["latency_budget_ms"] = latency_budget_ms
+    # Even the smallest plan may not fit; we run it anyway and say so.
+    plan["within_budget"] = bool(fits(estimated_seconds, latency_budget_ms))
+    return plan
+
+def fits(estimated_seconds, latency_budget_ms):
+    return latency_budget_ms is None or estimated_seconds * 1000.0 <= latency_budget_ms
+
+def estimate_univariate(num_records, gaussian_mixture_max_clusters):
+    # Fitting a mixture with c components is linear in c, and we try each count from 1 up to (but not
+    # including) the maximum.  If more than one cluster wins, checking each cluster costs the most.
+    seconds = UNIVARIATE_SECONDS + UNIVARIATE_SECONDS_PER_ROW * num_records
+    if num_records >= 15 and gaussian_mixture_max_clusters > 1:
+        seconds += sum(GAUSSIAN_MIXTURE_FIT_SECONDS + GAUSSIAN_MIXTURE_SECONDS_PER_ROW_COMPONENT * num_records * c
+            for c in range(1, gaussian_mixture_max_clusters))
+        seconds += GAUSSIAN_MIXTURE_CHECK_SECONDS + GAUSSIAN_MIXTURE_CHECK_SECONDS_PER_ROW * num_records
+    return seconds
+
+def plan_univariate(num_records, latency_budget_ms=None):
+    # The only test worth trimming is the Gaussian mixture:  first try fewer cluster counts, then skip it.
+    # At least three candidates (1 and 2 clusters) are needed for the test to find more than one cluster.
+    max_clusters = math.floor(min(num_records / 5.0, 9))
+    while max_clusters > 3 and not fits(estimate_univariate(num_records, max_clusters), latency_budget_ms):
+        max_clusters -= 1
+    if not fits(estimate_univariate(num_records, max_clusters), latency_budget_ms):
+        max_clusters = 0
+    tests = { "gaussian_mixture": 1 if num_records >= 15 and max_clusters > 2 else 0, "gaussian_mixture_max_clusters": max_clusters }
+    return get_plan(tests, estimate_univariate(num_records, max_clusters), latency_budget_ms)
+
+def get_n_neighbor_range(num_records, n_neighbors, num_cof_runs=20):
+    # Ensure we have n_neighbors at least 5 below the number of records.
+    # Ensure we have a boundary on number of tests.  100 above n_neighbors is a bit arbitrary
+    # if we have extremely large datasets but should be fine for 1k-10k.
+    return range(n_neighbors, min(num_records - 5, n_neighbors + 5 * num_cof_runs), 5)
+
+def estimate_multivariate(num_records, n_neighbor_range, run_loci):
+    # Each COF run computes all pairwise distances, then works through each point's neighbors.
+    seconds = sum(COF_SECONDS_PER_PAIR * num_records**2 + COF_SECONDS_PER_ROW_NEIGHBOR * num_records * n for n in n_neighbor_range)
+    seconds += COPOD_SECONDS_PER_ROW * num_records
+    if run_loci:
+        seconds += LOCI_SECONDS_PER_ROW * num_records + LOCI_SECONDS_PER_TRIPLE * num_records**3
+    return seconds
+
+def plan_multivariate(num_records, n_neighbors, latency_budget_ms=None):
+    # LOCI is cubic, so it goes first.  Then narrow the COF sweep, dropping the largest (and slowest)
+    # neighbor counts, down to a single one.  COPOD is nearly free and always runs.
+    num_cof_runs = len(get_n_neighbor_range(num_records, n_neighbors))
+    run_loci = num_records <= 1000
+    if run_loci and not fits(estimate_multivariate(num_records, get_n_neighbor_range(num_records, n_neighbors, 1), run_loci), latency_budget_ms):
+        run_loci = False
+    while num_cof_runs > 1 and not fits(estimate_multivariate(num_records, get_n_neighbor_range(num_records, n_neighbors, num_cof_runs), run_loci), latency_budget_ms):
+        num_cof_runs -= 1
+    n_neighbor_range = get_n_neighbor_range(num_records, n_neighbors, num_cof_runs)
+    tests = { "cof": 1, "loci": 1 if run_loci else 0, "copod": 1, "cof_n_neighbors": list(n_neighbor_range) }
+    return get_plan(tests, estimate_multivariate(num_records, n_neighbor_range, run_loci), latency_budget_ms)
+
+def estimate_single_timeseries(num_records, num_kernels, num_penalties, multi_resolution):
+    # Each penalty is a separate KernelCPD search, quadratic in the length of the series at full resolution.
+    num_iterations = num_kernels * num_penalties
+    if multi_resolution and num_records >= 1000:
+        return MULTI_RESOLUTION_SECONDS_PER_ROW * num_iterations * num_records
+    return KERNEL_CPD_SECONDS_PER_PAIR * num_iterations * num_records**2
+
+def thin(values, n):
+    # Keep n values spread evenly from the smallest to the largest.
+    if n >= len(values):
+        return values
+    return [values[round(i * (len(values) - 1) / (n - 1))] for i in range(n)]
+
+def plan_single_timeseries(num_records, kernels, penalties, multi_resolution=False, latency_budget_ms=None):
+    # Switching to multi-resolution search keeps every kernel and penalty, so try that first.  After that,
+    # thin out the penalties while keeping their full range, and finally drop kernels, keeping the cheapest.
+    all_penalties = sorted(penalties)
+    kernels = sorted(kernels, key=lambda k: KERNEL_ORDER.index(k) if k in KERNEL_ORDER else len(KERNEL_ORDER))
+    num_penalties = len(all_penalties)
+    def estimate():
+        return estimate_single_timeseries(num_records, len(kernels), num_penalties, multi_resolution)
+    if not fits(estimate(), latency_budget_ms) and num_records >= 1000:
+        multi_resolution = True
+    while num_penalties > MIN_PENALTIES and not fits(estimate(), latency_budget_ms):
+        num_penalties -= 1
+    while len(kernels) > 1 and not fits(estimate(), latency_budget_ms):
+        kernels = kernels[:-1]
+    tests = { "changepoint": 1, "kernels": set(kernels), "penalties": set(thin(all_penalties, num_penalties)),
+        "multi_resolution": multi_resolution }
+    return get_plan(tests, estimate(), latency_budget_ms)
@@ -0,0 +1,100 @@
+# Finding Ghosts in Your Data
+# Shared process pool for running independent detections in parallel.
+
+import os
+import importlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from threadpoolctl import threadpool_limits
+
+# numpy, scipy, and scikit-learn each start a BLAS thread pool sized to the whole machine.
+# With one of those per worker process, we would oversubscribe every core many times over,
+# so each worker gets a small number of BLAS threads and we size the pool to match.
+BLAS_THREADS_PER_WORKER = int(os.environ.get("DETECTOR_BLAS_THREADS", 1))
+
+# Detector modules take seconds to import, and the API imports each one on its first call.  Set
+# DETECTOR_WARMUP to "all" or a comma-separated list (such as "univariate,single_timeseries") to import
+# them at startup instead, in the server and in each worker, so that no caller waits for it.
+DETECTOR_MODULES = ["univariate", "multivariate", "single_timeseries", "multi_timeseries",
+    "sliding_multi_timeseries", "streaming_timeseries", "time_buckets"]
+
+_executor = None
+_executor_lock = threading.Lock()
+# Set in worker processes so that nested calls run inline instead of starting another pool.
+_in_worker = False
+
+def get_num_workers():
+    if "DETECTOR_WORKERS" in os.environ:
+        return max(1, int(os.environ["DETECTOR_WORKERS"]))
+    # Count the cores this process may run on, not every core on the machine.
+    try:
+        num_cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        num_cores = os.cpu_count() or 1
+    return max(1, num_cores // BLAS_THREADS_PER_WORKER)
+
+def get_warmup_modules():
+    setting = os.environ.get("DETECTOR_WARMUP", "").strip()
+    if setting.lower() == "all":
+        return list(DETECTOR_MODULES)
+    names = [name.strip() for name in setting.split(",") if name.strip()]
+    unknown = [name for name in names if name not in DETECTOR_MODULES]
+    if unknown:
+        raise ValueError(f"DETECTOR_WARMUP names unknown detector modules: {', '.join(unknown)}")
+    return names
+
+def import_modules(names):
+    for name in names:
+        importlib.import_module("." + name, __package__)
+
+def initialize_worker(warmup_modules=()):
+    global _in_worker
+    _in_worker = True
+    threadpool_limits(limits=BLAS_THREADS_PER_WORKER)
+    import_modules(warmup_modules)
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Forking a process that has already started BLAS or OpenMP threads can deadlock the child,
+            # so start workers from a clean server process instead.  For the same reason, each worker
+            # imports its own detector modules rather than inheriting them from the fork server.
+            _executor = ProcessPoolExecutor(max_workers=get_num_workers(), initializer=initialize_worker,
+                initargs=(get_warmup_modules(),), mp_context=multiprocessing.get_context("forkserver"))
+        return _executor
+
+def get_pid(_):
+    return os.getpid()
+
+def warm_up():
+    # Import the modules named in DETECTOR_WARMUP here, then start every worker, each of which imports
+    # them too, and wait for all of it.  The pool starts a new worker for each task it gets while none
+    # are idle, so one small task per worker starts them all.
+    names = get_warmup_modules()
+    if not names:
+        return []
+    import_modules(names)
+    list(get_executor().map(get_pid, range(get_num_workers())))
+    return names
+
+def reset_executor():
+    # A worker that dies (for example, killed for running out of memory) breaks the whole pool,
+    # so drop it and let the next call start a new one.
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+def map_in_pool(f, items):
+    # Starting up a pool costs more than it saves for a single item, and a worker
+    # should never start a pool of its own.
+    num_workers = get_num_workers()
+    if len(items) < 2 or num_workers < 2 or _in_worker:
+        return [f(item) for item in items]
+    # Hand out work in chunks to cut down on inter-process overhead, while still
+    # leaving enough chunks to balance series of different lengths across workers.
+    chunksize = max(1, len(items) // (4 * num_workers))
+    return list(get_executor().map(f, items, chunksize=chunksize))
@@ -4,13 +4,25 @@
 
 import pandas as pd
 import numpy as np
-from pandas.core import base
 import ruptures as rpt
+import math
+from functools import partial
+from . import planner, pool, sweep, timing
+
+# Not knowing the shape of the data, we will try each of the three kernels.
+# We will also try a variety of penalty values across 7 orders of magnitude.
+# The combination of results will allow us to develop a sensitivity score.
+# With a latency budget, the planner may use fewer of each.  The planner keeps the full grids, so that
+# admission control can plan a call without importing this module.
+KERNELS = planner.KERNELS
+PENALTIES = planner.PENALTIES
 
 def detect_single_timeseries(
     df,
     sensitivity_score,
-    max_fraction_anomalies
+    max_fraction_anomalies,
+    multi_resolution=False,
+    latency_budget_ms=None
 ):
     # Weights is here as a future-proofing measure.
     weights = { "time_series": 1.0 }
@@ -26,11 +38,56 @@ def detect_single_timeseries(
     elif (sensitivity_score <= 0 or sensitivity_score > 100 ):
         return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a valid sensitivity score, 0 < x <= 100.")
     else:
-        (df_tested, tests_run, diagnostics) = run_tests(df)
-        (df_out, diag_outliers) = determine_outliers(df_tested, tests_run, diagnostics["num_iterations"], sensitivity_score, max_fraction_anomalies)
+        plan = planner.plan_single_timeseries(num_data_points, KERNELS, PENALTIES, multi_resolution, latency_budget_ms)
+        with timing.stage("run_tests"):
+            if (plan["multi_resolution"]):
+                (df_tested, tests_run, diagnostics) = run_tests_multiresolution(df, plan["kernels"], plan["penalties"])
+            else:
+                (df_tested, tests_run, diagnostics) = run_tests(df, plan["kernels"], plan["penalties"])
+        if latency_budget_ms is not None:
+            diagnostics["Plan"] = plan
+        with timing.stage("determine_outliers"):
+            (is_anomaly, diag_outliers) = determine_outliers(df_tested['anomaly_score'].to_numpy(), diagnostics["num_iterations"], sensitivity_score, max_fraction_anomalies)
+            df_out = df_tested.assign(is_anomaly=is_anomaly)
         return (df_out, weights, { "message": "Result of single time series statistical tests.", "Tests run": tests_run, "Test diagnostics": diagnostics, "Outlier determination": diag_outliers})
 
-def run_tests(df):
+def detect_single_timeseries_sweep(
+    df,
+    sensitivity_scores,
+    max_fraction_anomalies,
+    multi_resolution=False,
+    latency_budget_ms=None
+):
+    # Run change point detection once, then threshold the same anomaly scores with each combination of settings.
+    combinations = sweep.get_combinations(sensitivity_scores, max_fraction_anomalies)
+    message = sweep.check_combinations(combinations)
+    if message is not None:
+        return sweep.invalid(df, {}, message)
+    (df_out, weights, details) = detect_single_timeseries(df, *combinations[0], multi_resolution=multi_resolution, latency_budget_ms=latency_budget_ms)
+    if isinstance(details, str):
+        return sweep.invalid(df, weights, details)
+    num_iterations = details["Test diagnostics"]["num_iterations"]
+    anomaly_score = df_out['anomaly_score'].to_numpy()
+    thresholds = [sweep.get_threshold(s, m, determine_outliers(anomaly_score, num_iterations, s, m)[0]) for (s, m) in combinations]
+    # Outlier determination differs for each combination, so leave out the first one's.
+    del details["Outlier determination"]
+    return (df_out.drop(columns='is_anomaly'), weights, details, thresholds)
+
+def detect_single_timeseries_batch(
+    series,
+    sensitivity_score,
+    max_fraction_anomalies,
+    multi_resolution=False
+):
+    # series is a dictionary of series ID to DataFrame.  Each series is independent,
+    # so we spread them out across worker processes and collect the results by ID.
+    series_ids = list(series.keys())
+    detect = partial(detect_single_timeseries, sensitivity_score=sensitivity_score,
+        max_fraction_anomalies=max_fraction_anomalies, multi_resolution=multi_resolution)
+    results = pool.map_in_pool(detect, [series[s] for s in series_ids])
+    return dict(zip(series_ids, results))
+
+def run_tests(df, kernels=KERNELS, penalties=PENALTIES):
     tests_run = {
         "changepoint": 1
     }
@@ -41,34 +98,109 @@ def run_tests(df):
     }
     signal = df['value'].to_numpy()
 
-    # Not knowing the shape of the data, we will try each of the three kernels.
-    # We will also try a variety of penalty values across 7 orders of magnitude.
-    # The combination of results will allow us to develop a sensitivity score.
-    kernels = { "linear", "rbf", "cosine" }
-    penalties = { 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 20, 50, 80, 100, 200, 500, 800, 1000 }
     diagnostics["kernels"] = kernels
     diagnostics["penalties"] = penalties
     diagnostics["num_iterations"] = len(kernels) * len(penalties)
 
     scores = np.zeros([num_records])
     for idx,k in enumerate(kernels):
-        algo = rpt.KernelCPD(kernel=k).fit(signal)
+        with timing.stage("kernel_cpd_fit"):
+            algo = rpt.KernelCPD(kernel=k).fit(signal)
         for idxp,p in enumerate(penalties):
             # Get the set of results and add them to the scores array
-            result = algo.predict(pen=p)
+            with timing.stage("kernel_cpd_predict"):
+                result = algo.predict(pen=p)
             for ix,r in enumerate(result[:-1]):
                 scores[r] += 1
 
     df["anomaly_score"] = scores
     return (df, tests_run, diagnostics)
 
+def run_tests_multiresolution(df, kernels=KERNELS, penalties=PENALTIES):
+    # KernelCPD is quadratic in the length of the series, so for long series we spend
+    # nearly all of our time on stretches nowhere near a change point.  Instead, we search
+    # a piecewise-aggregated version of the signal for candidate change points and then
+    # refine each candidate at full resolution in a small neighborhood around it.
+    num_records = df['key'].shape[0]
+    # With fewer records than this, the full-resolution search is already fast enough and
+    # the coarse signal would be too short to be meaningful.
+    if (num_records < 1000):
+        (df, tests_run, diagnostics) = run_tests(df, kernels, penalties)
+        diagnostics["Multi-resolution"] = f"Did not use multi-resolution search because we need at least 1000 records but only had {num_records}."
+        return (df, tests_run, diagnostics)
+
+    tests_run = {
+        "changepoint": 1
+    }
+    diagnostics = {
+        "Number of records": num_records
+    }
+    signal = df['value'].to_numpy()
+
+    diagnostics["kernels"] = kernels
+    diagnostics["penalties"] = penalties
+    diagnostics["num_iterations"] = len(kernels) * len(penalties)
+
+    # Use a block size of sqrt(n):  the coarse search then works on sqrt(n) points and each
+    # refinement works on a handful of blocks, so the total work stays close to linear in n.
+    block_size = math.ceil(math.sqrt(num_records))
+    with timing.stage("piecewise_aggregate"):
+        coarse_signal = generate_piecewise_aggregate(signal, block_size)
+    diagnostics["Multi-resolution"] = {
+        "Block size": block_size,
+        "Coarse signal length": coarse_signal.shape[0]
+    }
+
+    scores = np.zeros([num_records])
+    num_refinements = 0
+    for idx,k in enumerate(kernels):
+        with timing.stage("kernel_cpd_fit"):
+            algo = rpt.KernelCPD(kernel=k).fit(coarse_signal)
+        # The refined location of a coarse change point does not depend on the penalty,
+        # so we only need to refine each one once per kernel.
+        refined = {}
+        for idxp,p in enumerate(penalties):
+            # Each coarse point stands in for block_size points, so the cost of a segment
+            # is roughly 1/block_size of its full-resolution cost.  Scale the penalty down
+            # to keep the same trade-off between fit and number of change points.
+            with timing.stage("kernel_cpd_predict"):
+                result = algo.predict(pen=p / block_size)
+            for ix,r in enumerate(result[:-1]):
+                if r not in refined:
+                    with timing.stage("refine_changepoint"):
+                        refined[r] = refine_changepoint(signal, k, r * block_size, block_size)
+                    num_refinements += 1
+                scores[refined[r]] += 1
+
+    diagnostics["Multi-resolution"]["Number of refinements"] = num_refinements
+    df["anomaly_score"] = scores
+    return (df, tests_run, diagnostics)
+
+def generate_piecewise_aggregate(signal, block_size):
+    # Average each block of block_size points.  The final block may be short, so pad it
+    # with NaN and ignore the padding when taking the mean.
+    num_blocks = math.ceil(signal.shape[0] / block_size)
+    padded = np.full(num_blocks * block_size, np.nan)
+    padded[:signal.shape[0]] = signal
+    return np.nanmean(padded.reshape(num_blocks, block_size), axis=1)
+
+def refine_changepoint(signal, kernel, candidate, block_size):
+    # Search for the single best change point within two blocks on either side of the
+    # coarse candidate.  This covers the case in which the true change point fell anywhere
+    # inside the block before or after the coarse boundary.
+    lower = max(0, candidate - 2 * block_size)
+    upper = min(signal.shape[0], candidate + 2 * block_size)
+    window = signal[lower:upper]
+    result = rpt.KernelCPD(kernel=kernel).fit(window).predict(n_bkps=1)
+    return lower + result[0]
+
 def determine_outliers(
-    df,
-    tests_run,
+    anomaly_score,
     num_iterations,
     sensitivity_score,
     max_fraction_anomalies
 ):
+    # anomaly_score is an array, and we return whether each entry is an outlier.
     # To deal with lower-sensitivity iterations not always picking up valid changepoints, divide iterations by 1.5.
     # Then multiply by the inverse of sensitivity score to get our cutoff.
     sensitivity_threshold = (num_iterations / 1.5) * ((100.0 - sensitivity_score) / 100.0)
@@ -77,7 +209,7 @@ def determine_outliers(
     # Get the 100-Nth percentile of anomaly score.
     # Ex:  if max_fraction_anomalies = 0.1, get the
     # 90th percentile anomaly score.
-    max_fraction_anomaly_score = np.quantile(df['anomaly_score'], 1.0 - max_fraction_anomalies)
+    max_fraction_anomaly_score = np.quantile(anomaly_score, 1.0 - max_fraction_anomalies)
     diagnostics["Max fraction anomaly score"] = max_fraction_anomaly_score
     # If the max fraction anomaly score is greater than
     # the sensitivity score, it means that we have MORE outliers
@@ -87,4 +219,4 @@ def determine_outliers(
     if max_fraction_anomaly_score > sensitivity_threshold and max_fraction_anomalies < 1.0:
         sensitivity_threshold = max_fraction_anomaly_score
     diagnostics["Sensitivity score"] = sensitivity_threshold
-    return (df.assign(is_anomaly=df['anomaly_score'] > sensitivity_threshold), diagnostics)
+    return (anomaly_score > sensitivity_threshold, diagnostics)
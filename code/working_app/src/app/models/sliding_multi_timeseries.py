@@ -0,0 +1,264 @@
+# Finding Ghosts in Your Data
+# Sliding window multiple time series anomaly detection
+# This keeps the DIFFSTD and SAX approach from chapters 16-17 up to date as new points arrive,
+# so that callers only need to send the points since their last call.
+# Only part of the work is incremental.  DIFFSTD segments, PAA values, and chunk statistics are computed
+# once, when their points arrive.  SAX scales by the mean and standard deviation of the whole window,
+# which move with nearly every update, and outlier thresholds rank every piece of the window, so each
+# update still re-symbolizes every stored PAA value and re-scores every piece.  That work is vectorized
+# and runs on PAA letters and pieces rather than points, but it grows with window_size rather than with
+# the size of the update.
+
+import math
+import threading
+from collections import OrderedDict, deque
+import pandas as pd
+import numpy as np
+from scipy.stats import norm
+from . import multi_timeseries
+
+# DIFFSTD segments always hold 7 points here, rather than depending on the length of the series.
+# That way, a segment's DIFFSTD never changes once the segment has all of its points.
+SEGMENT_SIZE = 7
+ALPHABET_SIZE = 4
+WORD_SIZE = 4
+# Keep state for at most this many windows, dropping the least recently updated.
+MAX_WINDOWS = 1000
+
+_window_states = OrderedDict()
+_window_states_lock = threading.Lock()
+
+class WindowState:
+    def __init__(self, window_size):
+        self.lock = threading.Lock()
+        self.window_size = window_size
+        self.segment_split = multi_timeseries.get_sax_segment_split(window_size)
+        # Points join and age out of the window in chunks holding a whole number of DIFFSTD segments
+        # and SAX words, so segment and word boundaries stay put as the window slides.
+        self.chunk_size = math.lcm(SEGMENT_SIZE, WORD_SIZE * self.segment_split)
+        self.series_keys = None
+        self.last_dt = None
+        self.num_points_seen = 0
+        # Summaries of each completed chunk, oldest first.
+        self.chunks = deque()
+        # Points since the last chunk boundary, as (series x time) arrays.
+        self.tail_keys = None
+        self.tail_dt = None
+        self.tail_values = None
+        self.tail_summary = None
+
+    def start(self, series_keys):
+        num_series = len(series_keys)
+        self.series_keys = series_keys
+        self.tail_keys = np.empty((num_series, 0), dtype=object)
+        self.tail_dt = np.empty((num_series, 0), dtype='datetime64[ns]')
+        self.tail_values = np.empty((num_series, 0))
+        self.tail_summary = summarize_points(self.tail_values, self.segment_split)
+
+    def update(self, keys, dt, values):
+        # Returns every point in the segments which the new points touched, along with where that
+        # block of points starts in the window.
+        first_touched = (self.tail_values.shape[1] // SEGMENT_SIZE) * SEGMENT_SIZE
+        keys = np.hstack([self.tail_keys, keys])
+        dt = np.hstack([self.tail_dt, dt])
+        values = np.hstack([self.tail_values, values])
+        self.num_points_seen += values.shape[1] - self.tail_values.shape[1]
+        self.last_dt = dt[:, -1]
+
+        # Completed chunks never change again, so summarize them once.
+        num_chunks = values.shape[1] // self.chunk_size
+        for c in range(num_chunks):
+            self.chunks.append(summarize_points(values[:, c*self.chunk_size:(c+1)*self.chunk_size], self.segment_split))
+        tail_start = num_chunks * self.chunk_size
+        (self.tail_keys, self.tail_dt, self.tail_values) = (keys[:, tail_start:], dt[:, tail_start:], values[:, tail_start:])
+        self.tail_summary = summarize_points(self.tail_values, self.segment_split)
+
+        # Age out the oldest chunks, keeping at least window_size points.
+        while self.get_length() - self.chunk_size >= self.window_size:
+            self.chunks.popleft()
+
+        # Points from a very large update may already have aged out.
+        window_start = self.get_length() - values.shape[1]
+        first_touched = max(first_touched, -window_start)
+        return (keys[:, first_touched:], dt[:, first_touched:], values[:, first_touched:], window_start + first_touched)
+
+    def get_length(self):
+        return len(self.chunks) * self.chunk_size + self.tail_values.shape[1]
+
+    def get_summaries(self):
+        return list(self.chunks) + [self.tail_summary]
+
+def summarize_points(values, segment_split):
+    # DIFFSTD for each segment (the last one may be partial), the PAA of each complete SAX letter before
+    # any scaling, and the count, mean, and sum of squared deviations of all values so we can scale the
+    # PAA later.
+    (num_series, l) = values.shape
+    segment_starts = np.arange(0, l, SEGMENT_SIZE)
+    segment_sizes = np.minimum(SEGMENT_SIZE, l - segment_starts)
+    if l == 0:
+        segment_diffstd = np.empty((num_series, 0))
+    else:
+        segment_means = multi_timeseries.generate_segment_means(values)
+        (segment_numbers, segment_diffstd) = multi_timeseries.calculate_segment_diffstd(values, segment_means, segment_starts, segment_sizes)
+    mean = values.mean() if values.size > 0 else 0.0
+    num_letters = l // segment_split
+    paa = values[:, :num_letters*segment_split].reshape(num_series, num_letters, segment_split).mean(axis=2)
+    return {
+        "segment_diffstd": segment_diffstd,
+        "segment_sizes": segment_sizes,
+        "paa": paa,
+        "count": values.size,
+        "mean": mean,
+        "m2": ((values - mean)**2).sum()
+    }
+
+def get_window_state(window_id, window_size):
+    with _window_states_lock:
+        state = _window_states.get(window_id)
+        if state is None:
+            state = WindowState(window_size)
+            _window_states[window_id] = state
+            if len(_window_states) > MAX_WINDOWS:
+                _window_states.popitem(last=False)
+        else:
+            _window_states.move_to_end(window_id)
+        return state
+
+def reset_window(window_id):
+    with _window_states_lock:
+        return _window_states.pop(window_id, None) is not None
+
+def detect_multi_timeseries_window(
+    window_id,
+    df,
+    window_size,
+    sensitivity_score,
+    max_fraction_anomalies
+):
+    weights = { "DIFFSTD": 1.0, "SAX": 1.0 }
+
+    num_series = len(df["series_key"].unique())
+    series_lengths = df['series_key'].value_counts()
+    if (max_fraction_anomalies <= 0.0 or max_fraction_anomalies > 1.0):
+        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a valid max fraction of anomalies, 0 < x <= 1.0.")
+    elif (sensitivity_score <= 0 or sensitivity_score > 100 ):
+        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a valid sensitivity score, 0 < x <= 100.")
+    elif (window_size < 15):
+        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, f"Must have a window size of at least fifteen data points per time series.  You sent {window_size}.")
+    elif (df['value'].count() < 1):
+        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must send at least one data point to update the window.")
+    elif (num_series < 2):
+        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, f"Must have a minimum of at least two time series for anomaly detection.  You sent {num_series} series.")
+    elif (df[['series_key', 'dt']].duplicated().any()):
+        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Each time series may have at most one data point per dt.")
+
+    series_keys = pd.Categorical(df['series_key']).categories.tolist()
+    (row_order, values) = multi_timeseries.align_series(df)
+    # Only complete chunks are summarized, so every series needs a point at every dt in the update.
+    if (row_order < 0).any():
+        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, f"Every time series must have a data point at each dt in the update.  You sent between {series_lengths.min()} and {series_lengths.max()} points per series.")
+    keys = df['key'].to_numpy(dtype=object)[row_order]
+    dt = pd.to_datetime(df['dt'], utc=True).to_numpy(dtype='datetime64[ns]')[row_order]
+
+    state = get_window_state(window_id, window_size)
+    with state.lock:
+        if state.series_keys is None:
+            state.start(series_keys)
+        elif (state.window_size != window_size):
+            return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, f"This window has a window size of {state.window_size}.  Reset the window to change its size.  You sent {window_size}.")
+        elif (state.series_keys != series_keys):
+            return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, f"Every update must include the same time series as the window, {state.series_keys}.  You sent {series_keys}.")
+        elif (state.last_dt is not None and (dt[:, 0] <= state.last_dt).any()):
+            return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Every new data point must come after the data points already in the window.")
+        (keys, dt, values, output_start) = state.update(keys, dt, values)
+        summaries = state.get_summaries()
+        l = state.get_length()
+        num_points_seen = state.num_points_seen
+        chunk_size = state.chunk_size
+        segment_split = state.segment_split
+
+    df_out = pd.DataFrame({
+        "key": keys.ravel(),
+        "series_key": np.repeat(series_keys, keys.shape[1]),
+        "dt": pd.to_datetime(dt.ravel(), utc=True),
+        "value": values.ravel()
+    })
+    num_words = (l // segment_split) // WORD_SIZE
+    if (l < 15 or num_words < 1):
+        return (df_out.assign(is_anomaly=False, anomaly_score=0.0), weights, f"Must have a minimum of at least {max(15, WORD_SIZE * segment_split)} data points per time series for anomaly detection.  The window has {l} per series so far.")
+
+    (tests, tests_run, point_counts, diagnostics) = run_tests(summaries, l, segment_split)
+    (scores, diag_scored) = multi_timeseries.score_results(tests, tests_run, sensitivity_score, point_counts)
+    (is_anomaly, diag_outliers) = multi_timeseries.determine_outliers(scores["anomaly_score"], max_fraction_anomalies, point_counts)
+    diagnostics["Window size"] = window_size
+    diagnostics["Chunk size"] = chunk_size
+    diagnostics["Number of records seen"] = num_points_seen
+
+    # Each returned point takes the results of the piece it falls in.
+    positions = output_start + np.arange(keys.shape[1])
+    pieces = np.searchsorted(tests["piece_start"], positions, side='right') - 1
+    df_out = df_out.assign(
+        sax_distance=tests["sax_distance"][:, pieces].ravel(),
+        segment_number=np.tile(tests["segment_number"][pieces], keys.shape[0]),
+        diffstd_distance=tests["diffstd_distance"][:, pieces].ravel(),
+        diffstd_score=scores["diffstd_score"][:, pieces].ravel(),
+        sax_score=scores["sax_score"][:, pieces].ravel(),
+        anomaly_score=scores["anomaly_score"][:, pieces].ravel(),
+        is_anomaly=is_anomaly[:, pieces].ravel())
+    return (df_out, weights, { "message": "Result of sliding window multiple time series statistical tests.", "Tests run": tests_run, "Test diagnostics": diagnostics, "Outlier scoring": diag_scored, "Outlier determination": diag_outliers})
+
+def run_tests(summaries, l, segment_split):
+    tests_run = {
+        "DIFFSTD": 1,
+        "SAX": 1
+    }
+    segment_diffstd = np.hstack([s["segment_diffstd"] for s in summaries])
+    segment_sizes = np.concatenate([s["segment_sizes"] for s in summaries])
+    paa = np.hstack([s["paa"] for s in summaries])
+    num_series = segment_diffstd.shape[0]
+
+    # SAX scales by the mean and standard deviation of the whole window, which shift with every update.
+    # Scaling is linear, so we can scale the stored PAA values rather than every point.  Combining each
+    # chunk's mean and squared deviations, as sharded batch detection does, keeps the standard deviation
+    # the same as np.nanstd over the window even when the values are far from zero.
+    (count, mean, m2) = multi_timeseries.merge_moments([(s["count"], s["mean"], s["m2"]) for s in summaries])
+    std = (m2 / count)**0.5
+    if std == 0.0:
+        std = 1.0
+    breakpoints = norm.ppf([float(a) / ALPHABET_SIZE for a in range(1, ALPHABET_SIZE)])
+    sax_data = np.searchsorted(breakpoints, (paa - mean) / std, side='right')
+    num_words = paa.shape[1] // WORD_SIZE
+    word_ids = multi_timeseries.generate_word_ids(sax_data, num_words, WORD_SIZE, ALPHABET_SIZE)
+    word_counts = multi_timeseries.generate_word_counts(word_ids, ALPHABET_SIZE**WORD_SIZE)
+    word_distances = multi_timeseries.generate_word_distances(breakpoints, WORD_SIZE, l)
+    m = multi_timeseries.calculate_sax_matrix(word_ids, word_counts, word_distances, num_series)
+
+    # Every point between two DIFFSTD segment or SAX word boundaries has the same distances, so we work
+    # with these pieces rather than individual points.  As in the batch approach, any points past the
+    # final complete word use the final word.
+    word_length = WORD_SIZE * segment_split
+    segment_starts = np.concatenate([[0], np.cumsum(segment_sizes)[:-1]])
+    piece_start = np.union1d(segment_starts, np.arange(num_words) * word_length)
+    point_counts = np.diff(np.append(piece_start, l))
+    piece_segment = np.searchsorted(segment_starts, piece_start, side='right') - 1
+    piece_word = np.minimum(piece_start // word_length, num_words - 1)
+
+    diagnostics = {
+        "Number of time series": num_series,
+        "Time series length": l,
+        "Number of records": num_series * l,
+        "Number of segments per time series": segment_sizes.shape[0],
+        "SAX": {
+            "Segment size per letter": segment_split,
+            "Number of segments": paa.shape[1],
+            "Word size": WORD_SIZE,
+            "Number of words": num_words
+        }
+    }
+    tests = {
+        "piece_start": piece_start,
+        "segment_number": piece_segment,
+        "sax_distance": m[:, piece_word],
+        "diffstd_distance": segment_diffstd[:, piece_segment]
+    }
+    return (tests, tests_run, point_counts, diagnostics)
@@ -0,0 +1,178 @@
+# Finding Ghosts in Your Data
+# Streaming single time series anomaly detection
+# This extends the change point approach from chapters 13-14 to live data.
+
+import threading
+from collections import OrderedDict, deque
+import pandas as pd
+import numpy as np
+from scipy.special import gammaln, logsumexp
+from . import single_timeseries
+
+# Expect a change point roughly once every 250 observations.
+HAZARD = 1.0 / 250
+# Truncate the run-length distribution so that each update costs the same regardless
+# of how long we have been watching the series.
+MAX_RUN_LENGTH = 500
+# A change point at time t only becomes apparent after we see a few points past it,
+# so we revise scores for this many of the most recent points on each update.
+SCORE_LAG = 10
+# As with the batch detector, we need at least fifteen points before scoring means anything.
+MIN_POINTS = 15
+# Keep this many scored points per series for max_fraction_anomalies quantiles.
+HISTORY_SIZE = 1000
+# Keep state for at most this many series, dropping the least recently updated.
+MAX_SERIES = 10000
+
+_series_states = OrderedDict()
+_series_states_lock = threading.Lock()
+
+class SeriesState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Running mean and variance (Welford) across everything we have seen.
+        # We use these as the prior for each new run.
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        # Log posterior of the run length, plus Normal-Gamma sufficient statistics for each run length.
+        self.log_r = np.zeros(0)
+        self.mu = np.zeros(0)
+        self.kappa = np.zeros(0)
+        self.alpha = np.zeros(0)
+        self.beta = np.zeros(0)
+        # Recent points, each a dict with key, dt, value, and anomaly_score.
+        self.history = deque(maxlen=HISTORY_SIZE)
+        # The latest dt we have seen, in UTC.  BOCPD treats every point as coming after the ones before it.
+        self.last_dt = None
+
+    def prior(self):
+        if self.n > 1 and self.m2 > 0:
+            variance = self.m2 / (self.n - 1)
+        else:
+            variance = max(abs(self.mean), 1.0)
+        return (self.mean, 1.0, 1.0, variance)
+
+    def update(self, key, dt, value):
+        self.history.append({ "key": key, "dt": dt, "value": value, "anomaly_score": 0.0 })
+        if self.n == 0:
+            self.update_running_stats(value)
+            (mu0, kappa0, alpha0, beta0) = self.prior()
+            self.log_r = np.zeros(1)
+            self.mu = np.array([mu0])
+            self.kappa = np.array([kappa0])
+            self.alpha = np.array([alpha0])
+            self.beta = np.array([beta0])
+            return
+
+        # Predictive probability of the new value under each current run length.
+        log_pred = student_t_logpdf(value, self.mu, self.kappa, self.alpha, self.beta)
+        log_joint = self.log_r + log_pred
+        log_growth = log_joint + np.log(1.0 - HAZARD)
+        log_changepoint = logsumexp(log_joint) + np.log(HAZARD)
+
+        self.update_running_stats(value)
+        (mu0, kappa0, alpha0, beta0) = self.prior()
+        # Runs grow by one, picking up the new value.
+        mu = (self.kappa * self.mu + value) / (self.kappa + 1)
+        beta = self.beta + (self.kappa * (value - self.mu)**2) / (2 * (self.kappa + 1))
+        self.log_r = np.append(log_changepoint, log_growth)[:MAX_RUN_LENGTH]
+        self.mu = np.append(mu0, mu)[:MAX_RUN_LENGTH]
+        self.kappa = np.append(kappa0, self.kappa + 1)[:MAX_RUN_LENGTH]
+        self.alpha = np.append(alpha0, self.alpha + 0.5)[:MAX_RUN_LENGTH]
+        self.beta = np.append(beta0, beta)[:MAX_RUN_LENGTH]
+        self.log_r = self.log_r - logsumexp(self.log_r)
+
+        # Run length j means the current run started with the point j-1 places back from the newest.
+        # The probability of run length 0 is always the hazard rate, so it tells us nothing.
+        # Each point keeps the strongest evidence we have seen that a new run started with it.
+        if self.n < MIN_POINTS:
+            return
+        probabilities = np.exp(self.log_r)
+        for j in range(1, min(SCORE_LAG + 1, probabilities.shape[0], len(self.history) + 1)):
+            point = self.history[-j]
+            point["anomaly_score"] = max(point["anomaly_score"], float(probabilities[j]))
+
+    def update_running_stats(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+def student_t_logpdf(x, mu, kappa, alpha, beta):
+    # Posterior predictive of a Normal-Gamma model is a Student's t distribution.
+    nu = 2 * alpha
+    scale2 = beta * (kappa + 1) / (alpha * kappa)
+    return (gammaln((nu + 1) / 2) - gammaln(nu / 2) - 0.5 * np.log(nu * np.pi * scale2)
+        - ((nu + 1) / 2) * np.log(1 + (x - mu)**2 / (nu * scale2)))
+
+def get_series_state(series_id):
+    with _series_states_lock:
+        state = _series_states.get(series_id)
+        if state is None:
+            state = SeriesState()
+            _series_states[series_id] = state
+            if len(_series_states) > MAX_SERIES:
+                _series_states.popitem(last=False)
+        else:
+            _series_states.move_to_end(series_id)
+        return state
+
+def reset_series(series_id):
+    with _series_states_lock:
+        return _series_states.pop(series_id, None) is not None
+
+def detect_single_timeseries_stream(
+    series_id,
+    df,
+    sensitivity_score,
+    max_fraction_anomalies
+):
+    weights = { "time_series": 1.0 }
+
+    # Ensure that everything is sorted by dt
+    df = df.sort_values("dt", axis=0, ascending=True)
+
+    if (max_fraction_anomalies <= 0.0 or max_fraction_anomalies > 1.0):
+        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a valid max fraction of anomalies, 0 < x <= 1.0.")
+    elif (sensitivity_score <= 0 or sensitivity_score > 100 ):
+        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a valid sensitivity score, 0 < x <= 100.")
+    elif (df['value'].count() < 1):
+        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must send at least one data point to update the series.")
+    elif (df['dt'].duplicated().any()):
+        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Each data point must have its own dt.")
+
+    tests_run = {
+        "bocpd": 1
+    }
+    dts = pd.to_datetime(df['dt'], utc=True)
+    state = get_series_state(series_id)
+    with state.lock:
+        # Points which repeat or come before ones we already have would corrupt the run-length posterior.
+        if (state.last_dt is not None and dts.iloc[0] <= state.last_dt):
+            return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, f"Every new data point must come after the data points already in the series.  The latest is {state.last_dt.isoformat()}.")
+        for (key, dt, value) in zip(df['key'], df['dt'], df['value']):
+            state.update(key, dt, float(value))
+        state.last_dt = dts.iloc[-1]
+        history = pd.DataFrame(list(state.history))
+        num_points_seen = state.n
+        most_likely_run_length = int(np.argmax(state.log_r))
+
+    diagnostics = {
+        "Number of records": df.shape[0],
+        "Number of records seen": num_points_seen,
+        "Number of records retained": history.shape[0],
+        "Most likely run length": most_likely_run_length,
+        "Hazard": HAZARD,
+        "Max run length": MAX_RUN_LENGTH
+    }
+
+    # Each point gets a single change point probability in [0, 1], so we threshold it as a single
+    # iteration of the batch approach, using the retained history for max_fraction_anomalies.
+    (is_anomaly, diag_outliers) = single_timeseries.determine_outliers(history['anomaly_score'].to_numpy(), 1, sensitivity_score, max_fraction_anomalies)
+    history_out = history.assign(is_anomaly=is_anomaly)
+
+    # Return the new points, along with any earlier points whose scores we revised.
+    num_returned = min(history_out.shape[0], df.shape[0] + SCORE_LAG - 1)
+    df_out = history_out.tail(num_returned).reset_index(drop=True)
+    return (df_out, weights, { "message": "Result of streaming single time series change point detection.", "Tests run": tests_run, "Test diagnostics": diagnostics, "Outlier determination": diag_outliers})
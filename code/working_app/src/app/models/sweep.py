@@ -0,0 +1,32 @@
+# Finding Ghosts in Your Data
+# Sensitivity sweeps
+# Running the tests is the expensive part of every detector, while deciding which anomaly scores make
+# outliers is a cheap threshold.  A sweep runs the tests once and then applies each combination of
+# sensitivity score and max fraction of anomalies, so that tuning the sensitivity does not rerun the ensemble.
+
+import itertools
+
+def get_combinations(sensitivity_scores, max_fraction_anomalies):
+    return list(itertools.product(sensitivity_scores, max_fraction_anomalies))
+
+def check_combinations(combinations):
+    # Check every combination before running any tests, so that a bad one does not waste the work.
+    if (len(combinations) == 0):
+        return "Must have at least one sensitivity score and one max fraction of anomalies."
+    for (sensitivity_score, max_fraction_anomalies) in combinations:
+        if (max_fraction_anomalies <= 0.0 or max_fraction_anomalies > 1.0):
+            return "Must have a valid max fraction of anomalies, 0 < x <= 1.0."
+        elif (sensitivity_score <= 0 or sensitivity_score > 100 ):
+            return "Must have a valid sensitivity score, 0 < x <= 100."
+    return None
+
+def invalid(df, weights, message):
+    return (df.assign(anomaly_score=0.0), weights, message, [])
+
+def get_threshold(sensitivity_score, max_fraction_anomalies, is_anomaly, anomaly_score=None):
+    # Each threshold holds the settings and whatever changes with them, one entry per row of the results.
+    threshold = { "sensitivity_score": sensitivity_score, "max_fraction_anomalies": max_fraction_anomalies }
+    if anomaly_score is not None:
+        threshold["anomaly_score"] = anomaly_score
+    threshold["is_anomaly"] = is_anomaly
+    return threshold
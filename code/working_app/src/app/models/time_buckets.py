@@ -0,0 +1,57 @@
+# Finding Ghosts in Your Data
+# Time bucket pre-aggregation for time series anomaly detection
+# Detectors run on one value per bucket; results map back onto every original point.
+
+import pandas as pd
+import numpy as np
+
+aggregators = { "mean", "median", "min", "max", "sum", "first", "last" }
+
+def detect_with_time_buckets(
+    df,
+    detect,
+    aggregation_interval,
+    aggregation_function,
+    group_columns=None
+):
+    # detect takes a DataFrame and returns the same (df, weights, details) tuple as each of our detectors.
+    if aggregation_function not in aggregators:
+        return (df.assign(is_anomaly=False, anomaly_score=0.0), {}, f"Must have a valid aggregation function, one of {sorted(aggregators)}.  You sent {aggregation_function}.")
+    try:
+        (df_buckets, bucket_ids, diagnostics) = aggregate_time_buckets(df, aggregation_interval, aggregation_function, group_columns)
+    except ValueError:
+        return (df.assign(is_anomaly=False, anomaly_score=0.0), {}, f"Must have a valid aggregation interval, such as 1min or 1h.  You sent {aggregation_interval}.")
+
+    (df_buckets_out, weights, details) = detect(df_buckets)
+    df_out = map_bucket_results(df, bucket_ids, df_buckets_out)
+    if isinstance(details, dict):
+        details["Time buckets"] = diagnostics
+    return (df_out, weights, details)
+
+def aggregate_time_buckets(df, aggregation_interval, aggregation_function, group_columns=None):
+    if group_columns is None:
+        group_columns = []
+    # Floor each timestamp to the start of its bucket.  Buckets are per series if we have group columns.
+    bucket_dt = pd.to_datetime(df['dt'], utc=True).dt.floor(aggregation_interval)
+    grouped = df.assign(dt=bucket_dt).groupby(group_columns + ["dt"], sort=True)
+    # ngroup() numbers buckets in the same order as the aggregated output, so we can use it to map back.
+    bucket_ids = grouped.ngroup().to_numpy()
+    df_buckets = grouped['value'].agg(aggregation_function).reset_index()
+    df_buckets.insert(0, "key", [str(b) for b in range(df_buckets.shape[0])])
+
+    diagnostics = {
+        "Aggregation interval": aggregation_interval,
+        "Aggregation function": aggregation_function,
+        "Number of records": df.shape[0],
+        "Number of buckets": df_buckets.shape[0]
+    }
+    return (df_buckets, bucket_ids, diagnostics)
+
+def map_bucket_results(df, bucket_ids, df_buckets_out):
+    # Detectors may reorder their output, so line results back up by bucket key.
+    bucket_order = df_buckets_out['key'].astype(int).to_numpy()
+    anomaly_score = np.zeros(bucket_order.shape[0])
+    is_anomaly = np.zeros(bucket_order.shape[0], dtype=bool)
+    anomaly_score[bucket_order] = df_buckets_out['anomaly_score'].to_numpy()
+    is_anomaly[bucket_order] = df_buckets_out['is_anomaly'].to_numpy()
+    return df.assign(anomaly_score=anomaly_score[bucket_ids], is_anomaly=is_anomaly[bucket_ids])
@@ -0,0 +1,111 @@
+# Finding Ghosts in Your Data
+# Per-stage timing for the detectors
+# When a call is slow, we want to know which part of the ensemble made it slow.  Each detector wraps its
+# stages and tests in stage(), and a debug call collects the wall time, CPU time, and peak allocation of
+# each one.  Outside of collect(), stage() hands back a shared no-op, so ordinary calls pay for little
+# more than a context variable lookup.
+
+import time
+import threading
+import tracemalloc
+import contextvars
+from contextlib import contextmanager
+
+_collector = contextvars.ContextVar("timing_collector", default=None)
+
+# tracemalloc is process-wide, so calls running on several threads at once share it.  Peaks are exact
+# for one call at a time and approximate otherwise.
+_tracing_lock = threading.Lock()
+_tracing_count = 0
+
+class NoStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NO_STAGE = NoStage()
+
+class Stage:
+    def __init__(self, collector, name):
+        self.collector = collector
+        self.name = name
+
+    def __enter__(self):
+        c = self.collector
+        # Whatever the enclosing stage allocated so far counts towards its own peak before we reset it.
+        (current, peak) = tracemalloc.get_traced_memory()
+        if c.open_stages:
+            c.open_stages[-1].max_peak = max(c.open_stages[-1].max_peak, peak)
+        tracemalloc.reset_peak()
+        self.start_memory = current
+        self.max_peak = current
+        c.open_stages.append(self)
+        self.start_cpu = time.thread_time()
+        self.start_wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.start_wall
+        cpu = time.thread_time() - self.start_cpu
+        c = self.collector
+        c.open_stages.pop()
+        peak = max(self.max_peak, tracemalloc.get_traced_memory()[1])
+        if c.open_stages:
+            c.open_stages[-1].max_peak = max(c.open_stages[-1].max_peak, peak)
+        path = "/".join([s.name for s in c.open_stages] + [self.name])
+        t = c.timings.setdefault(path, { "calls": 0, "wall_ms": 0.0, "cpu_ms": 0.0, "peak_bytes": 0 })
+        # A stage which runs many times (one COF run per neighbor count, say) adds up its times and keeps its largest peak.
+        t["calls"] += 1
+        t["wall_ms"] += wall * 1000.0
+        t["cpu_ms"] += cpu * 1000.0
+        t["peak_bytes"] = max(t["peak_bytes"], peak - self.start_memory)
+        return False
+
+class Collector:
+    def __init__(self):
+        self.timings = {}
+        self.open_stages = []
+
+def stage(name):
+    collector = _collector.get()
+    if collector is None:
+        return NO_STAGE
+    return Stage(collector, name)
+
+def start_tracing():
+    global _tracing_count
+    with _tracing_lock:
+        if _tracing_count == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing_count = 1
+        elif _tracing_count > 0:
+            _tracing_count += 1
+
+def stop_tracing():
+    global _tracing_count
+    with _tracing_lock:
+        if _tracing_count > 0:
+            _tracing_count -= 1
+            if _tracing_count == 0:
+                tracemalloc.stop()
+
+@contextmanager
+def collect(enabled=True):
+    # Yields the dictionary of timings, keyed by the path of nested stage names.  It fills in as stages
+    # finish.  Tracing allocations slows Python-heavy stages down, which is why this only runs for debug calls.
+    if not enabled:
+        yield None
+        return
+    collector = Collector()
+    start_tracing()
+    token = _collector.set(collector)
+    try:
+        yield collector.timings
+    finally:
+        _collector.reset(token)
+        stop_tracing()
+        for t in collector.timings.values():
+            t["wall_ms"] = round(t["wall_ms"], 3)
+            t["cpu_ms"] = round(t["cpu_ms"], 3)
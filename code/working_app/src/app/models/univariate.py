@@ -4,7 +4,6 @@
 
 import pandas as pd
 import numpy as np
-from pandas.core import base
 from statsmodels import robust
 # Chapter 7
 from scipy.stats import shapiro, normaltest, anderson, boxcox
@@ -12,12 +11,14 @@ import scikit_posthocs as ph
 import math
 # Chapter 9
 from sklearn.mixture import GaussianMixture
+from . import planner, sweep, timing
 
-def detect_univariate_statistical(
-    df,
-    sensitivity_score,
-    max_fraction_anomalies
-):
+# Up to this many rows, building DataFrame columns, copying frames, and grouping cost more than most of
+# the tests themselves, so we run the ensemble on NumPy arrays and build the output DataFrame once.
+# Both paths give identical results.
+SMALL_INPUT_ROWS = 200
+
+def get_weights():
     # Standard deviation is not a very robust measure, so we weigh this lowest.
     # IQR is a reasonably good measure, so we give it the second-highest weight.
     # MAD is a robust measure for deviation, so we give it the highest weight.
@@ -25,9 +26,17 @@ def detect_univariate_statistical(
     # shape of the data and the correct number of observations.
     # The reason Grubbs' and Dixon's tests are so low is that they capture at most
     # 1 (Grubbs) or 2 (Dixon) outliers.
-    weights = {"sds": 0.25, "iqrs": 0.35, "mads": 0.45,
-               "grubbs": 0.05, "dixon": 0.15, "gesd": 0.3,
-               "gaussian_mixture": 1.5}
+    return {"sds": 0.25, "iqrs": 0.35, "mads": 0.45,
+            "grubbs": 0.05, "dixon": 0.15, "gesd": 0.3,
+            "gaussian_mixture": 1.5}
+
+def detect_univariate_statistical(
+    df,
+    sensitivity_score,
+    max_fraction_anomalies,
+    latency_budget_ms=None
+):
+    weights = get_weights()
 
     if (df['value'].count() < 3):
         return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a minimum of at least three data points for anomaly detection.")
@@ -36,26 +45,127 @@ def detect_univariate_statistical(
     elif (sensitivity_score <= 0 or sensitivity_score > 100 ):
         return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a valid sensitivity score, 0 < x <= 100.")
     else:
-        (df_tested, tests_run, diagnostics) = run_tests(df)
-        df_scored = score_results(df_tested, tests_run, weights)
-        df_out = determine_outliers(df_scored, sensitivity_score, max_fraction_anomalies)
+        plan = planner.plan_univariate(df['value'].count(), latency_budget_ms)
+        if is_small_input(df):
+            with timing.stage("run_tests"):
+                (columns, tests_run, diagnostics) = run_tests_arrays(df['value'].to_numpy(), plan)
+            with timing.stage("score_results"):
+                columns["anomaly_score"] = calculate_anomaly_score(columns, tests_run, weights)
+            with timing.stage("determine_outliers"):
+                columns["is_anomaly"] = determine_outliers(columns["anomaly_score"], sensitivity_score, max_fraction_anomalies)
+            df_out = df.assign(**columns)
+        else:
+            with timing.stage("run_tests"):
+                (df_tested, tests_run, diagnostics) = run_tests(df, plan)
+            with timing.stage("score_results"):
+                df_scored = score_results(df_tested, tests_run, weights)
+            with timing.stage("determine_outliers"):
+                df_out = df_scored.assign(is_anomaly=determine_outliers(df_scored['anomaly_score'].to_numpy(), sensitivity_score, max_fraction_anomalies))
         return (df_out, weights, { "message": "Ensemble of univariate statistical tests.", "Test diagnostics": diagnostics})
 
-def run_tests(df):
+def detect_univariate_statistical_group(calls):
+    # calls is a list of (df, keywords) pairs, one for each request in a micro-batch, where keywords holds
+    # the rest of the arguments to detect_univariate_statistical.  Each series still needs its own
+    # statistics, normality tests, and Gaussian mixture, but the SD, MAD, and IQR checks, the scoring,
+    # and the thresholds then run once over every series' values together.  Returns the result (or the
+    # exception) for each call, in order, just as calling detect_univariate_statistical on each would.
+    results = [None] * len(calls)
+    group = []
+    for (i, (df, keywords)) in enumerate(calls):
+        try:
+            s = keywords["sensitivity_score"]
+            m = keywords["max_fraction_anomalies"]
+            if not is_small_input(df) or df.shape[0] < 3 or m <= 0.0 or m > 1.0 or s <= 0 or s > 100:
+                # Larger inputs, and anything which only gets an error message, run on their own.
+                results[i] = detect_univariate_statistical(df, **keywords)
+                continue
+            values = df['value'].to_numpy()
+            plan = planner.plan_univariate(df.shape[0], keywords.get("latency_budget_ms"))
+            (columns, tests_run, diagnostics) = run_series_tests_arrays(values, plan)
+            group.append({ "index": i, "df": df, "values": values, "sensitivity_score": s, "max_fraction_anomalies": m,
+                "columns": columns, "tests_run": tests_run, "diagnostics": diagnostics })
+        except Exception as e:
+            results[i] = e
+    if not group:
+        return results
+
+    # Line the series up end to end, with each one's statistics and tests run repeated for each of its values.
+    lengths = [g["values"].shape[0] for g in group]
+    ends = np.cumsum(lengths)
+    values = np.concatenate([g["values"] for g in group])
+    b = { k: np.repeat([g["diagnostics"]["Base calculations"][k] for g in group], lengths) for k in ["mean", "sd", "median", "mad", "p25", "p75", "iqr"] }
+    with timing.stage("run_tests"):
+        spread = check_spread_arrays(values, b)
+    columns = { **spread, **{ test: np.concatenate([g["columns"][test] for g in group]) for test in ["grubbs", "gesd", "dixon", "gaussian_mixture"] } }
+    tests_run = { test: np.repeat([g["tests_run"][test] for g in group], lengths) for test in group[0]["tests_run"] }
+    with timing.stage("score_results"):
+        anomaly_score = calculate_anomaly_score(columns, tests_run, get_weights())
+    with timing.stage("determine_outliers"):
+        thresholds = [get_outlier_threshold(anomaly_score[end - n:end], g["sensitivity_score"], g["max_fraction_anomalies"])
+            for (g, n, end) in zip(group, lengths, ends)]
+        is_anomaly = anomaly_score >= np.repeat(thresholds, lengths)
+
+    # Adding columns to a DataFrame one at a time costs more than the tests on a small series, so build the
+    # output for all series with the same columns at once, and slice each series' rows back out of that.
+    schemas = {}
+    for (g, n, end) in zip(group, lengths, ends):
+        g["rows"] = np.arange(end - n, end)
+        schema = (tuple(g["df"].columns), tuple(g["df"].dtypes), tuple((k, v.dtype) for (k, v) in g["columns"].items()))
+        schemas.setdefault(schema, []).append(g)
+    for same in schemas.values():
+        rows = np.concatenate([g["rows"] for g in same])
+        outputs = { **{ k: v[rows] for (k, v) in spread.items() }, **{ k: np.concatenate([g["columns"][k] for g in same]) for k in same[0]["columns"] },
+            "anomaly_score": anomaly_score[rows], "is_anomaly": is_anomaly[rows] }
+        df_group = pd.concat([pd.concat([g["df"] for g in same], ignore_index=True), pd.DataFrame(outputs)], axis=1)
+        start = 0
+        for g in same:
+            df_out = df_group.iloc[start:start + g["rows"].shape[0]].reset_index(drop=True)
+            start += g["rows"].shape[0]
+            results[g["index"]] = (df_out, get_weights(), { "message": "Ensemble of univariate statistical tests.", "Test diagnostics": g["diagnostics"]})
+    return results
+
+def detect_univariate_statistical_sweep(
+    df,
+    sensitivity_scores,
+    max_fraction_anomalies,
+    latency_budget_ms=None
+):
+    # Run the tests once, then threshold the same anomaly scores with each combination of settings.
+    # The anomaly score does not depend on the settings, so only is_anomaly changes.
+    combinations = sweep.get_combinations(sensitivity_scores, max_fraction_anomalies)
+    message = sweep.check_combinations(combinations)
+    if message is not None:
+        return sweep.invalid(df, {}, message)
+    (df_out, weights, details) = detect_univariate_statistical(df, *combinations[0], latency_budget_ms=latency_budget_ms)
+    if isinstance(details, str):
+        return sweep.invalid(df, weights, details)
+    anomaly_score = df_out['anomaly_score'].to_numpy()
+    thresholds = [sweep.get_threshold(s, m, determine_outliers(anomaly_score, s, m)) for (s, m) in combinations]
+    return (df_out.drop(columns='is_anomaly'), weights, details, thresholds)
+
+def run_tests(df, plan=None):
+    # plan comes from the latency-budget planner.  Without one, run every test the data allows.
+    if plan is None:
+        plan = planner.plan_univariate(df['value'].count())
     # Get our baseline calculations, prior to any data transformations.
-    base_calculations = perform_statistical_calculations(df['value'])
+    with timing.stage("base_calculations"):
+        base_calculations = perform_statistical_calculations(df['value'])
 
     diagnostics = { "Base calculations": base_calculations }
 
-    (use_fitted_results, fitted_data, normalization_diagnostics) = perform_normalization(base_calculations, df)
+    with timing.stage("normalization"):
+        (use_fitted_results, fitted_data, normalization_diagnostics) = perform_normalization(base_calculations, df)
     diagnostics.update(normalization_diagnostics)
 
     # for each test, execute and add a new score
     # Initial tests should NOT use the fitted calculations.
     b = base_calculations
-    df['sds'] = [check_sd(val, b["mean"], b["sd"], 3.0) for val in df['value']]
-    df['mads'] = [check_mad(val, b["median"], b["mad"], 3.0) for val in df['value']]
-    df['iqrs'] = [check_iqr(val, b["median"], b["p25"], b["p75"], b["iqr"], 1.5) for val in df['value']]
+    with timing.stage("sds"):
+        df['sds'] = [check_sd(val, b["mean"], b["sd"], 3.0) for val in df['value']]
+    with timing.stage("mads"):
+        df['mads'] = [check_mad(val, b["median"], b["mad"], 3.0) for val in df['value']]
+    with timing.stage("iqrs"):
+        df['iqrs'] = [check_iqr(val, b["median"], b["p25"], b["p75"], b["iqr"], 1.5) for val in df['value']]
     tests_run = {
         "sds": 1,
         "mads": 1,
@@ -83,13 +193,15 @@ def run_tests(df):
         diagnostics["Fitted calculations"] = c
 
         if (b['len'] >= 7):
-            df['grubbs'] = check_grubbs(col)
+            with timing.stage("grubbs"):
+                df['grubbs'] = check_grubbs(col)
             tests_run['grubbs'] = 1
         else:
             diagnostics["Grubbs' Test"] = f"Did not run Grubbs' test because we need at least 7 observations but only had {b['len']}."
 
         if (b['len'] >= 3 and b['len'] <= 25):
-            df['dixon'] = check_dixon(col)
+            with timing.stage("dixon"):
+                df['dixon'] = check_dixon(col)
             tests_run['dixon'] = 1
         else:
             diagnostics["Dixon's Q Test"] = f"Did not run Dixon's Q test because we need between 3 and 25 observations but had {b['len']}."
@@ -98,15 +210,20 @@ def run_tests(df):
             # Ensure we have at least 1 outlier allowed and there are still enough
             # degrees of freedom to analyze the data.
             max_num_outliers = math.floor(b['len'] / 3)
-            df['gesd'] = check_gesd(col, max_num_outliers)
+            with timing.stage("gesd"):
+                df['gesd'] = check_gesd(col, max_num_outliers)
             tests_run['gesd'] = 1
     else:
         diagnostics["Extended tests"] = "Did not run extended tests because the dataset was not normal and could not be normalized."
 
-    if b['len'] >= 15:
-        num_clusters = get_number_of_gaussian_mixture_clusters(df['value'])
+    if b['len'] >= 15 and plan["gaussian_mixture"] == 0:
+        diagnostics["Gaussian mixture test"] = f"Did not run Gaussian mixture test because it would not fit in the latency budget of {plan['latency_budget_ms']} ms."
+    elif b['len'] >= 15:
+        with timing.stage("gaussian_mixture_search"):
+            num_clusters = get_number_of_gaussian_mixture_clusters(df['value'], plan["gaussian_mixture_max_clusters"])
         if (num_clusters > 1):
-            df['gaussian_mixture'] = check_gaussian_mixture(df['value'], num_clusters)
+            with timing.stage("gaussian_mixture"):
+                df['gaussian_mixture'] = check_gaussian_mixture(df['value'], num_clusters)
             diagnostics["Gaussian mixture test"] = f"Ran Gaussian mixture test with {num_clusters} clusters."
             tests_run['gaussian_mixture'] = 1
         else:
@@ -115,18 +232,115 @@ def run_tests(df):
         diagnostics["Gaussian mixture test"] = "Did not run Gaussian mixture test because we need at least 15 data points to run this test."
     
     diagnostics["Tests Run"] = tests_run
+    if plan["latency_budget_ms"] is not None:
+        diagnostics["Plan"] = plan
 
     return (df, tests_run, diagnostics)
 
+def is_small_input(df):
+    # The array path looks rows up by position where run_tests uses index labels, and does not skip
+    # missing values the way pandas does, so it only takes inputs on which the two agree.
+    index = df.index
+    return (df.shape[0] <= SMALL_INPUT_ROWS
+        and isinstance(index, pd.RangeIndex) and index.start == 0 and index.step == 1
+        and df['value'].dtype == np.float64 and df['value'].count() == df.shape[0])
+
+def run_tests_arrays(values, plan):
+    # The same tests as run_tests, on a NumPy array.  Returns a dictionary of result columns,
+    # in the order in which run_tests adds them to its DataFrame.
+    (columns, tests_run, diagnostics) = run_series_tests_arrays(values, plan)
+    return ({ **check_spread_arrays(values, diagnostics["Base calculations"]), **columns }, tests_run, diagnostics)
+
+def check_spread_arrays(values, b):
+    # The SD, MAD, and IQR checks.  Each of the base calculations in b may be a single number, or
+    # an array with one entry for each value.
+    columns = {}
+    with timing.stage("sds"):
+        columns['sds'] = check_stat_arrays(values, b["mean"], b["sd"], 3.0)
+    with timing.stage("mads"):
+        columns['mads'] = check_stat_arrays(values, b["median"], b["mad"], 3.0)
+    with timing.stage("iqrs"):
+        columns['iqrs'] = check_iqr_arrays(values, b["median"], b["p25"], b["p75"], b["iqr"], 1.5)
+    return columns
+
+def run_series_tests_arrays(values, plan):
+    # Every test except the SD, MAD, and IQR checks, which is to say those which need the whole series.
+    with timing.stage("base_calculations"):
+        base_calculations = perform_statistical_calculations_arrays(values)
+
+    diagnostics = { "Base calculations": base_calculations }
+
+    with timing.stage("normalization"):
+        (use_fitted_results, fitted_data, normalization_diagnostics) = perform_column_normalization(base_calculations, values)
+    diagnostics.update(normalization_diagnostics)
+
+    b = base_calculations
+    columns = {}
+    tests_run = { "sds": 1, "mads": 1, "iqrs": 1, "grubbs": 0, "gesd": 0, "dixon": 0, "gaussian_mixture": 0 }
+    for test in ['grubbs', 'gesd', 'dixon', 'gaussian_mixture']:
+        columns[test] = np.full(values.shape[0], -1)
+
+    if (use_fitted_results):
+        col = np.asarray(fitted_data)
+        columns['fitted_value'] = col
+        diagnostics["Fitted calculations"] = perform_statistical_calculations_arrays(col)
+
+        if (b['len'] >= 7):
+            with timing.stage("grubbs"):
+                columns['grubbs'] = find_differences_arrays(col, ph.outliers_grubbs(col))
+            tests_run['grubbs'] = 1
+        else:
+            diagnostics["Grubbs' Test"] = f"Did not run Grubbs' test because we need at least 7 observations but only had {b['len']}."
+
+        if (b['len'] >= 3 and b['len'] <= 25):
+            with timing.stage("dixon"):
+                columns['dixon'] = np.isin(col, get_dixon_outliers(sorted(col.tolist()))).astype(np.float64)
+            tests_run['dixon'] = 1
+        else:
+            diagnostics["Dixon's Q Test"] = f"Did not run Dixon's Q test because we need between 3 and 25 observations but had {b['len']}."
+
+        if (b['len'] >= 15):
+            max_num_outliers = math.floor(b['len'] / 3)
+            with timing.stage("gesd"):
+                columns['gesd'] = find_differences_arrays(col, ph.outliers_gesd(col, max_num_outliers))
+            tests_run['gesd'] = 1
+    else:
+        diagnostics["Extended tests"] = "Did not run extended tests because the dataset was not normal and could not be normalized."
+
+    if b['len'] >= 15 and plan["gaussian_mixture"] == 0:
+        diagnostics["Gaussian mixture test"] = f"Did not run Gaussian mixture test because it would not fit in the latency budget of {plan['latency_budget_ms']} ms."
+    elif b['len'] >= 15:
+        with timing.stage("gaussian_mixture_search"):
+            (num_clusters, gm_model) = get_best_gaussian_mixture(values, plan["gaussian_mixture_max_clusters"])
+        if (num_clusters > 1):
+            with timing.stage("gaussian_mixture"):
+                columns['gaussian_mixture'] = check_gaussian_mixture_arrays(values, gm_model)
+            diagnostics["Gaussian mixture test"] = f"Ran Gaussian mixture test with {num_clusters} clusters."
+            tests_run['gaussian_mixture'] = 1
+        else:
+            diagnostics["Gaussian mixture test"] = "Did not run Gaussian mixture test because the dataset appears to contain one cluster."
+    else:
+        diagnostics["Gaussian mixture test"] = "Did not run Gaussian mixture test because we need at least 15 data points to run this test."
+
+    diagnostics["Tests Run"] = tests_run
+    if plan["latency_budget_ms"] is not None:
+        diagnostics["Plan"] = plan
+
+    return (columns, tests_run, diagnostics)
+
 def perform_normalization(base_calculations, df):
+    return perform_column_normalization(base_calculations, df['value'])
+
+def perform_column_normalization(base_calculations, col):
     use_fitted_results = False
     fitted_data = None
 
-    (is_naturally_normal, natural_normality_checks) = is_normally_distributed(df['value'])
+    with timing.stage("normality_tests"):
+        (is_naturally_normal, natural_normality_checks) = is_normally_distributed(col)
     diagnostics = {"Initial normality checks": natural_normality_checks}
     # If we already have normal-looking data, just use it without reshaping.
     if is_naturally_normal:
-        fitted_data = df['value']
+        fitted_data = col
         use_fitted_results = True
 
     # Perform a Box-Cox normalization test if we meet all of the criteria:
@@ -137,10 +351,12 @@ def perform_normalization(base_calculations, df):
     if ((not is_naturally_normal)
         and base_calculations["min"] < base_calculations["max"]
         and base_calculations["min"] > 0
-        and df['value'].shape[0] >= 8):
+        and col.shape[0] >= 8):
 
-        (fitted_data, fitted_lambda) = normalize(df['value'])
-        (is_fitted_normal, fitted_normality_checks) = is_normally_distributed(fitted_data)
+        with timing.stage("box_cox"):
+            (fitted_data, fitted_lambda) = normalize(col)
+        with timing.stage("normality_tests"):
+            (is_fitted_normal, fitted_normality_checks) = is_normally_distributed(fitted_data)
         # The output dataset might not be totally normal, but it should be a lot closer.
         use_fitted_results = True
         diagnostics["Fitted Lambda"] = fitted_lambda
@@ -148,7 +364,7 @@ def perform_normalization(base_calculations, df):
     else:
         has_variance = base_calculations["min"] < base_calculations["max"]
         all_gt_zero = base_calculations["min"] > 0
-        enough_observations = df['value'].shape[0] >= 8
+        enough_observations = col.shape[0] >= 8
         diagnostics["Fitting Status"] = f"Did not attempt to normalize the data.  Is naturally normal?  {is_naturally_normal}.  Has variance?  {has_variance}.  All values above 0?  {all_gt_zero}.  Has at least 8 observations?  {enough_observations}"
 
     return (use_fitted_results, fitted_data, diagnostics)
@@ -170,6 +386,23 @@ def perform_statistical_calculations(col):
     return { "mean": mean, "sd": sd, "min": min, "max": max,
         "p25": p25, "median": median, "p75": p75, "iqr": iqr, "mad": mad, "len": len }
 
+def perform_statistical_calculations_arrays(values):
+    # The same calculations on a NumPy array.  The mean, the two-pass standard deviation, and
+    # nanmedian follow pandas, so that both give the same results down to the last bit.
+    len = values.shape[0]
+    mean = values.sum() / len
+    sd = np.sqrt(((mean - values) ** 2).sum() / (len - 1)) if len > 1 else np.nan
+    p25 = np.quantile(values, 0.25)
+    p75 = np.quantile(values, 0.75)
+    iqr = p75 - p25
+    median = np.nanmedian(values)
+    mad = robust.mad(values)
+    min = values.min()
+    max = values.max()
+
+    return { "mean": mean, "sd": sd, "min": min, "max": max,
+        "p25": p25, "median": median, "p75": p75, "iqr": iqr, "mad": mad, "len": len }
+
 def check_sd(val, mean, sd, min_num_sd):
     return check_stat(val, mean, sd, min_num_sd)
 
@@ -188,6 +421,12 @@ def check_stat(val, midpoint, distance, n):
     else:
         return 1.0
 
+def check_stat_arrays(values, midpoint, distance, n):
+    # check_stat for every value at once.  With no spread, the division is never used.
+    deviation = np.abs(values - midpoint)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(deviation < (n * distance), deviation/(n * distance), 1.0)
+
 def check_iqr(val, median, p25, p75, iqr, min_iqr_diff):
     # We only want to check one direction, based on whether
     # the value is below the median or at/above.
@@ -218,6 +457,15 @@ def check_iqr(val, median, p25, p75, iqr, min_iqr_diff):
         else:
             return 1.0
 
+def check_iqr_arrays(values, median, p25, p75, iqr, min_iqr_diff):
+    # check_iqr for every value at once.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        below = np.where(values > p25, 0.0,
+            np.where((p25 - values) < (min_iqr_diff * iqr), np.abs(p25 - values)/(min_iqr_diff * iqr), 1.0))
+        above = np.where(values < p75, 0.0,
+            np.where((values - p75) < (min_iqr_diff * iqr), np.abs(values - p75)/(min_iqr_diff * iqr), 1.0))
+    return np.where(values < median, below, above)
+
 def is_normally_distributed(col):
     alpha = 0.05
 
@@ -312,7 +560,20 @@ def find_differences(col, out):
 
     return res
 
+def find_differences_arrays(values, out):
+    # Every value the test left out of its output is an outlier, wherever it appears.
+    return (~np.isin(values, out)).astype(np.float64)
+
 def check_dixon(col):
+    res = [0.0 for val in col]
+    # Dixon's Q test only lets us test the edges, so if there are multiple
+    # outliers on a side, we only get to see one.
+    for outlier in get_dixon_outliers(sorted(col)):
+        indexes = col[col == outlier].index
+        for i in indexes: res[i] = 1.0
+    return res
+
+def get_dixon_outliers(sorted_data):
     q95 = [0.97, 0.829, 0.71, 0.625, 0.568, 0.526, 0.493, 0.466,
         0.444, 0.426, 0.41, 0.396, 0.384, 0.374, 0.365, 0.356,
         0.349, 0.342, 0.337, 0.331, 0.326, 0.321, 0.317, 0.312,
@@ -320,7 +581,6 @@ def check_dixon(col):
     Q95 = {n:q for n, q in zip(range(3, len(q95) + 1), q95)}
 
     Q_mindiff, Q_maxdiff = (0,0), (0,0)
-    sorted_data = sorted(col)
 
     # Check the left-hand side to see if there are any min outliers
     Q_min = (sorted_data[1] - sorted_data[0])
@@ -329,7 +589,7 @@ def check_dixon(col):
     except ZeroDivisionError:
         pass
 
-    Q_mindiff = (Q_min - Q95[len(col)], sorted_data[0])
+    Q_mindiff = (Q_min - Q95[len(sorted_data)], sorted_data[0])
 
     Q_max = abs(sorted_data[-2] - sorted_data[-1])
     try:
@@ -337,32 +597,34 @@ def check_dixon(col):
     except ZeroDivisionError:
         pass
 
-    Q_maxdiff = (Q_max - Q95[len(col)], sorted_data[-1])
+    Q_maxdiff = (Q_max - Q95[len(sorted_data)], sorted_data[-1])
 
     # If the resulting calculation is greater than 0, we have an outlier.
-    res = [0.0 for val in col]
-    # Dixon's Q test only lets us test the edges, so if there are multiple
-    # outliers on a side, we only get to see one.
+    outliers = []
     if Q_maxdiff[0] >= 0:
-        indexes = col[col == Q_maxdiff[1]].index
-        for i in indexes: res[i] = 1.0
-
+        outliers.append(Q_maxdiff[1])
     if Q_mindiff[0] >= 0:
-        indexes = col[col == Q_mindiff[1]].index
-        for i in indexes: res[i] = 1.0
+        outliers.append(Q_mindiff[1])
+    return outliers
 
-    return res
+def get_number_of_gaussian_mixture_clusters(col, max_clusters=9):
+    return get_best_gaussian_mixture(np.array(col), max_clusters)[0]
 
-def get_number_of_gaussian_mixture_clusters(col):
-    X = np.array(col).reshape(-1,1)
+def get_best_gaussian_mixture(values, max_clusters=9):
+    # Returns the number of clusters along with the winning model.  Fitting the same data with the
+    # same random state gives the same model, so check_gaussian_mixture_arrays can use this one.
+    X = values.reshape(-1,1)
+    models = []
     bic_vals = []
     # Have a minimum of 2 clusters (if 10 rows come in)
-    # and a maximum of 9 clusters.
-    max_clusters = math.floor(min(col.shape[0]/5.0, 9))
+    # and a maximum of 9 clusters, or fewer if the latency budget calls for it.
+    max_clusters = math.floor(min(values.shape[0]/5.0, max_clusters))
     for c in range(1, max_clusters, 1):
         gm = GaussianMixture(n_components = c, random_state = 0, max_iter = 250, covariance_type='full').fit(X)
+        models.append(gm)
         bic_vals.append(gm.bic(X))
-    return np.argmin(bic_vals) + 1
+    best = np.argmin(bic_vals)
+    return (best + 1, models[best])
 
 def check_gaussian_mixture(col, best_fit_cluster_count):
     # Because this is univariate, we need to reshape the array using -1,1 as our parameters.
@@ -394,13 +656,34 @@ def check_gaussian_mixture(col, best_fit_cluster_count):
             xdf.loc[xdf['value']==xdf_g.iloc[r,0], "far_off"]=xdf_g.iloc[r,4]
     return [max(sc, fo) for (sc, fo) in zip(xdf["small_cluster"], xdf["far_off"])]
 
+def check_gaussian_mixture_arrays(values, gm_model):
+    # check_gaussian_mixture on an array, with the model already fit.  Equal values always land in
+    # the same cluster, so scoring each cluster's rows is the same as scoring its distinct values.
+    grp = gm_model.predict(values.reshape(-1,1))
+    # Clusters containing less than 5% of data will be marked as outliers.
+    min_num_items = math.ceil(values.shape[0] * .05)
+    small_cluster = np.zeros(values.shape[0])
+    far_off = np.zeros(values.shape[0])
+    for g in np.unique(grp):
+        in_group = (grp == g)
+        if np.count_nonzero(in_group) <= min_num_items:
+            small_cluster[in_group] = 1.0
+        calc = perform_statistical_calculations_arrays(values[in_group])
+        # If there is no spread within a cluster, we can't calculate MAD.
+        if calc["mad"] > 0.0:
+            far_off[in_group] = check_stat_arrays(values[in_group], calc["median"], calc["mad"], 3.0)
+    return np.maximum(small_cluster, far_off)
+
 def score_results(df, tests_run, weights):
     # Chapter 7:  add in normal distribution checks
     # Add in observation length tests (n <= 25 for Dixon, n >= 7 for Grubbs, n >= 15 for GESD)
     # Determine maximum weight, sum of weights of included tests, and proportionally allocate tests based on available weight
     # Ex:  max weight = 1.05.  Sum of tests = 0.8.  1.05 / 0.8 = 1.3125 * weights of individual tests will sum to 1.05.
     # Perform this calculation as a separate function
+    return df.assign(anomaly_score=calculate_anomaly_score(df, tests_run, weights))
 
+def calculate_anomaly_score(columns, tests_run, weights):
+    # columns is a DataFrame or a dictionary of arrays.
     # Because some tests do not run, we want to factor that into our anomaly score.
     tested_weights = {w: weights.get(w, 0) * tests_run.get(w, 0) for w in set(weights).union(tests_run)}
     max_weight = sum([tested_weights[w] for w in tested_weights])
@@ -408,21 +691,25 @@ def score_results(df, tests_run, weights):
     # If a test was not run, its tests_run[] result will be 0, so we won't include it in our score.
     # If we divide by max weight, we end up with possible values of [0-1].
     # Multiplying by 0.95 makes it a little more likely that we mark an item as an outlier.
-    return df.assign(anomaly_score=(
-       df['sds'] * tested_weights['sds'] +
-       df['iqrs'] * tested_weights['iqrs'] +
-       df['mads'] * tested_weights['mads'] +
-       df['grubbs'] * tested_weights['grubbs'] +
-       df['gesd'] * tested_weights['gesd'] +
-       df['dixon'] * tested_weights['dixon'] +
-       df['gaussian_mixture'] * tested_weights['gaussian_mixture']
-    ) / (max_weight * 0.95))
+    return (
+       columns['sds'] * tested_weights['sds'] +
+       columns['iqrs'] * tested_weights['iqrs'] +
+       columns['mads'] * tested_weights['mads'] +
+       columns['grubbs'] * tested_weights['grubbs'] +
+       columns['gesd'] * tested_weights['gesd'] +
+       columns['dixon'] * tested_weights['dixon'] +
+       columns['gaussian_mixture'] * tested_weights['gaussian_mixture']
+    ) / (max_weight * 0.95)
 
 def determine_outliers(
-    df,
+    anomaly_score,
     sensitivity_score,
     max_fraction_anomalies
 ):
+    # anomaly_score is an array, and we return whether each entry is an outlier.
+    return anomaly_score >= get_outlier_threshold(anomaly_score, sensitivity_score, max_fraction_anomalies)
+
+def get_outlier_threshold(anomaly_score, sensitivity_score, max_fraction_anomalies):
     # Convert sensitivity score to be approximately the same
     # scale as anomaly score.  Note that sensitivity score is "reversed",
     # such that 100 is the *most* sensitive.
@@ -430,7 +717,7 @@ def determine_outliers(
     # Get the 100-Nth percentile of anomaly score.
     # Ex:  if max_fraction_anomalies = 0.1, get the
     # 90th percentile anomaly score.
-    max_fraction_anomaly_score = np.quantile(df['anomaly_score'], 1.0 - max_fraction_anomalies)
+    max_fraction_anomaly_score = np.quantile(anomaly_score, 1.0 - max_fraction_anomalies)
     # If the max fraction anomaly score is greater than
     # the sensitivity score, it means that we have MORE outliers
     # than our max_fraction_anomalies supports, and therefore we
@@ -438,4 +725,4 @@ def determine_outliers(
     # Otherwise, sensitivity score stays the same and we operate as normal.
     if max_fraction_anomaly_score > sensitivity_score and max_fraction_anomalies < 1.0:
         sensitivity_score = max_fraction_anomaly_score
-    return df.assign(is_anomaly=(df['anomaly_score'] >= sensitivity_score))
+    return sensitivity_score
@@ -0,0 +1,84 @@
+# Finding Ghosts in Your Data
+# Response serialization for the anomaly detection endpoints.
+# pandas writes records-oriented JSON in C, so we pass its output straight through rather than
+# parsing it back into Python objects for FastAPI to serialize a second time.
+
+import json
+import numpy as np
+import pandas as pd
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+from . import metrics
+from .models import timing
+
+def records_json(df, date_format=None):
+    # NaN becomes null and dates use the same ISO format as before.  force_ascii=False matches FastAPI,
+    # which writes non-ASCII characters as they are rather than escaping them.
+    if date_format is None:
+        return df.to_json(orient='records', force_ascii=False)
+    return df.to_json(orient='records', date_format=date_format, force_ascii=False)
+
+def value_json(value):
+    # Weights and debug details are small, so encode them exactly the way FastAPI would.
+    return json.dumps(jsonable_encoder(value), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":"))
+
+def timings_json(timings):
+    return ',"debug_timings":' + value_json(timings) if timings is not None else ''
+
+def detection_json(df, weights, details, debug, date_format=None, timings=None):
+    body = '{"anomalies":' + records_json(df, date_format)
+    if (debug):
+        body += ',"debug_weights":' + value_json(weights)
+        body += ',"debug_details":' + value_json(details)
+        body += timings_json(timings)
+    return body + '}'
+
+def detection_batch_json(batch_results, debug, date_format=None, timings=None):
+    # batch_results maps each series ID to a (df, weights, details) tuple.  Each series runs in a worker
+    # process, so timings cover the batch as a whole.
+    series_json = [value_json(series_id) + ':' + detection_json(df, weights, details, debug, date_format)
+        for series_id, (df, weights, details) in batch_results.items()]
+    return '{"results":{' + ','.join(series_json) + '}' + (timings_json(timings) if debug else '') + '}'
+
+def threshold_json(threshold):
+    # The settings are small, but the per-row arrays are as long as the input, so let pandas write those.
+    parts = [value_json(k) + ':' + (pd.Series(v).to_json(orient='values') if isinstance(v, np.ndarray) else value_json(v))
+        for (k, v) in threshold.items()]
+    return '{' + ','.join(parts) + '}'
+
+def sweep_json(df, weights, details, thresholds, debug, date_format=None, timings=None):
+    # The thresholds line up with the anomalies, row for row.
+    body = '{"anomalies":' + records_json(df, date_format)
+    body += ',"thresholds":[' + ','.join(threshold_json(t) for t in thresholds) + ']'
+    if (debug):
+        body += ',"debug_weights":' + value_json(weights)
+        body += ',"debug_details":' + value_json(details)
+        body += timings_json(timings)
+    return body + '}'
+
+def run_detector(detect, data, debug):
+    # With debug on, time each stage of the detector as it runs.
+    with timing.collect(debug) as timings:
+        with timing.stage("detect"):
+            result = detect(data)
+    metrics.count_tests(result)
+    return (result, timings)
+
+def detect_json(detect, df, debug, date_format=None):
+    # Run a detector and encode its result in one step, so that a worker process can do both
+    # and send back a single string rather than the result DataFrame.
+    ((df, weights, details), timings) = run_detector(detect, df, debug)
+    return detection_json(df, weights, details, debug, date_format, timings)
+
+def detect_batch_json(detect_batch, series, debug, date_format=None):
+    (batch_results, timings) = run_detector(detect_batch, series, debug)
+    return detection_batch_json(batch_results, debug, date_format, timings)
+
+def detect_sweep_json(detect_sweep, df, debug, date_format=None):
+    (result, timings) = run_detector(detect_sweep, df, debug)
+    return sweep_json(*result, debug, date_format, timings)
+
+def json_response(body):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return Response(content=body, media_type="application/json")
@@ -0,0 +1,98 @@
+# Finding Ghosts in Your Data
+# Apache Arrow IPC and Parquet input and output for bulk detection.
+# Offline scoring jobs send far more rows than interactive callers, and JSON is the slow part both on the
+# wire and in parsing.  Arrow tables carry typed columns, so numeric and timestamp columns without nulls
+# become the NumPy arrays the models use without a copy.
+
+import io
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+import pandas as pd
+from fastapi import HTTPException, Response
+from . import serialization
+
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+PARQUET = "application/vnd.apache.parquet"
+JSON = "application/json"
+# Older clients still send the unregistered Parquet type.
+TABLE_MEDIA_TYPES = { ARROW_STREAM: ARROW_STREAM, PARQUET: PARQUET, "application/x-parquet": PARQUET }
+
+def get_media_type(header):
+    # Drop parameters such as charset and take the first type we know about.
+    for media_type in (header or "").split(","):
+        media_type = media_type.split(";")[0].strip().lower()
+        if media_type in TABLE_MEDIA_TYPES:
+            return TABLE_MEDIA_TYPES[media_type]
+    return None
+
+def get_response_media_type(accept):
+    # Results come back as JSON unless the caller asks for a table.
+    return get_media_type(accept) or JSON
+
+def read_table(body, content_type):
+    media_type = get_media_type(content_type)
+    if media_type is None:
+        raise HTTPException(status_code=415, detail=f"Send an Arrow IPC stream ({ARROW_STREAM}) or a Parquet file ({PARQUET}).")
+    try:
+        if media_type == ARROW_STREAM:
+            return ipc.open_stream(pa.py_buffer(body)).read_all()
+        return pq.read_table(pa.BufferReader(body))
+    except (pa.ArrowInvalid, OSError) as e:
+        raise HTTPException(status_code=400, detail=f"Could not read the request body as {media_type}:  {e}")
+
+def column_to_numpy(column):
+    # Numeric and timestamp chunks without nulls convert in place; several chunks must be joined first.
+    if column.num_chunks == 1:
+        column = column.chunk(0)
+    else:
+        column = column.combine_chunks()
+    if pa.types.is_list(column.type) or pa.types.is_large_list(column.type) or pa.types.is_fixed_size_list(column.type):
+        # The multivariate model wants one list of values per row.
+        return column.to_pylist()
+    # Timestamps come back as UTC datetime64 values whatever their time zone.
+    return column.to_numpy(zero_copy_only=False)
+
+def table_to_dataframe(table, columns):
+    missing = [c for c in columns if c not in table.column_names]
+    if missing:
+        raise HTTPException(status_code=422, detail=f"The table must include the columns {columns}.  It is missing {missing}.")
+    df = pd.DataFrame({ c: column_to_numpy(table.column(c)) for c in columns }, copy=False)
+    if "dt" in columns and df["dt"].dtype.kind == "M":
+        df["dt"] = df["dt"].dt.tz_localize("UTC")
+    return df
+
+def read_dataframe(body, content_type, columns):
+    return table_to_dataframe(read_table(body, content_type), columns)
+
+def dataframe_to_table(df, weights, details, debug, timings=None):
+    # Arrow column names must be strings, and weights, details, and timings ride along as schema metadata.
+    table = pa.Table.from_pandas(df.rename(columns=str), preserve_index=False)
+    if (debug):
+        metadata = dict(table.schema.metadata or {})
+        metadata[b"debug_weights"] = serialization.value_json(weights).encode("utf-8")
+        metadata[b"debug_details"] = serialization.value_json(details).encode("utf-8")
+        if timings is not None:
+            metadata[b"debug_timings"] = serialization.value_json(timings).encode("utf-8")
+        table = table.replace_schema_metadata(metadata)
+    return table
+
+def write_table(table, media_type):
+    sink = io.BytesIO()
+    if media_type == ARROW_STREAM:
+        with ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        pq.write_table(table, sink)
+    return sink.getvalue()
+
+def detect_table(detect, df, debug, media_type, date_format=None):
+    # Like serialization.detect_json, run a detector and encode its result in one step so that a worker
+    # process sends back bytes rather than the result DataFrame.
+    ((df, weights, details), timings) = serialization.run_detector(detect, df, debug)
+    if media_type == JSON:
+        return serialization.detection_json(df, weights, details, debug, date_format, timings).encode("utf-8")
+    return write_table(dataframe_to_table(df, weights, details, debug, timings), media_type)
+
+def table_response(body, media_type):
+    return Response(content=body, media_type=media_type)
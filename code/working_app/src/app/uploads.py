@@ -0,0 +1,66 @@
+# Finding Ghosts in Your Data
+# CSV file uploads for the detection endpoints.
+# Most of our data starts out as CSV exports such as stock prices (Date, Open, High, Low, Close, ...).
+# Rather than turning a file into JSON on the client, callers upload it as multipart form data and tell us
+# which CSV column holds each field.  The upload lands in a temporary file, and we read it a chunk of rows
+# at a time, keeping only the columns we need as NumPy arrays.
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from fastapi import HTTPException
+
+# How many CSV rows to parse at a time.  Only one chunk of text is ever in memory.
+CHUNK_ROWS = 100000
+
+def convert_chunk(field, column):
+    if field in ("key", "series_key"):
+        # Keep pandas strings, which pack the text far tighter than one Python object per row.
+        return column.astype(str)
+    if field == "dt":
+        return pd.to_datetime(column, utc=True).to_numpy(dtype="datetime64[ns]")
+    return pd.to_numeric(column).to_numpy(dtype=np.float64)
+
+def concatenate(parts):
+    if not parts:
+        return np.empty(0)
+    if isinstance(parts[0], pd.Series):
+        return pd.concat(parts, ignore_index=True)
+    return np.concatenate(parts)
+
+def read_csv_columns(file, columns, chunk_rows=CHUNK_ROWS):
+    # columns maps each field to its CSV column, such as { "dt": "Date", "value": "Close" }.  For multivariate
+    # data, the "vals" field maps to a list of CSV columns.  If there is no "key" column, each row's key is its
+    # row number.
+    fields = { field: column for (field, column) in columns.items() if column is not None }
+    # The parser reads value columns straight into float64 arrays.  Keys and dates stay text until we convert them.
+    dtypes = {}
+    for (field, column) in fields.items():
+        for c in (column if isinstance(column, list) else [column]):
+            dtypes[c] = np.float64 if field in ("value", "vals") and dtypes.get(c, np.float64) is np.float64 else str
+    parts = { field: [] for field in fields }
+    try:
+        for chunk in pd.read_csv(file, usecols=list(dtypes), dtype=dtypes, chunksize=chunk_rows):
+            for (field, column) in fields.items():
+                if isinstance(column, list):
+                    parts[field].append(np.column_stack([convert_chunk(field, chunk[c]) for c in column]))
+                else:
+                    parts[field].append(convert_chunk(field, chunk[column]))
+    except pd.errors.EmptyDataError:
+        raise HTTPException(status_code=422, detail="The uploaded file has no data.")
+    except (ValueError, TypeError) as e:
+        # Missing columns, text in a numeric column, and dates we cannot parse all end up here.
+        raise HTTPException(status_code=422, detail=f"Could not read the uploaded file with columns {fields}:  {e}")
+
+    arrays = { field: concatenate(p) for (field, p) in parts.items() }
+    num_rows = len(next(iter(arrays.values()))) if arrays else 0
+    if "key" not in arrays:
+        # Arrow writes the numbers out as one packed string column, without a Python string for each row.
+        arrays = { "key": pa.array(np.arange(num_rows)).cast(pa.large_string()).to_pandas(), **arrays }
+    if "vals" in arrays:
+        # The multivariate model wants one list of values per row; each row is a view into the same matrix.
+        arrays["vals"] = list(arrays["vals"])
+    df = pd.DataFrame(arrays, copy=False)
+    if "dt" in df.columns:
+        df["dt"] = df["dt"].dt.tz_localize("UTC")
+    return df[[c for c in ["key", "series_key", "dt", "value", "vals"] if c in df.columns]]
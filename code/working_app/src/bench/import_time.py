@@ -0,0 +1,46 @@
+# Measure how long the service and each detector module take to import in a fresh interpreter, which is
+# what a new server process or a respawned worker pays before its first call.  Each module is timed
+# twice:  on its own, and on top of pandas and NumPy, which every endpoint needs anyway.
+# Run from the src directory:  python bench/import_time.py [repeats]
+
+import os
+import re
+import sys
+import subprocess
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parents[1]
+MODULES = ["app.main", "app.models.univariate", "app.models.multivariate", "app.models.single_timeseries",
+    "app.models.multi_timeseries", "app.models.sliding_multi_timeseries", "app.models.streaming_timeseries",
+    "app.models.time_buckets"]
+BASELINE = "import numpy, pandas"
+
+def import_times(statement, depth=0):
+    # -X importtime writes one line per module to stderr:  self and cumulative microseconds, then the
+    # name, indented two spaces per level, children before their parent.  Returns the cumulative seconds
+    # of each import at the given depth (0 for the imports in the statement itself), in order.
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], cwd=SRC,
+        capture_output=True, text=True, check=True, env={ **os.environ, "PYTHONPATH": str(SRC) })
+    lines = [re.match(r"import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)", l) for l in result.stderr.splitlines()]
+    return [(m.group(3), int(m.group(1)) / 1e6) for m in lines if m is not None and len(m.group(2)) == 1 + 2 * depth]
+
+def import_seconds(statement):
+    return sum(seconds for (name, seconds) in import_times(statement))
+
+def heaviest(module, n=3):
+    # The slowest libraries the module imports directly, on top of the baseline.  Anything numpy or
+    # pandas brought in has already been counted, so it does not show up again here.
+    times = [t for t in import_times(f"{BASELINE}; import {module}", depth=1)
+        if not t[0].startswith(("app", "numpy", "pandas")) and t[0] not in ("__future__", "dateutil")]
+    return ", ".join(f"{name} {seconds:.2f}s" for (name, seconds) in sorted(times, key=lambda t: -t[1])[:n])
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    # Take the best of a few runs, since the first run also warms the disk cache.
+    baseline = min(import_seconds(BASELINE) for _ in range(repeats))
+    print(f"{'module':<40} {'alone':>8} {'after pandas':>13}   heaviest imports")
+    print(f"{'numpy + pandas':<40} {baseline:>7.2f}s")
+    for module in MODULES:
+        alone = min(import_seconds(f"import {module}") for _ in range(repeats))
+        after = min(import_seconds(f"{BASELINE}; import {module}") for _ in range(repeats)) - baseline
+        print(f"{module:<40} {alone:>7.2f}s {after:>12.2f}s   {heaviest(module)}")
@@ -0,0 +1,68 @@
+# Measure the throughput and latency of many small univariate calls arriving at once, with micro-batching
+# off and then on, through the same execution layer and worker processes the API uses.
+# Run from the src directory:  python bench/micro_batching.py [concurrent calls] [wait ms] [max batch size]
+
+import os
+import sys
+import time
+import asyncio
+import warnings
+from pathlib import Path
+from functools import partial
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from app import batching, execution, serialization
+from app.models import pool, univariate
+
+class BenchRequest:
+    # Stands in for the FastAPI request:  the client never leaves.
+    scope = { "path": "/detect/univariate" }
+
+    async def is_disconnected(self):
+        return False
+
+def make_input(num_rows, seed):
+    rng = np.random.default_rng(seed)
+    values = rng.normal(10.0, 2.0, num_rows)
+    values[num_rows // 2] = 40.0
+    return pd.DataFrame({ "key": [str(i) for i in range(num_rows)], "value": values })
+
+async def run_calls(inputs):
+    detect = partial(univariate.detect_univariate_statistical, sensitivity_score=50, max_fraction_anomalies=1.0, latency_budget_ms=None)
+    async def timed(df):
+        start = time.perf_counter()
+        await batching.run_batched(BenchRequest(), "univariate", serialization.detect_json, detect, df, False)
+        return time.perf_counter() - start
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*[timed(df) for df in inputs])
+    return (time.perf_counter() - start, latencies)
+
+def measure(inputs, wait_ms, max_size):
+    os.environ["DETECTOR_BATCH_MAX_WAIT_MS"] = str(wait_ms)
+    os.environ["DETECTOR_BATCH_MAX_SIZE"] = str(max_size)
+    batching._batchers.clear()
+    execution._limiters.clear()
+    asyncio.run(run_calls(inputs[:4]))
+    batching._batchers.clear()
+    execution._limiters.clear()
+    (elapsed, latencies) = asyncio.run(run_calls(inputs))
+    return (len(inputs) / elapsed, 1000.0 * float(np.median(latencies)), 1000.0 * float(np.percentile(latencies, 99)))
+
+if __name__ == "__main__":
+    # Worker processes inherit the environment, not this process's warning filters.
+    warnings.simplefilter("ignore")
+    os.environ["PYTHONWARNINGS"] = "ignore"
+    num_calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    wait_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+    max_size = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+    pool.warm_up()
+    print(f"{pool.get_num_workers()} workers, {num_calls} concurrent calls")
+    print(f"{'rows':>6} {'batching':>9} {'calls/s':>9} {'p50':>9} {'p99':>9}")
+    for num_rows in [15, 50, 200]:
+        inputs = [make_input(num_rows, seed) for seed in range(num_calls)]
+        for (label, wait) in [("off", 0), (f"{wait_ms:g}ms", wait_ms)]:
+            (throughput, p50, p99) = measure(inputs, wait, max_size)
+            print(f"{num_rows:>6} {label:>9} {throughput:>9.0f} {p50:>7.1f}ms {p99:>7.1f}ms")
+    pool.reset_executor()
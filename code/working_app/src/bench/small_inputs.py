@@ -0,0 +1,49 @@
+# Measure the median latency of small univariate detection calls, from the input DataFrame to the JSON
+# response body, which is the work a worker process does for each call.  Each size runs once on the
+# DataFrame path and once on the NumPy path for small inputs, over the same data.
+# Run from the src directory:  python bench/small_inputs.py [repeats]
+
+import sys
+import time
+import warnings
+from pathlib import Path
+from functools import partial
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from app import serialization
+from app.models import univariate
+
+SIZES = [15, 25, 50, 100, 200]
+
+def make_input(num_rows, seed=0):
+    # Normal data with a single outlier, which runs every test the size allows.
+    rng = np.random.default_rng(seed)
+    values = rng.normal(10.0, 2.0, num_rows)
+    values[num_rows // 2] = 40.0
+    return pd.DataFrame({ "key": [str(i) for i in range(num_rows)], "value": values })
+
+def median_ms(df, repeats, small_input_rows):
+    univariate.SMALL_INPUT_ROWS = small_input_rows
+    detect = partial(univariate.detect_univariate_statistical, sensitivity_score=50, max_fraction_anomalies=1.0)
+    serialization.detect_json(detect, df.copy(), False)
+    times = []
+    for _ in range(repeats):
+        data = df.copy()
+        start = time.perf_counter()
+        serialization.detect_json(detect, data, False)
+        times.append(time.perf_counter() - start)
+    return 1000.0 * float(np.median(times))
+
+if __name__ == "__main__":
+    warnings.simplefilter("ignore")
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    default = univariate.SMALL_INPUT_ROWS
+    print(f"{'rows':>6} {'DataFrame p50':>14} {'NumPy p50':>10} {'speedup':>8}")
+    for num_rows in SIZES:
+        df = make_input(num_rows)
+        dataframe = median_ms(df, repeats, 0)
+        arrays = median_ms(df, repeats, default)
+        print(f"{num_rows:>6} {dataframe:>12.2f}ms {arrays:>8.2f}ms {dataframe / arrays:>7.2f}x")
+    univariate.SMALL_INPUT_ROWS = default
@@ -0,0 +1,70 @@
+from src.app import admission
+from src.app.models import univariate, multivariate, single_timeseries, streaming_timeseries, time_buckets
+from functools import partial
+import asyncio
+import pandas as pd
+import pytest
+
+def generate_frame(num_rows):
+    return pd.DataFrame({ "key": [str(i) for i in range(num_rows)], "value": [0.0] * num_rows })
+
+@pytest.mark.parametrize("detect, num_rows, min_seconds, max_seconds", [
+    (partial(univariate.detect_univariate_statistical, sensitivity_score=50, max_fraction_anomalies=1.0), 14, 0, 0.01),
+    (partial(multivariate.detect_multivariate_statistical, sensitivity_score=50, max_fraction_anomalies=1.0, n_neighbors=10), 1000, 500, 1500),
+    (partial(multivariate.detect_multivariate_statistical, sensitivity_score=50, max_fraction_anomalies=1.0, n_neighbors=10, latency_budget_ms=2000), 1000, 0, 2),
+    (partial(multivariate.detect_multivariate_statistical, sensitivity_score=50, max_fraction_anomalies=1.0, n_neighbors=10), 1001, 1, 100),
+    (partial(single_timeseries.detect_single_timeseries, sensitivity_score=50, max_fraction_anomalies=1.0), 10000, 10, 100),
+    (partial(single_timeseries.detect_single_timeseries, sensitivity_score=50, max_fraction_anomalies=1.0, multi_resolution=True), 10000, 0, 1),
+    (partial(single_timeseries.detect_single_timeseries, sensitivity_score=50, max_fraction_anomalies=1.0, latency_budget_ms=2000), 10000, 0, 2),
+    (partial(streaming_timeseries.detect_single_timeseries_stream, "s1", sensitivity_score=50, max_fraction_anomalies=1.0), 20000, 1, 30),
+    (partial(time_buckets.detect_with_time_buckets, aggregation_interval="1h", aggregation_function="mean",
+        detect=partial(single_timeseries.detect_single_timeseries, sensitivity_score=50, max_fraction_anomalies=1.0)), 10000, 10, 100),
+])
+def test_estimate_cost_follows_model_thresholds(detect, num_rows, min_seconds, max_seconds):
+    # Arrange
+    df = generate_frame(num_rows)
+    # Act
+    cost = admission.estimate_cost(detect, df)
+    # Assert:  LOCI stops at 1000 rows, multi-resolution search makes KernelCPD close to linear, a latency
+    # budget gives up the most expensive tests, and streaming is linear in the length of the update.
+    assert(min_seconds < cost.cpu_seconds < max_seconds)
+
+def test_estimate_cost_ignores_other_calls():
+    # Arrange
+    # Act
+    cost = admission.estimate_cost(sum, [1, 2, 3])
+    # Assert
+    assert(cost == admission.NO_COST)
+
+def test_admission_controller_rejects_oversized_call():
+    # Arrange
+    controller = admission.AdmissionController(10, 1000, 5, 1, 1)
+    # Act
+    with pytest.raises(admission.Rejected) as e:
+        asyncio.run(controller.admit(admission.Cost(6, 10)))
+    # Assert
+    assert(e.value.status_code == 503)
+
+def test_admission_controller_queues_then_rejects():
+    # Arrange:  the budget has room for one call at a time, and one call may wait.
+    controller = admission.AdmissionController(10, 1000, 10, 1, 0.2)
+    cost = admission.Cost(8, 10)
+    async def admit_calls():
+        await controller.admit(cost)
+        waiting = asyncio.ensure_future(controller.admit(cost))
+        await asyncio.sleep(0.05)
+        with pytest.raises(admission.Rejected) as too_many:
+            await controller.admit(cost)
+        controller.release(cost)
+        await waiting
+        status = controller.get_status()
+        with pytest.raises(admission.Rejected) as too_long:
+            await controller.admit(cost)
+        return (status, too_many.value, too_long.value)
+    # Act
+    (status, too_many, too_long) = asyncio.run(admit_calls())
+    # Assert
+    assert(too_many.status_code == 429)
+    assert(too_long.status_code == 503)
+    assert(status["running"] == 1 and status["waiting"] == 0 and status["queued"] == 1)
+    assert(status["cpu_seconds_in_flight"] == 8)
@@ -0,0 +1,96 @@
+from src.app import batching, execution, serialization
+from src.app.models import univariate
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import time
+import pandas as pd
+import pytest
+
+class FakeRequest:
+    def __init__(self, disconnect_after=None):
+        self.start = time.monotonic()
+        self.disconnect_after = disconnect_after
+        self.scope = { "path": "/detect/univariate" }
+
+    async def is_disconnected(self):
+        return self.disconnect_after is not None and time.monotonic() - self.start >= self.disconnect_after
+
+def make_call(i, num_rows=20):
+    df = pd.DataFrame({ "key": [str(k) for k in range(num_rows)], "value": [float((k * (i + 3)) % 11) for k in range(num_rows - 1)] + [60.0 + i] })
+    detect = partial(univariate.detect_univariate_statistical, sensitivity_score=50, max_fraction_anomalies=1.0, latency_budget_ms=None)
+    return (detect, df)
+
+@pytest.fixture(autouse=True)
+def fresh_batchers(monkeypatch):
+    # Each test runs its own event loop, so each needs its own batchers and semaphores.  Run batches on a
+    # thread pool, so that we can count the groups.
+    monkeypatch.setattr(batching, "_batchers", {})
+    monkeypatch.setattr(execution, "_limiters", {})
+    groups = []
+    run_group = batching.run_group
+    def count_group(calls):
+        groups.append(len(calls))
+        return run_group(calls)
+    monkeypatch.setattr(batching, "run_group", count_group)
+    monkeypatch.setattr(batching.pool, "get_executor", lambda: execution.get_thread_executor())
+    return groups
+
+def test_run_batched_groups_concurrent_calls(monkeypatch, fresh_batchers):
+    # Arrange
+    monkeypatch.setenv("DETECTOR_BATCH_MAX_WAIT_MS", "50")
+    monkeypatch.setenv("DETECTOR_BATCH_MAX_SIZE", "32")
+    calls = [make_call(i) for i in range(5)]
+    async def run_calls():
+        return await asyncio.gather(*[batching.run_batched(FakeRequest(), "univariate", serialization.detect_json, detect, df.copy(), False) for (detect, df) in calls])
+    # Act
+    bodies = asyncio.run(run_calls())
+    # Assert:  one group, and each caller gets the body it would have had on its own.
+    assert(fresh_batchers == [5])
+    assert(bodies == [serialization.detect_json(detect, df.copy(), False) for (detect, df) in calls])
+
+def test_run_batched_flushes_at_max_size(monkeypatch, fresh_batchers):
+    # Arrange
+    monkeypatch.setenv("DETECTOR_BATCH_MAX_WAIT_MS", "10000")
+    monkeypatch.setenv("DETECTOR_BATCH_MAX_SIZE", "2")
+    calls = [make_call(i) for i in range(4)]
+    async def run_calls():
+        return await asyncio.gather(*[batching.run_batched(FakeRequest(), "univariate", serialization.detect_json, detect, df, False) for (detect, df) in calls])
+    # Act
+    start = time.monotonic()
+    asyncio.run(run_calls())
+    elapsed = time.monotonic() - start
+    # Assert:  full batches never wait for the timer.
+    assert(fresh_batchers == [2, 2])
+    assert(elapsed < 5)
+
+@pytest.mark.parametrize("wait_ms, debug, num_rows, expected", [
+    ("5", False, 20, True),
+    ("0", False, 20, False),
+    ("5", True, 20, False),
+    ("5", False, 201, False),
+])
+def test_can_batch(monkeypatch, wait_ms, debug, num_rows, expected):
+    # Arrange
+    monkeypatch.setenv("DETECTOR_BATCH_MAX_WAIT_MS", wait_ms)
+    (detect, df) = make_call(0, num_rows)
+    # Act
+    result = batching.can_batch(serialization.detect_json, (detect, df, debug))
+    # Assert
+    assert(result == expected)
+
+def test_run_batched_leaves_out_disconnected_callers(monkeypatch, fresh_batchers):
+    # Arrange
+    monkeypatch.setenv("DETECTOR_BATCH_MAX_WAIT_MS", "300")
+    calls = [make_call(i) for i in range(2)]
+    async def run_calls():
+        first = batching.run_batched(FakeRequest(), "univariate", serialization.detect_json, *calls[0], False)
+        second = batching.run_batched(FakeRequest(disconnect_after=0.1), "univariate", serialization.detect_json, *calls[1], False)
+        return await asyncio.gather(first, second, return_exceptions=True)
+    # Act
+    (first, second) = asyncio.run(run_calls())
+    # Assert
+    assert(first == serialization.detect_json(*calls[0], False))
+    assert(isinstance(second, execution.ClientDisconnected))
+    assert(fresh_batchers == [1])
+    assert(batching.admission.get_controller().get_status()["cpu_seconds_in_flight"] == 0)
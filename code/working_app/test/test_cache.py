@@ -0,0 +1,109 @@
+from src.app.cache import *
+from src.app.models.univariate import detect_univariate_statistical
+import asyncio
+import datetime
+import src.app.cache
+import pytest
+
+def generate_frame(dt_as_objects=False):
+    dt = pd.date_range("2021-12-11", periods=5, freq="min", tz="UTC")
+    if dt_as_objects:
+        dt = [d.to_pydatetime() for d in dt]
+    return pd.DataFrame({ "key": ["a", "b", "c", "d", "e"], "dt": dt, "value": [1, 2, 3, 4, 5] })
+
+def test_result_cache_evicts_least_recently_used():
+    # Arrange
+    cache = ResultCache(10, 60)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    cache.get("a")
+    # Act
+    cache.put("c", b"1234")
+    # Assert
+    assert(cache.get("a") == b"1234")
+    assert(cache.get("b") is None)
+    assert(cache.get_stats()["bytes"] == 8)
+    assert(cache.get_stats()["evictions"] == 1)
+
+def test_result_cache_expires_entries():
+    # Arrange
+    cache = ResultCache(100, 0.05)
+    cache.put("a", b"1234")
+    # Act
+    time.sleep(0.1)
+    # Assert
+    assert(cache.get("a") is None)
+    assert(cache.get_stats()["bytes"] == 0)
+
+def test_result_cache_shares_disk_tier(tmp_path):
+    # Arrange:  two processes' caches pointing at the same directory.
+    first = ResultCache(100, 60, str(tmp_path))
+    second = ResultCache(100, 60, str(tmp_path))
+    # Act
+    first.put("a", b"1234")
+    # Assert
+    assert(second.get("a") == b"1234")
+    assert(second.get_stats()["disk_hits"] == 1)
+
+@pytest.mark.parametrize("other, same", [
+    (generate_frame(dt_as_objects=True), True),
+    (generate_frame().astype({ "value": float }), True),
+    (generate_frame().assign(value=[1, 2, 3, 4, 6]), False),
+    (generate_frame().assign(key=["a", "b", "c", "d", "f"]), False),
+])
+def test_get_key_hashes_values(other, same):
+    # Arrange
+    detect = partial(detect_univariate_statistical, sensitivity_score=50, max_fraction_anomalies=1.0)
+    # Act
+    key = get_key("univariate", detect, generate_frame(), False)
+    other_key = get_key("univariate", detect, other, False)
+    # Assert
+    assert((key == other_key) == same)
+
+@pytest.mark.parametrize("sensitivity_score, debug, same", [
+    (50, False, True),
+    (60, False, False),
+    (50, True, False),
+])
+def test_get_key_includes_parameters(sensitivity_score, debug, same):
+    # Arrange
+    detect = partial(detect_univariate_statistical, sensitivity_score=50, max_fraction_anomalies=1.0)
+    other = partial(detect_univariate_statistical, sensitivity_score=sensitivity_score, max_fraction_anomalies=1.0)
+    # Act
+    key = get_key("univariate", detect, generate_frame(), False)
+    other_key = get_key("univariate", other, generate_frame(), debug)
+    # Assert
+    assert((key == other_key) == same)
+
+@pytest.mark.parametrize("use_cache, expected_calls", [(True, 1), (False, 2)])
+def test_cached_runs_once(monkeypatch, use_cache, expected_calls):
+    # Arrange
+    monkeypatch.setattr(src.app.cache, "_cache", ResultCache(10000, 60))
+    calls = []
+    async def run(request, endpoint, f, df):
+        calls.append(endpoint)
+        return f(df)
+    async def run_twice():
+        return [await cached(use_cache, run, None, "cached", lambda df: df.to_json(date_format="iso"), generate_frame()) for i in range(2)]
+    # Act
+    (first, second) = asyncio.run(run_twice())
+    # Assert
+    assert(first == second)
+    assert(isinstance(first, bytes))
+    assert(len(calls) == expected_calls)
+
+@pytest.mark.parametrize("debug, expected_calls", [(False, 1), (True, 2)])
+def test_cached_always_runs_debug_calls(monkeypatch, debug, expected_calls):
+    # Arrange
+    monkeypatch.setattr(src.app.cache, "_cache", ResultCache(10000, 60))
+    calls = []
+    detect = partial(detect_univariate_statistical, sensitivity_score=50, max_fraction_anomalies=1.0)
+    async def run(request, endpoint, f, detect, df, debug):
+        calls.append(endpoint)
+        return f(df)
+    async def run_twice():
+        return [await cached(True, run, None, "cached", lambda df: df.to_json(date_format="iso"), detect, generate_frame(), debug) for i in range(2)]
+    # Act
+    asyncio.run(run_twice())
+    # Assert:  debug timings describe each run, so they never come from the cache.
+    assert(len(calls) == expected_calls)
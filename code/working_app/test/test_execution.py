@@ -0,0 +1,62 @@
+from src.app import execution
+import asyncio
+import time
+import pytest
+
+class FakeRequest:
+    def __init__(self, disconnect_after=None):
+        self.start = time.monotonic()
+        self.disconnect_after = disconnect_after
+
+    async def is_disconnected(self):
+        return self.disconnect_after is not None and time.monotonic() - self.start >= self.disconnect_after
+
+def sleep_and_return(seconds, value):
+    time.sleep(seconds)
+    return value
+
+@pytest.fixture(autouse=True)
+def fresh_limiters(monkeypatch):
+    # Each test runs its own event loop, so each needs its own semaphores.
+    monkeypatch.setattr(execution, "_limiters", {})
+
+def test_run_in_thread_honors_endpoint_limit(monkeypatch):
+    # Arrange
+    monkeypatch.setenv("DETECTOR_MAX_CONCURRENT_LIMITED", "1")
+    async def run_calls():
+        calls = [asyncio.ensure_future(execution.run_in_thread(FakeRequest(), "limited", sleep_and_return, 0.2, i)) for i in range(3)]
+        await asyncio.sleep(0.1)
+        status = execution.get_queue_status()["limited"]
+        return (await asyncio.gather(*calls), status)
+    # Act
+    (results, status) = asyncio.run(run_calls())
+    # Assert
+    assert(results == [0, 1, 2])
+    assert(status == { "limit": 1, "running": 1, "waiting": 2 })
+    assert(execution.get_queue_status()["limited"] == { "limit": 1, "running": 0, "waiting": 0 })
+
+def test_run_in_thread_cancels_waiting_call_on_disconnect(monkeypatch):
+    # Arrange
+    monkeypatch.setenv("DETECTOR_MAX_CONCURRENT_CANCELLED", "1")
+    async def run_calls():
+        first = asyncio.ensure_future(execution.run_in_thread(FakeRequest(), "cancelled", sleep_and_return, 0.3, "first"))
+        second = asyncio.ensure_future(execution.run_in_thread(FakeRequest(disconnect_after=0.1), "cancelled", sleep_and_return, 0.3, "second"))
+        return await asyncio.gather(first, second, return_exceptions=True)
+    # Act
+    start = time.monotonic()
+    (first, second) = asyncio.run(run_calls())
+    elapsed = time.monotonic() - start
+    # Assert:  the second call never ran, so we did not wait for it.
+    assert(first == "first")
+    assert(isinstance(second, execution.ClientDisconnected))
+    assert(elapsed < 0.5)
+    assert(execution.get_queue_status()["cancelled"] == { "limit": 1, "running": 0, "waiting": 0 })
+
+def test_run_in_process_returns_result():
+    # Arrange
+    async def run_call():
+        return await execution.run_in_process(FakeRequest(), "process", sum, [1, 2, 3])
+    # Act
+    result = asyncio.run(run_call())
+    # Assert
+    assert(result == 6)
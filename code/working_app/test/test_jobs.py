@@ -0,0 +1,82 @@
+from src.app.jobs import *
+from src.app import metrics, serialization
+from src.app.models import univariate
+from functools import partial
+import pandas as pd
+import pytest
+
+def sleep_and_return(seconds, value):
+    time.sleep(seconds)
+    return value
+
+def fail():
+    raise ValueError("bad input")
+
+def wait_for(queue, job, timeout=10):
+    start = time.monotonic()
+    while not job.is_finished() and time.monotonic() - start < timeout:
+        time.sleep(0.01)
+    return queue.get_status(job)
+
+@pytest.mark.parametrize("in_process, f, args, expected_status, expected_body", [
+    (False, sleep_and_return, (0.01, '{"anomalies":[]}'), "succeeded", b'{"anomalies":[]}'),
+    (True, sum, ([1, 2, 3],), "succeeded", 6),
+    (False, fail, (), "failed", None),
+])
+def test_job_queue_runs_job(in_process, f, args, expected_status, expected_body):
+    # Arrange
+    queue = JobQueue(1, 10, 60, 10)
+    # Act
+    job = queue.submit("test", in_process, f, *args)
+    status = wait_for(queue, job)
+    # Assert
+    assert(status["status"] == expected_status)
+    assert(queue.get(job.job_id).body == expected_body)
+    assert(("error" in status) == (expected_status == "failed"))
+
+def test_job_queue_bounds_queue_and_cancels():
+    # Arrange:  one job runs, two wait, and the queue holds two.
+    queue = JobQueue(1, 2, 60, 10)
+    running = queue.submit("test", False, sleep_and_return, 0.3, "running")
+    time.sleep(0.05)
+    waiting = [queue.submit("test", False, sleep_and_return, 0, "waiting") for i in range(2)]
+    # Act
+    with pytest.raises(JobQueueFull):
+        queue.submit("test", False, sleep_and_return, 0, "rejected")
+    positions = [queue.get_status(job)["queue_position"] for job in waiting]
+    cancelled = queue.cancel(waiting[0].job_id)
+    # Assert
+    assert(positions == [0, 1])
+    assert(queue.get_status(cancelled)["status"] == "cancelled")
+    assert(queue.cancel(running.job_id).status == "running")
+    assert(wait_for(queue, waiting[1])["status"] == "succeeded")
+    assert(wait_for(queue, running)["status"] == "succeeded")
+
+@pytest.mark.parametrize("ttl_seconds, max_stored, expected_remaining", [
+    (0, 10, 0),
+    (60, 1, 1),
+    (60, 10, 3),
+])
+def test_job_queue_removes_finished_jobs(ttl_seconds, max_stored, expected_remaining):
+    # Arrange
+    queue = JobQueue(1, 10, ttl_seconds, max_stored)
+    submitted = [queue.submit("test", False, sleep_and_return, 0, i) for i in range(3)]
+    for job in submitted:
+        wait_for(queue, job)
+    # Act
+    remaining = [job for job in submitted if queue.get(job.job_id) is not None]
+    # Assert:  the newest jobs are the ones kept.
+    assert(len(remaining) == expected_remaining)
+    assert(remaining == submitted[len(submitted) - expected_remaining:])
+
+def test_job_queue_counts_tests_run():
+    # Arrange
+    queue = JobQueue(1, 10, 60, 10)
+    detect = partial(univariate.detect_univariate_statistical, sensitivity_score=50, max_fraction_anomalies=1.0)
+    df = pd.DataFrame({ "key": [str(i) for i in range(20)], "value": [float(i % 5) for i in range(19)] + [40.0] })
+    # Act
+    job = queue.submit("job_counted", False, serialization.detect_json, detect, df, False)
+    status = wait_for(queue, job)
+    # Assert
+    assert(status["status"] == "succeeded")
+    assert(metrics.tests_total.values.get(("job_counted", "sds"), 0) == 1)
@@ -0,0 +1,44 @@
+from src.app.lazy import *
+from src.app.models import pool
+import pytest
+
+def test_module_imports_on_first_attribute():
+    # Arrange
+    colorsys = module("colorsys")
+    # Act
+    loaded_before = colorsys.is_loaded()
+    hsv = colorsys.rgb_to_hsv(1.0, 0.0, 0.0)
+    # Assert
+    assert(loaded_before == False)
+    assert(colorsys.is_loaded() == True)
+    assert(hsv == (0.0, 1.0, 1.0))
+
+def test_module_raises_for_missing_attribute():
+    # Arrange
+    colorsys = module("colorsys")
+    # Act
+    # Assert
+    with pytest.raises(AttributeError):
+        colorsys.not_a_function
+
+@pytest.mark.parametrize("setting, expected", [
+    ("", []),
+    ("all", pool.DETECTOR_MODULES),
+    ("univariate", ["univariate"]),
+    (" univariate, single_timeseries ,", ["univariate", "single_timeseries"]),
+])
+def test_get_warmup_modules(monkeypatch, setting, expected):
+    # Arrange
+    monkeypatch.setenv("DETECTOR_WARMUP", setting)
+    # Act
+    names = pool.get_warmup_modules()
+    # Assert
+    assert(names == expected)
+
+def test_get_warmup_modules_rejects_unknown_modules(monkeypatch):
+    # Arrange
+    monkeypatch.setenv("DETECTOR_WARMUP", "univariate,not_a_detector")
+    # Act
+    # Assert
+    with pytest.raises(ValueError):
+        pool.get_warmup_modules()
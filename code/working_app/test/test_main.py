@@ -0,0 +1,104 @@
+import sys
+from pathlib import Path
+# The API imports its own package as app, the way the server runs it.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+from app import admission, execution, main
+from app.models import multivariate, pool
+from fastapi.testclient import TestClient
+import datetime
+import time
+import numpy as np
+import pytest
+
+def generate_multivariate(num_rows):
+    rng = np.random.default_rng(0)
+    return [{ "key": str(i), "vals": rng.normal(0.0, 1.0, 3).tolist() } for i in range(num_rows)]
+
+def generate_single_timeseries(num_rows):
+    rng = np.random.default_rng(0)
+    start = datetime.datetime(2024, 1, 1)
+    return [{ "key": str(i), "dt": (start + datetime.timedelta(minutes=i)).isoformat(), "value": float(v) }
+        for (i, v) in enumerate(rng.normal(10.0, 1.0, num_rows))]
+
+@pytest.fixture
+def client(monkeypatch):
+    # Run detectors on a thread pool in this process, and give each test its own limiters and admission
+    # controller, since each test client runs its own event loop.
+    monkeypatch.delenv("DETECTOR_WARMUP", raising=False)
+    monkeypatch.setattr(execution, "_limiters", {})
+    monkeypatch.setattr(admission, "_controller", None)
+    monkeypatch.setattr(pool, "get_executor", execution.get_thread_executor)
+    with TestClient(main.app) as client:
+        yield client
+
+@pytest.mark.parametrize("latency_budget_ms, expected_status", [
+    (None, 503),
+    (2000, 200),
+])
+def test_multivariate_latency_budget_is_admitted(monkeypatch, client, latency_budget_ms, expected_status):
+    # Arrange:  without a budget, LOCI on 1000 rows would take far longer than this server allows.
+    monkeypatch.setenv("DETECTOR_MAX_REQUEST_SECONDS", "60")
+    params = { "use_cache": False } if latency_budget_ms is None else { "use_cache": False, "latency_budget_ms": latency_budget_ms }
+    # Act
+    response = client.post("/detect/multivariate", params=params, json=generate_multivariate(1000))
+    # Assert
+    assert(response.status_code == expected_status)
+
+@pytest.mark.parametrize("latency_budget_ms, expected_status", [
+    (None, 503),
+    (2000, 200),
+])
+def test_single_timeseries_latency_budget_is_admitted(monkeypatch, client, latency_budget_ms, expected_status):
+    # Arrange:  without a budget, KernelCPD over the full grid is quadratic in the length of the series.
+    monkeypatch.setenv("DETECTOR_MAX_REQUEST_SECONDS", "5")
+    params = { "use_cache": False } if latency_budget_ms is None else { "use_cache": False, "latency_budget_ms": latency_budget_ms }
+    # Act
+    response = client.post("/detect/timeseries/single", params=params, json=generate_single_timeseries(5000))
+    # Assert
+    assert(response.status_code == expected_status)
+
+def test_multivariate_at_loci_limit_is_admitted_by_default(monkeypatch, client):
+    # Arrange:  1000 rows is the most LOCI runs on, and the detectors have always taken such calls.  Stand
+    # in for LOCI itself, which takes minutes at this size.
+    monkeypatch.delenv("DETECTOR_MAX_REQUEST_SECONDS", raising=False)
+    monkeypatch.setattr(multivariate, "check_loci", lambda col_array: (np.zeros(len(col_array)), np.zeros(len(col_array)), { "LOCI Threshold": 3.0 }))
+    # Act
+    response = client.post("/detect/multivariate", params={ "use_cache": False }, json=generate_multivariate(1000))
+    # Assert
+    assert(response.status_code == 200)
+    assert(len(response.json()["anomalies"]) == 1000)
+
+def test_job_uses_latency_budget(client):
+    # Arrange:  without a budget, LOCI on 1000 rows would run for minutes.
+    params = { "latency_budget_ms": 2000, "debug": True }
+    # Act
+    job = client.post("/jobs/detect/multivariate", params=params, json=generate_multivariate(1000)).json()
+    start = time.monotonic()
+    while client.get(f"/jobs/{job['job_id']}").json()["status"] in ("queued", "running") and time.monotonic() - start < 60:
+        time.sleep(0.05)
+    result = client.get(f"/jobs/{job['job_id']}/result").json()
+    # Assert
+    assert(result["debug_details"]["Tests run"]["loci"] == 0)
+    assert(result["debug_details"]["Tests run"]["cof"] == 1)
+
+def test_multivariate_string_values_are_cached(client):
+    # Arrange:  string values are encoded by the detector, so the cache key must hash them as they are.
+    rows = [{ "key": str(i), "vals": [float(i % 7), ["red", "green", "blue"][i % 3], 3.0] } for i in range(30)]
+    # Act
+    first = client.post("/detect/multivariate", params={ "use_cache": True }, json=rows)
+    second = client.post("/detect/multivariate", params={ "use_cache": True }, json=rows)
+    uncached = client.post("/detect/multivariate", params={ "use_cache": False }, json=rows)
+    # Assert
+    assert(first.status_code == 200)
+    assert(second.json() == first.json())
+    assert(uncached.json() == first.json())
+
+def test_large_stream_update_is_admitted(client):
+    # Arrange:  BOCPD is linear in the length of the update, so a long backfill fits in one call.
+    rows = generate_single_timeseries(20000)
+    # Act
+    response = client.post("/detect/timeseries/single/stream/backfill", json=rows)
+    client.delete("/detect/timeseries/single/stream/backfill")
+    # Assert
+    assert(response.status_code == 200)
+    assert(response.json()["anomalies"][-1]["key"] == "19999")
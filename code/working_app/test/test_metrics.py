@@ -0,0 +1,95 @@
+from src.app.metrics import *
+from src.app.models import univariate, multivariate
+from src.app import serialization
+from functools import partial
+import asyncio
+import pandas as pd
+import pytest
+
+def test_histogram_renders_cumulative_buckets():
+    # Arrange
+    h = Histogram("test_seconds", "Test.", ("route",), (0.1, 1.0))
+    # Act
+    for value in [0.05, 0.5, 0.7, 5.0]:
+        h.observe(("/a",), value)
+    lines = h.render()
+    # Assert
+    assert('test_seconds_bucket{route="/a",le="0.1"} 1' in lines)
+    assert('test_seconds_bucket{route="/a",le="1.0"} 3' in lines)
+    assert('test_seconds_bucket{route="/a",le="+Inf"} 4' in lines)
+    assert('test_seconds_sum{route="/a"} 6.25' in lines)
+    assert('test_seconds_count{route="/a"} 4' in lines)
+
+def test_counter_escapes_labels():
+    # Arrange
+    c = Counter("test_total", "Test.", ("name",))
+    # Act
+    c.inc(('say "hi"\n',), 2)
+    # Assert
+    assert(c.render()[-1] == 'test_total{name="say \\"hi\\"\\n"} 2')
+
+@pytest.mark.parametrize("detect, df, expected", [
+    (partial(univariate.detect_univariate_statistical, sensitivity_score=50, max_fraction_anomalies=1.0),
+        pd.DataFrame({ "key": [str(i) for i in range(10)], "value": [1.0, 2.0, 3.0, 2.0, 1.0, 2.0, 3.0, 2.0, 1.0, 20.0] }),
+        { "sds", "mads", "iqrs" }),
+    (partial(multivariate.detect_multivariate_statistical, sensitivity_score=50, max_fraction_anomalies=1.0, n_neighbors=5),
+        pd.DataFrame({ "key": [str(i) for i in range(20)], "vals": [[float(i), float(i % 3)] for i in range(20)] }),
+        { "cof", "loci", "copod" }),
+    (partial(univariate.detect_univariate_statistical, sensitivity_score=500, max_fraction_anomalies=1.0),
+        pd.DataFrame({ "key": ["1", "2", "3"], "value": [1.0, 2.0, 3.0] }),
+        set()),
+])
+def test_run_counting_tests_returns_tests_which_ran(detect, df, expected):
+    # Arrange
+    # Act
+    (body, tests_run) = run_counting_tests(serialization.detect_json, detect, df, False)
+    # Assert
+    assert(body.startswith('{"anomalies":'))
+    assert(set(tests_run.keys()) >= expected)
+    assert(all(count == 1 for count in tests_run.values()))
+
+def test_middleware_records_route_and_status():
+    # Arrange
+    class Route:
+        path = "/detect/thing/{thing_id}"
+    async def inner_app(scope, receive, send):
+        scope["route"] = Route()
+        await send({ "type": "http.response.start", "status": 418 })
+        await send({ "type": "http.response.body", "body": b"" })
+    async def send(message):
+        pass
+    middleware = MetricsMiddleware(inner_app)
+    labels = ("/detect/thing/{thing_id}", "POST", "418")
+    before = requests_total.values.get(labels, 0)
+    # Act
+    for thing_id in ["a", "b"]:
+        asyncio.run(middleware({ "type": "http", "path": f"/detect/thing/{thing_id}", "method": "POST" }, None, send))
+    # Assert
+    assert(requests_total.values[labels] == before + 2)
+    assert(sum(request_seconds.values[("/detect/thing/{thing_id}",)][0]) >= 2)
+
+def test_middleware_shares_label_for_unmatched_routes():
+    # Arrange
+    async def inner_app(scope, receive, send):
+        await send({ "type": "http.response.start", "status": 404 })
+        await send({ "type": "http.response.body", "body": b"" })
+    async def send(message):
+        pass
+    middleware = MetricsMiddleware(inner_app)
+    labels = ("unmatched", "POST", "404")
+    before = requests_total.values.get(labels, 0)
+    # Act
+    for path in ["/detect/foo/a1", "/detect/bar/b2"]:
+        asyncio.run(middleware({ "type": "http", "path": path, "method": "POST" }, None, send))
+    # Assert
+    assert(requests_total.values[labels] == before + 2)
+    assert(not any(key[0].startswith("/detect/foo") for key in requests_total.values))
+
+def test_render_includes_gauges():
+    # Arrange
+    # Act
+    text = render()
+    # Assert
+    assert(text.endswith("\n"))
+    assert("# TYPE detector_cache_hit_ratio gauge" in text)
+    assert("process_resident_memory_bytes " in text)
@@ -1,4 +1,5 @@
 from numpy import number
+import numpy as np
 from src.app.models.multi_timeseries import *
 import pandas as pd
 import pytest
@@ -83,3 +84,164 @@ def test_detect_single_timeseries_sample_fraction(df_input, max_fraction_anomali
     print(df_out.sort_values(by=['dt']))
     # Assert
     assert(number_of_anomalies == df_out[df_out['is_anomaly'] == True].shape[0])
+
+# SAX and DIFFSTD distances are shared, but each sensitivity score gets its own anomaly scores.
+def test_detect_multi_timeseries_sweep_matches_individual_results():
+    # Arrange
+    df = pd.DataFrame(sample_input, columns=["key", "series_key", "dt", "value"])
+    sensitivity_scores = [100, 60, 5]
+    max_fraction_anomalies = [1.0, 0.1]
+    # Act
+    (df_out, weights, details, thresholds) = detect_multi_timeseries_sweep(df, sensitivity_scores, max_fraction_anomalies)
+    # Assert
+    assert(len(thresholds) == 6)
+    for threshold in thresholds:
+        (df_expected, weights, details) = detect_multi_timeseries(df, threshold["sensitivity_score"], threshold["max_fraction_anomalies"])
+        assert(df_expected['key'].tolist() == df_out['key'].tolist())
+        assert(np.allclose(df_expected['anomaly_score'], threshold["anomaly_score"]))
+        assert(df_expected['is_anomaly'].tolist() == threshold["is_anomaly"].tolist())
+
+# The original DIFFSTD, one pair of segments at a time, kept as a reference for the vectorized version.
+def diffstd(s1v, s2v):
+    # Find the differences between the two input segments.
+    dt = [x1 - x2 for (x1, x2) in zip(s1v, s2v)]
+    n = len(s1v)
+    mu = np.mean(dt)
+    # For each difference, square its distance from the mean.  This guarantees all numbers are positive.
+    diff2 = [(d-mu)**2 for d in dt]
+    # Sum the squared differences, divide by the number of data points (to get an average),
+    # and take the square root of the result.  This returns a single number, the DIFFSTD comparing
+    # these two segments.
+    return (np.sum(diff2)/n)**0.5
+
+# The array-based DIFFSTD should match segment-by-segment calls to diffstd().
+@pytest.mark.parametrize("num_series, l", [
+    (2, 17),
+    (5, 100),
+    (20, 703),
+])
+def test_check_diffstd_matches_diffstd(num_series, l):
+    # Arrange
+    rng = np.random.default_rng(0)
+    values = rng.normal(50, 10, (num_series, l))
+    num_segments = l // 7
+    # Act
+    (segment_starts, segment_sizes) = generate_segment_bounds(l, num_segments)
+    segment_means = generate_segment_means(values)
+    (segment_numbers, diffstd_distances) = check_diffstd(values, segment_means, segment_starts, segment_sizes)
+    # Assert
+    mean_segments = np.array_split(segment_means, num_segments)
+    for i in range(num_series):
+        expected = [diffstd(s, m) for (s, m) in zip(np.array_split(values[i], num_segments), mean_segments)]
+        expected_per_point = [expected[j] for j in segment_numbers]
+        assert(np.allclose(diffstd_distances[i], expected_per_point, rtol=1e-12))
+    assert(segment_numbers.tolist() == [j for j, seg in enumerate(np.array_split(values[0], num_segments)) for v in seg])
+
+# Missing points (NaN) should drop out of both the segment means and each series' DIFFSTD.
+def test_check_diffstd_skips_missing_points():
+    # Arrange
+    rng = np.random.default_rng(0)
+    values = rng.normal(50, 10, (4, 70))
+    values[rng.random(values.shape) < 0.2] = np.nan
+    (segment_starts, segment_sizes) = generate_segment_bounds(70, 10)
+    # Act
+    segment_means = generate_segment_means(values)
+    (segment_numbers, diffstd_distances) = check_diffstd(values, segment_means, segment_starts, segment_sizes)
+    # Assert
+    assert(np.allclose(segment_means, np.nanmean(values, axis=0), rtol=1e-12))
+    for i in range(4):
+        for (start, size) in zip(segment_starts, segment_sizes):
+            valid = ~np.isnan(values[i, start:start+size])
+            expected = diffstd(values[i, start:start+size][valid], segment_means[start:start+size][valid])
+            assert(np.isclose(diffstd_distances[i, start], expected, rtol=1e-12))
+
+# Series which dropped points, or started late, line up with the others by dt.
+@pytest.mark.parametrize("dropped_keys", [
+    ["k5", "k12a"],
+    ["k1a", "k2a", "k3a"],
+    ["k16", "k17", "k4a", "k9a"],
+])
+def test_detect_multi_timeseries_unequal_lengths(dropped_keys):
+    # Arrange
+    df = pd.DataFrame(sample_input, columns=["key", "series_key", "dt", "value"])
+    df = df[~df['key'].isin(dropped_keys)]
+    # Act
+    (df_out, weights, diagnostics) = detect_multi_timeseries(df, 100, 1.0)
+    # Assert
+    assert(isinstance(diagnostics, dict))
+    assert(diagnostics["Test diagnostics"]["Time series length"] == 17)
+    assert(sorted(df_out['key']) == sorted(df['key']))
+    assert(np.isfinite(df_out['anomaly_score']).all())
+    # The large jump at the end of s1 is still an outlier when s1 has it.
+    assert(df_out[df_out['key'].isin(["k16", "k17"])]['is_anomaly'].all())
+
+# The vectorized SAX matrix should match pairwise tslearn distance_sax calls.
+@pytest.mark.parametrize("num_series, l", [
+    (2, 17),
+    (5, 120),
+    (7, 1003),
+])
+def test_check_sax_matches_tslearn(num_series, l):
+    # Arrange
+    from tslearn.piecewise import SymbolicAggregateApproximation
+    rng = np.random.default_rng(0)
+    values = rng.normal(0, 1, (num_series, l)).cumsum(axis=1)
+    # Act
+    (sax_distances, diagnostics) = check_sax(values, l)
+    # Assert
+    segment_split = diagnostics["Segment size per letter"]
+    word_size = diagnostics["Word size"]
+    sax = SymbolicAggregateApproximation(n_segments=l//segment_split, alphabet_size_avg=4, scale=True)
+    sax_data = sax.fit_transform(values.tolist())
+    num_words = len(sax_data[0])//word_size
+    m = np.empty((num_series, num_words))
+    for i in range(num_series):
+        for j in range(num_words):
+            m[i][j] = sum(sax.distance_sax(sax_data[i][j*word_size:(1+j)*word_size], sax_data[k][j*word_size:(1+j)*word_size])
+                for k in range(num_series))/(num_series-1)
+    assert(np.allclose(m, diagnostics["SAX matrix"], rtol=1e-12))
+    expected_sax_distance = [m[0][min(j//(word_size*segment_split), num_words-1)] for j in range(l)]
+    assert(np.allclose(sax_distances[0], expected_sax_distance, rtol=1e-12))
+
+# Sharded execution should give the same results as running everything at once.
+# An offset far larger than the spread checks that the shards' standard deviations combine without rounding away.
+@pytest.mark.parametrize("num_series, l, num_shards, drop_fraction, offset", [
+    (2, 17, 2, 0.0, 0.0),
+    (7, 120, 3, 0.0, 0.0),
+    (50, 300, 4, 0.0, 0.0),
+    (7, 120, 3, 0.1, 0.0),
+    (7, 120, 3, 0.1, 1e9),
+])
+def test_detect_multi_timeseries_sharded_matches_unsharded(num_series, l, num_shards, drop_fraction, offset, monkeypatch):
+    # Arrange
+    monkeypatch.setenv("DETECTOR_WORKERS", str(num_shards))
+    rng = np.random.default_rng(0)
+    values = rng.normal(0, 1, (num_series, l)).cumsum(axis=1) + offset
+    df = pd.DataFrame({"key": [f"k{i}_{j}" for i in range(num_series) for j in range(l)],
+        "series_key": [f"s{i}" for i in range(num_series) for j in range(l)],
+        "dt": list(pd.date_range("2021-12-11", periods=l, freq="h")) * num_series,
+        "value": values.ravel()})
+    df = df[rng.random(df.shape[0]) >= drop_fraction]
+    # Act
+    (df_expected, weights, diag_expected) = detect_multi_timeseries(df, 70, 0.2)
+    (df_out, weights, diag_out) = detect_multi_timeseries(df, 70, 0.2, sharded=True)
+    # Assert
+    assert(diag_out["Test diagnostics"]["Number of shards"] == num_shards)
+    assert(df_expected['key'].tolist() == df_out['key'].tolist())
+    # Sums of values near the offset round differently depending on the order in which they are added.
+    assert(np.allclose(df_expected['anomaly_score'], df_out['anomaly_score'], rtol=1e-9, atol=10 * np.finfo(float).eps * offset))
+    assert(df_expected['is_anomaly'].tolist() == df_out['is_anomaly'].tolist())
+    assert(diag_expected["Outlier scoring"].keys() == diag_out["Outlier scoring"].keys())
+
+def test_merge_moments_matches_nanstd():
+    # Arrange
+    rng = np.random.default_rng(0)
+    values = rng.normal(1e9, 1.0, 1000)
+    values[::7] = np.nan
+    shards = np.array_split(values, 4)
+    # Act
+    (count, mean, m2) = merge_moments([summarize_shard(shard)[1:4] for shard in shards])
+    # Assert
+    assert(count == np.count_nonzero(~np.isnan(values)))
+    assert(np.isclose(mean, np.nanmean(values), rtol=1e-15))
+    assert(np.isclose((m2 / count)**0.5, np.nanstd(values), rtol=1e-9))
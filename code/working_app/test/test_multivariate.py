@@ -22,6 +22,22 @@ def test_detect_multivariate_encoding_string_columns(df_input, requires_encoding
     assert(requires_encoding == encoding_performed)
     assert(number_of_string_columns == num_string_columns)
 
+# Numeric rows of equal length skip the per-row Series but should split out exactly the same columns.
+@pytest.mark.parametrize("df_input", [
+    ([["s1", [1, 30.1, 2]], ["s2", [4, 19.6, 5]], ["s3", [7, 17.3, 8]]]),
+    ([["s1", [1, 30, 2]], ["s2", [4, 19, 5]], ["s3", [7, 17, 8]]]),
+    ([["s1", [1, 30.1, 2]], ["s2", [4, 19.6]], ["s3", [7, 17.3, 8]]]),
+    ([["s1", [1, 30.1, None]], ["s2", [4, 19.6, 5]], ["s3", [7, 17.3, 8]]]),
+])
+def test_detect_multivariate_encoding_matches_per_row_split(df_input):
+    # Arrange
+    df = pd.DataFrame(df_input, columns=["key", "vals"])
+    expected = pd.concat([df, pd.DataFrame([pd.Series(x) for x in df.vals])], axis=1)
+    # Act
+    (df_encoded, diagnostics) = encode_string_data(df)
+    # Assert
+    pd.testing.assert_frame_equal(df_encoded, expected)
+
 sample_input = [["1604", [87,16,6184.90844,0.771,11.72]],
 ["91849", [7921,12,6337.69829,0.919,11.55]],
 ["55194", [4497,5,5639.15773,0.678,4.71]],
@@ -182,6 +198,20 @@ def test_detect_multivariate_cof_sample_fraction(df_input, max_fraction_anomalie
     # Assert
     assert(number_of_anomalies == df_out[df_out['is_anomaly'] == True].shape[0])
 
+# COF, COPOD, and LOCI run once.  COF's raw labels come from the first max fraction, but is_anomaly should not.
+def test_detect_multivariate_sweep_matches_individual_results():
+    # Arrange
+    df = pd.DataFrame(sample_input, columns=["key", "vals"])
+    sensitivity_scores = [50, 5, 1]
+    max_fraction_anomalies = [1.0, 0.01]
+    # Act
+    (df_out, weights, details, thresholds) = detect_multivariate_statistical_sweep(df.copy(), sensitivity_scores, max_fraction_anomalies, 10)
+    # Assert
+    assert(len(thresholds) == 6)
+    for threshold in thresholds:
+        (df_expected, weights, details) = detect_multivariate_statistical(df.copy(), threshold["sensitivity_score"], threshold["max_fraction_anomalies"], 10)
+        assert(df_expected['is_anomaly'].tolist() == threshold["is_anomaly"].tolist())
+
 # Note that even when we don't see outliers, COF and LOCI may still catch minor differences.
 sample_input_one_outlier = [["1604", [87,16,6184.90844,0.771,11.72]],
 ["1604", [87.0,16,6184.90844,0.771,11.72]],
@@ -0,0 +1,78 @@
+from src.app.models.planner import *
+from src.app.models import multivariate, single_timeseries
+import numpy as np
+import pandas as pd
+import pytest
+
+# Without a budget, the plan matches the size rules each detector has always used.
+@pytest.mark.parametrize("num_records, gaussian_mixture, max_clusters", [
+    (10, 0, 2),
+    (30, 1, 6),
+    (1000, 1, 9),
+])
+def test_plan_univariate_without_budget_runs_everything(num_records, gaussian_mixture, max_clusters):
+    # Arrange
+    # Act
+    plan = plan_univariate(num_records)
+    # Assert
+    assert(plan["gaussian_mixture"] == gaussian_mixture)
+    assert(plan["gaussian_mixture_max_clusters"] == max_clusters)
+    assert(plan["within_budget"])
+
+@pytest.mark.parametrize("latency_budget_ms, gaussian_mixture, max_clusters", [
+    (10000, 1, 9),
+    (3400, 1, 5),
+    (3000, 0, 0),
+])
+def test_plan_univariate_trims_gaussian_mixture(latency_budget_ms, gaussian_mixture, max_clusters):
+    # Arrange
+    num_records = 10000
+    # Act
+    plan = plan_univariate(num_records, latency_budget_ms)
+    # Assert
+    assert(plan["gaussian_mixture"] == gaussian_mixture)
+    assert(plan["gaussian_mixture_max_clusters"] == max_clusters)
+
+@pytest.mark.parametrize("num_records, latency_budget_ms, loci, num_cof_runs", [
+    (500, None, 1, 20),
+    (500, 1000, 0, 7),
+    (2000, None, 0, 20),
+    (2000, 5000, 0, 5),
+    (2000, 1, 0, 1),
+])
+def test_plan_multivariate_drops_loci_then_narrows_cof(num_records, latency_budget_ms, loci, num_cof_runs):
+    # Arrange
+    # Act
+    plan = plan_multivariate(num_records, 10, latency_budget_ms)
+    # Assert
+    assert(plan["loci"] == loci)
+    assert(len(plan["cof_n_neighbors"]) == num_cof_runs)
+    assert(plan["cof_n_neighbors"][0] == 10)
+
+@pytest.mark.parametrize("num_records, latency_budget_ms, multi_resolution, num_kernels, num_penalties", [
+    (2000, None, False, 3, 17),
+    (2000, 1000, True, 3, 17),
+    (500, 50, False, 3, 9),
+    (500, 1, False, 1, 3),
+])
+def test_plan_single_timeseries_keeps_full_grid_as_long_as_possible(num_records, latency_budget_ms, multi_resolution, num_kernels, num_penalties):
+    # Arrange
+    # Act
+    plan = plan_single_timeseries(num_records, single_timeseries.KERNELS, single_timeseries.PENALTIES, False, latency_budget_ms)
+    # Assert
+    assert(plan["multi_resolution"] == multi_resolution)
+    assert(len(plan["kernels"]) == num_kernels)
+    assert(len(plan["penalties"]) == num_penalties)
+    # Thinning keeps the full range of penalties.
+    assert(min(plan["penalties"]) == 0.001 and max(plan["penalties"]) == 1000)
+
+def test_detect_multivariate_with_budget_reports_plan():
+    # Arrange
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({ "key": [str(i) for i in range(100)], "vals": list(rng.normal(size=(100, 3))) })
+    # Act
+    (df_out, weights, details) = multivariate.detect_multivariate_statistical(df, 50, 1.0, 10, latency_budget_ms=100)
+    # Assert:  LOCI did not fit, so it did not run and carries no weight.
+    assert(details["Tests run"]["loci"] == 0)
+    assert("anomaly_score_loci" not in df_out.columns)
+    assert(details["Test diagnostics"]["Plan"]["latency_budget_ms"] == 100)
@@ -1,4 +1,5 @@
 from numpy import number
+import numpy as np
 from src.app.models.single_timeseries import *
 import pandas as pd
 import pytest
@@ -90,3 +91,66 @@ def test_detect_single_timeseries_sample_fraction(df_input, max_fraction_anomali
     print(df_out.sort_values(by=['dt']))
     # Assert
     assert(number_of_anomalies == df_out[df_out['is_anomaly'] == True].shape[0])
+
+# Change point detection runs once, and only the thresholds differ.  Bad settings get a message, as in a single call.
+@pytest.mark.parametrize("sensitivity_scores, max_fraction_anomalies, expected_message", [
+    ([100, 70, 50, 5], [1.0, 0.1], False),
+    ([50, 0], [1.0], True),
+    ([], [1.0], True),
+])
+def test_detect_single_timeseries_sweep_matches_individual_results(sensitivity_scores, max_fraction_anomalies, expected_message):
+    # Arrange
+    df = pd.DataFrame(sample_input, columns=["key", "dt", "value"])
+    # Act
+    (df_out, weights, details, thresholds) = detect_single_timeseries_sweep(df.copy(), sensitivity_scores, max_fraction_anomalies)
+    # Assert
+    assert(isinstance(details, str) == expected_message)
+    assert(len(thresholds) == (0 if expected_message else len(sensitivity_scores) * len(max_fraction_anomalies)))
+    for threshold in thresholds:
+        (df_expected, weights, details) = detect_single_timeseries(df.copy(), threshold["sensitivity_score"], threshold["max_fraction_anomalies"])
+        assert(df_expected['is_anomaly'].tolist() == threshold["is_anomaly"].tolist())
+
+# Multi-resolution search should find each change point within 2% for long series.
+@pytest.mark.parametrize("n_samples, n_bkps", [
+    (2000, 4),
+    (5000, 3),
+])
+def test_detect_single_timeseries_multi_resolution(n_samples, n_bkps):
+    # Arrange
+    signal, bkps = rpt.pw_constant(n_samples, 1, n_bkps, noise_std=2, delta=(5, 10), seed=0)
+    df = pd.DataFrame({"key": [str(i) for i in range(n_samples)],
+        "dt": pd.date_range("2021-12-11", periods=n_samples, freq="min"),
+        "value": signal[:, 0]})
+    sensitivity_score = 50
+    max_fraction_anomalies = 1.0
+    # Act
+    (df_out, weights, diagnostics) = detect_single_timeseries(df, sensitivity_score, max_fraction_anomalies, multi_resolution=True)
+    result = list(np.flatnonzero(df_out['is_anomaly'])) + [n_samples]
+    # Assert
+    p, r = precision_recall(bkps, result, margin=n_samples * 0.02)
+    assert(r == 1.0)
+    assert("Block size" in diagnostics["Test diagnostics"]["Multi-resolution"])
+
+# Short series fall back to the full-resolution search.
+def test_detect_single_timeseries_multi_resolution_short_series():
+    # Arrange
+    df = pd.DataFrame(sample_input, columns=["key", "dt", "value"])
+    # Act
+    (df_full, weights, diag_full) = detect_single_timeseries(df.copy(), 70, 1.0)
+    (df_multi, weights, diag_multi) = detect_single_timeseries(df.copy(), 70, 1.0, multi_resolution=True)
+    # Assert
+    assert(df_full['anomaly_score'].tolist() == df_multi['anomaly_score'].tolist())
+
+# Batch detection should match running each series on its own.
+def test_detect_single_timeseries_batch_matches_individual_results():
+    # Arrange
+    df = pd.DataFrame(sample_input, columns=["key", "dt", "value"])
+    series = { "s1": df.copy(), "s2": df.assign(value=df['value'] * -1.0), "s3": df.head(10).copy() }
+    # Act
+    results = detect_single_timeseries_batch(series, 70, 1.0)
+    # Assert
+    assert(list(results.keys()) == ["s1", "s2", "s3"])
+    for series_id in series:
+        (df_expected, weights, details) = detect_single_timeseries(series[series_id].copy(), 70, 1.0)
+        (df_out, weights, details) = results[series_id]
+        assert(df_expected['is_anomaly'].tolist() == df_out['is_anomaly'].tolist())
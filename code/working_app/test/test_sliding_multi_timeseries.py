@@ -0,0 +1,90 @@
+from src.app.models.sliding_multi_timeseries import *
+from src.app.models.multi_timeseries import detect_multi_timeseries
+import numpy as np
+import pandas as pd
+import pytest
+
+def generate_series(num_series, n):
+    np.random.seed(1)
+    values = np.random.normal(10, 1, (num_series, n))
+    values[2, 150:160] += 8
+    dt = pd.date_range("2021-12-11", periods=n, freq="min")
+    return (values, dt)
+
+def generate_frame(values, dt, start, end):
+    return pd.DataFrame([{"key": f"{s}_{t}", "series_key": f"s{s}", "dt": dt[t], "value": values[s, t]}
+        for s in range(values.shape[0]) for t in range(start, end)])
+
+# An offset far larger than the spread checks that the chunks' standard deviations combine without rounding away.
+@pytest.mark.parametrize("update_sizes, offset", [
+    ([168], 0.0),
+    ([5, 40, 3, 60, 1, 20, 39], 0.0),
+    ([56, 56, 56], 0.0),
+    ([7] * 24, 0.0),
+    ([5, 40, 3, 60, 1, 20, 39], 1e9),
+])
+def test_detect_multi_timeseries_window_matches_batch(update_sizes, offset):
+    # Arrange:  a window size of 56 uses 56-point chunks, so after 168 points the window holds the last 56.
+    window_id = f"matches_batch_{len(update_sizes)}_{offset}"
+    reset_window(window_id)
+    (values, dt) = generate_series(4, 200)
+    values = values + offset
+    position = 0
+    # Act
+    for size in update_sizes:
+        (df_out, weights, diagnostics) = detect_multi_timeseries_window(window_id, generate_frame(values, dt, position, position + size), 56, 50, 1.0)
+        position += size
+    (df_batch, weights, diagnostics_batch) = detect_multi_timeseries(generate_frame(values, dt, position - 56, position), 50, 1.0)
+    df_batch = df_batch.set_index("key").loc[df_out["key"]]
+    # Assert
+    assert(diagnostics["Test diagnostics"]["Time series length"] == 56)
+    assert(np.allclose(df_out["anomaly_score"], df_batch["anomaly_score"]))
+    assert((df_out["is_anomaly"].to_numpy() == df_batch["is_anomaly"].to_numpy()).all())
+
+def test_detect_multi_timeseries_window_state_is_bounded():
+    # Arrange
+    window_id = "bounded"
+    reset_window(window_id)
+    (values, dt) = generate_series(3, 600)
+    # Act
+    for start in range(0, 600, 50):
+        (df_out, weights, diagnostics) = detect_multi_timeseries_window(window_id, generate_frame(values, dt, start, start + 50), 100, 50, 1.0)
+    state = get_window_state(window_id, 100)
+    # Assert:  only the segments the last update touched come back.
+    assert(100 <= state.get_length() < 100 + state.chunk_size)
+    assert(df_out.shape[0] <= 3 * (50 + SEGMENT_SIZE - 1))
+    assert(diagnostics["Test diagnostics"]["Number of records seen"] == 600)
+
+@pytest.mark.parametrize("first_update, second_update", [
+    ((0, 30), (0, 30)),
+    ((0, 30), (30, 60)),
+])
+def test_detect_multi_timeseries_window_rejects_bad_updates(first_update, second_update):
+    # Arrange:  the first rejected update resends old points, the second changes the set of series.
+    window_id = f"bad_updates_{second_update[0]}"
+    reset_window(window_id)
+    (values, dt) = generate_series(4, 100)
+    detect_multi_timeseries_window(window_id, generate_frame(values, dt, *first_update), 56, 50, 1.0)
+    df = generate_frame(values, dt, *second_update)
+    if second_update[0] > 0:
+        df = df[df["series_key"] != "s3"]
+    # Act
+    (df_out, weights, diagnostics) = detect_multi_timeseries_window(window_id, df, 56, 50, 1.0)
+    # Assert
+    assert(isinstance(diagnostics, str))
+    assert(get_window_state(window_id, 56).get_length() == 30)
+
+@pytest.mark.parametrize("window_size, sensitivity_score, max_fraction_anomalies", [
+    (56, 0, 1.0),
+    (56, 50, 0.0),
+    (10, 50, 1.0),
+])
+def test_detect_multi_timeseries_window_invalid_parameters(window_size, sensitivity_score, max_fraction_anomalies):
+    # Arrange
+    (values, dt) = generate_series(4, 100)
+    df = generate_frame(values, dt, 0, 30)
+    # Act
+    (df_out, weights, diagnostics) = detect_multi_timeseries_window("invalid", df, window_size, sensitivity_score, max_fraction_anomalies)
+    # Assert
+    assert(df_out[df_out['is_anomaly'] == True].shape[0] == 0)
+    assert(isinstance(diagnostics, str))
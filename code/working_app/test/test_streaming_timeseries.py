@@ -0,0 +1,81 @@
+from src.app.models.streaming_timeseries import *
+import numpy as np
+import pandas as pd
+import pytest
+
+def generate_level_shift(n, shift_at):
+    np.random.seed(0)
+    values = np.concatenate([np.random.normal(10, 1, shift_at), np.random.normal(20, 1, n - shift_at)])
+    return pd.DataFrame({"key": [str(i) for i in range(n)],
+        "dt": pd.date_range("2021-12-11", periods=n, freq="min"),
+        "value": values})
+
+@pytest.mark.parametrize("batch_size", [1, 7, 60])
+def test_detect_single_timeseries_stream_finds_level_shift(batch_size):
+    # Arrange
+    series_id = f"level_shift_{batch_size}"
+    reset_series(series_id)
+    df = generate_level_shift(300, 200)
+    anomalies = set()
+    # Act
+    for start in range(0, df.shape[0], batch_size):
+        (df_out, weights, diagnostics) = detect_single_timeseries_stream(series_id, df.iloc[start:start + batch_size], 50, 1.0)
+        anomalies.update(df_out[df_out['is_anomaly'] == True]['key'])
+    # Assert:  the only anomaly is the first point after the shift
+    assert(anomalies == {"200"})
+
+def test_detect_single_timeseries_stream_state_is_bounded():
+    # Arrange
+    series_id = "bounded"
+    reset_series(series_id)
+    df = generate_level_shift(HISTORY_SIZE + 200, 100)
+    # Act
+    (df_out, weights, diagnostics) = detect_single_timeseries_stream(series_id, df, 50, 1.0)
+    state = get_series_state(series_id)
+    # Assert
+    assert(state.log_r.shape[0] <= MAX_RUN_LENGTH)
+    assert(len(state.history) == HISTORY_SIZE)
+    assert(diagnostics["Test diagnostics"]["Number of records seen"] == HISTORY_SIZE + 200)
+
+@pytest.mark.parametrize("start, end", [
+    (0, 20),
+    (10, 15),
+    (19, 30),
+])
+def test_detect_single_timeseries_stream_rejects_old_points(start, end):
+    # Arrange:  the second update starts at or before the latest point the series already has.
+    series_id = f"old_points_{start}"
+    reset_series(series_id)
+    df = generate_level_shift(40, 30)
+    detect_single_timeseries_stream(series_id, df.iloc[0:20], 50, 1.0)
+    # Act
+    (df_out, weights, diagnostics) = detect_single_timeseries_stream(series_id, df.iloc[start:end], 50, 1.0)
+    (df_next, weights, diagnostics_next) = detect_single_timeseries_stream(series_id, df.iloc[20:40], 50, 1.0)
+    # Assert:  the rejected update leaves the series as it was, ready for the points which do come next.
+    assert(isinstance(diagnostics, str))
+    assert(df_out[df_out['is_anomaly'] == True].shape[0] == 0)
+    assert(diagnostics_next["Test diagnostics"]["Number of records seen"] == 40)
+
+def test_detect_single_timeseries_stream_rejects_duplicate_dt():
+    # Arrange
+    df = generate_level_shift(20, 10)
+    df.loc[5, 'dt'] = df.loc[4, 'dt']
+    # Act
+    (df_out, weights, diagnostics) = detect_single_timeseries_stream("duplicate_dt", df, 50, 1.0)
+    # Assert
+    assert(isinstance(diagnostics, str))
+
+@pytest.mark.parametrize("sensitivity_score, max_fraction_anomalies", [
+    (0, 1.0),
+    (101, 1.0),
+    (50, 0.0),
+    (50, 1.1),
+])
+def test_detect_single_timeseries_stream_invalid_parameters(sensitivity_score, max_fraction_anomalies):
+    # Arrange
+    df = generate_level_shift(20, 10)
+    # Act
+    (df_out, weights, diagnostics) = detect_single_timeseries_stream("invalid", df, sensitivity_score, max_fraction_anomalies)
+    # Assert
+    assert(df_out[df_out['is_anomaly'] == True].shape[0] == 0)
+    assert(isinstance(diagnostics, str))
@@ -0,0 +1,88 @@
+from src.app.tables import *
+from src.app.models.univariate import detect_univariate_statistical
+from functools import partial
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+def generate_table(num_rows, num_chunks=1):
+    np.random.seed(0)
+    table = pa.table({
+        "key": [str(i) for i in range(num_rows)],
+        "dt": pd.date_range("2021-12-11", periods=num_rows, freq="min"),
+        "value": np.random.normal(10, 1, num_rows)
+    })
+    return pa.concat_tables([table.slice(i * num_rows // num_chunks, num_rows // num_chunks) for i in range(num_chunks)])
+
+@pytest.mark.parametrize("header, expected", [
+    (ARROW_STREAM, ARROW_STREAM),
+    ("application/x-parquet; charset=binary", PARQUET),
+    ("text/html, application/vnd.apache.parquet", PARQUET),
+    ("application/json", None),
+    (None, None),
+])
+def test_get_media_type(header, expected):
+    # Arrange
+    # Act
+    media_type = get_media_type(header)
+    # Assert
+    assert(media_type == expected)
+
+@pytest.mark.parametrize("media_type", [ARROW_STREAM, PARQUET])
+@pytest.mark.parametrize("num_chunks", [1, 4])
+def test_read_dataframe_round_trip(media_type, num_chunks):
+    # Arrange
+    table = generate_table(100, num_chunks)
+    # Act
+    df = read_dataframe(write_table(table, media_type), media_type, ["key", "dt", "value"])
+    # Assert
+    assert(df.shape == (100, 3))
+    assert(df["dt"].dt.tz is not None)
+    assert(df["dt"].iloc[0] == pd.Timestamp("2021-12-11", tz="UTC"))
+    assert(np.array_equal(df["value"].to_numpy(), table.column("value").to_numpy()))
+
+def test_column_to_numpy_is_zero_copy():
+    # Arrange
+    table = generate_table(100)
+    # Act
+    values = column_to_numpy(table.column("value"))
+    # Assert:  the array shares the Arrow buffer, so NumPy does not own its memory.
+    assert(not values.flags.owndata)
+
+def test_column_to_numpy_list_column():
+    # Arrange
+    column = pa.chunked_array([pa.array([[1.0, 2.0], [3.0, 4.0]])])
+    # Act
+    vals = column_to_numpy(column)
+    # Assert
+    assert(vals == [[1.0, 2.0], [3.0, 4.0]])
+
+@pytest.mark.parametrize("body, content_type, columns, status_code", [
+    (b"not a table", ARROW_STREAM, ["key", "value"], 400),
+    (b"not a table", PARQUET, ["key", "value"], 400),
+    (b"[]", "application/json", ["key", "value"], 415),
+    (None, ARROW_STREAM, ["key", "series_key"], 422),
+])
+def test_read_dataframe_rejects_bad_input(body, content_type, columns, status_code):
+    # Arrange
+    if body is None:
+        body = write_table(generate_table(10), ARROW_STREAM)
+    # Act
+    with pytest.raises(HTTPException) as e:
+        read_dataframe(body, content_type, columns)
+    # Assert
+    assert(e.value.status_code == status_code)
+
+@pytest.mark.parametrize("media_type", [ARROW_STREAM, PARQUET])
+def test_detect_table_returns_table(media_type):
+    # Arrange
+    df = read_dataframe(write_table(generate_table(100), ARROW_STREAM), ARROW_STREAM, ["key", "value"])
+    detect = partial(detect_univariate_statistical, sensitivity_score=50, max_fraction_anomalies=1.0)
+    # Act
+    body = detect_table(detect, df, True, media_type)
+    table = read_table(body, media_type)
+    # Assert
+    assert(table.num_rows == 100)
+    assert("anomaly_score" in table.column_names)
+    assert(b"debug_details" in table.schema.metadata)
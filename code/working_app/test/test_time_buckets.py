@@ -0,0 +1,82 @@
+from src.app.models.time_buckets import *
+from src.app.models.single_timeseries import detect_single_timeseries
+from functools import partial
+import pandas as pd
+import pytest
+
+hourly_input = [["k1", "2021-12-11T08:00:00Z", 14.3],
+["k2", "2021-12-11T09:00:00Z", 15.3],
+["k3", "2021-12-11T10:00:00Z", 15.8],
+["k4", "2021-12-11T11:00:00Z", 16.2],
+["k5", "2021-12-11T12:00:00Z", 16.4],
+["k6", "2021-12-11T13:00:00Z", 16.5],
+["k7", "2021-12-11T14:00:00Z", 16.3],
+["k8", "2021-12-11T15:00:00Z", 16.0],
+["k9", "2021-12-11T16:00:00Z", 15.5],
+["k10", "2021-12-11T17:00:00Z", 15.1],
+["k11", "2021-12-11T18:00:00Z", 14.6],
+["k12", "2021-12-11T19:00:00Z", 14.4],
+["k13", "2021-12-11T20:00:00Z", 14.1],
+["k14", "2021-12-11T21:00:00Z", 13.9],
+["k15", "2021-12-11T22:00:00Z", 13.7],
+["k16", "2021-12-11T23:00:00Z", 190.8],
+["k17", "2021-12-12T00:00:00Z", 193.7]]
+
+def expand_to_minutes(rows, points_per_hour):
+    # Spread each hourly value across several points within the hour, alternating above and below it.
+    expanded = []
+    for [k, dt, v] in rows:
+        for m in range(points_per_hour):
+            offset = 0.1 if m % 2 == 0 else -0.1
+            expanded.append([f"{k}_{m}", pd.Timestamp(dt) + pd.Timedelta(minutes=m * 10), v + offset])
+    return pd.DataFrame(expanded, columns=["key", "dt", "value"])
+
+def test_detect_with_time_buckets_matches_hourly_detection():
+    # Arrange
+    df = expand_to_minutes(hourly_input, 4)
+    df_hourly = pd.DataFrame(hourly_input, columns=["key", "dt", "value"])
+    detect = partial(detect_single_timeseries, sensitivity_score=70, max_fraction_anomalies=1.0)
+    # Act
+    (df_out, weights, details) = detect_with_time_buckets(df, detect, "1h", "mean")
+    (df_hourly_out, weights, hourly_details) = detect(df_hourly)
+    # Assert:  every original point has the result of its hour
+    assert(df_out.shape[0] == df.shape[0])
+    assert(df_out['key'].tolist() == df['key'].tolist())
+    expected = [a for a in df_hourly_out.sort_values("dt")['is_anomaly'] for m in range(4)]
+    assert(df_out['is_anomaly'].tolist() == expected)
+    assert(details["Time buckets"]["Number of buckets"] == 17)
+
+@pytest.mark.parametrize("aggregation_function, expected_values", [
+    ("mean", [2.0, 5.0, 10.0, 20.0]),
+    ("max", [3.0, 6.0, 10.0, 30.0]),
+    ("first", [1.0, 4.0, 10.0, 10.0]),
+    ("count", None),
+])
+def test_aggregate_time_buckets_per_series(aggregation_function, expected_values):
+    # Arrange
+    df = pd.DataFrame([["a", "s1", "2021-12-11T08:00:10Z", 1.0],
+        ["b", "s1", "2021-12-11T08:00:20Z", 3.0],
+        ["c", "s1", "2021-12-11T08:00:50Z", 2.0],
+        ["d", "s1", "2021-12-11T08:01:10Z", 4.0],
+        ["e", "s1", "2021-12-11T08:01:20Z", 6.0],
+        ["f", "s2", "2021-12-11T08:00:10Z", 10.0],
+        ["g", "s2", "2021-12-11T08:01:10Z", 10.0],
+        ["h", "s2", "2021-12-11T08:01:20Z", 30.0]], columns=["key", "series_key", "dt", "value"])
+    detect = lambda d: (d.assign(anomaly_score=d['value'], is_anomaly=False), {}, {})
+    # Act
+    (df_out, weights, details) = detect_with_time_buckets(df, detect, "1min", aggregation_function, ["series_key"])
+    # Assert
+    if expected_values is None:
+        assert(isinstance(details, str))
+    else:
+        assert(df_out['anomaly_score'].tolist() == [expected_values[i] for i in [0, 0, 0, 1, 1, 2, 3, 3]])
+
+def test_detect_with_time_buckets_invalid_interval():
+    # Arrange
+    df = expand_to_minutes(hourly_input, 2)
+    detect = partial(detect_single_timeseries, sensitivity_score=70, max_fraction_anomalies=1.0)
+    # Act
+    (df_out, weights, details) = detect_with_time_buckets(df, detect, "not an interval", "mean")
+    # Assert
+    assert(df_out[df_out['is_anomaly'] == True].shape[0] == 0)
+    assert(isinstance(details, str))
@@ -0,0 +1,58 @@
+from src.app.models.timing import *
+from src.app.models import univariate
+from src.app import serialization
+from functools import partial
+import json
+import numpy as np
+import pandas as pd
+
+def test_stage_does_nothing_outside_collect():
+    # Arrange
+    # Act
+    with stage("outside") as s:
+        pass
+    # Assert
+    assert(s is NO_STAGE)
+
+def test_collect_records_nested_stages():
+    # Arrange
+    num_bytes = 8 * 10**6
+    # Act
+    with collect() as timings:
+        with stage("outer"):
+            for i in range(3):
+                with stage("inner"):
+                    a = np.ones(num_bytes // 8)
+                    del a
+    # Assert
+    assert(set(timings.keys()) == { "outer", "outer/inner" })
+    assert(timings["outer"]["calls"] == 1)
+    assert(timings["outer/inner"]["calls"] == 3)
+    # The inner allocation counts towards both stages' peaks.
+    assert(timings["outer/inner"]["peak_bytes"] >= num_bytes)
+    assert(timings["outer"]["peak_bytes"] >= num_bytes)
+    assert(timings["outer"]["wall_ms"] >= timings["outer/inner"]["wall_ms"])
+
+def test_collect_can_be_turned_off():
+    # Arrange
+    # Act
+    with collect(False) as timings:
+        with stage("off") as s:
+            pass
+    # Assert
+    assert(timings is None)
+    assert(s is NO_STAGE)
+
+def test_detect_json_includes_timings_only_in_debug():
+    # Arrange
+    df = pd.DataFrame({ "key": [str(i) for i in range(30)], "value": [float(i % 7) for i in range(30)] })
+    detect = partial(univariate.detect_univariate_statistical, sensitivity_score=50, max_fraction_anomalies=1.0)
+    # Act
+    debug_body = json.loads(serialization.detect_json(detect, df.copy(), True))
+    body = json.loads(serialization.detect_json(detect, df.copy(), False))
+    # Assert
+    assert("debug_timings" not in body)
+    timings = debug_body["debug_timings"]
+    assert("detect/run_tests/normalization/normality_tests" in timings)
+    assert("detect/run_tests/gaussian_mixture_search" in timings)
+    assert(timings["detect"]["calls"] == 1)
@@ -90,6 +90,20 @@ def test_detect_univariate_statistical_sensitivity_affects_anomaly_count(df_inpu
     # Assert:  we have the correct number of anomalies
     assert(num_anomalies == number_of_anomalies)
 
+# The anomaly score does not depend on the settings, so only is_anomaly can differ from call to call.
+def test_detect_univariate_statistical_sweep_matches_individual_results():
+    # Arrange
+    df = pd.DataFrame(anomalous_sample, columns=["value"])
+    sensitivity_scores = [100, 75, 25]
+    max_fraction_anomalies = [1.0, 0.1]
+    # Act
+    (df_out, weights, details, thresholds) = detect_univariate_statistical_sweep(df.copy(), sensitivity_scores, max_fraction_anomalies)
+    # Assert
+    assert(len(thresholds) == 6)
+    for threshold in thresholds:
+        (df_expected, weights, details) = detect_univariate_statistical(df.copy(), threshold["sensitivity_score"], threshold["max_fraction_anomalies"])
+        assert(df_expected['is_anomaly'].tolist() == threshold["is_anomaly"].tolist())
+
 @pytest.mark.parametrize("df_input, max_fraction_anomalies, number_of_anomalies", [
     (anomalous_sample, 0.0, 0),
     (anomalous_sample, 0.01, 1),
@@ -315,4 +329,61 @@ def test_detect_univariate_statistical_multi_cluster(df_input, number_of_anomali
     (df_out, weights, details) = detect_univariate_statistical(df, sensitivity_score, max_fraction_anomalies)
     num_anomalies = df_out[df_out['is_anomaly'] == True].shape[0]
     # Assert:  we have the correct number of anomalies
-    assert(num_anomalies == number_of_anomalies)
\ No newline at end of file
+    assert(num_anomalies == number_of_anomalies)
+
+# Small inputs run on NumPy arrays rather than DataFrame columns, and should get exactly the same results.
+@pytest.mark.parametrize("df_input, sensitivity_score, max_fraction_anomalies", [
+    ([1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0, 19.4], 50.0, 1.0),
+    ([0.01, 0.03, 0.05, 0.02, 0.01, 0.03, 0.40], 50.0, 1.0),
+    ([1.0, 1.0, 1.0, 2.0, 2.0, 2.0, 3.0, 3.0, 50.0, -50.0, 98.0, 98.0, 98.0, 99.0, 99.0, 99.0, 100.0, 100.0], 50.0, 1.0),
+    ([1.4, 1.2, 1.0, 1.8, 1.4, 1.3, 1.8, 2.0, 2.1, 2.3, 2.5, 2.3, 2.6, 2.8, 2.4, 2.3, 3.1, 3.9, 3.2, 3.7, 3.1, 3.0, 3.4, 3.3, 50.2, -50.1, 98.6, 98.3, 99.6, 99.9, 100.2], 50.0, 1.0),
+    ([float(v) for v in anomalous_sample], 100.0, 0.2),
+    ([float(v % 17) + 0.5 * (v % 3) for v in range(150)] + [80.0], 75.0, 0.1),
+])
+def test_detect_univariate_statistical_small_inputs_match_dataframe_path(monkeypatch, df_input, sensitivity_score, max_fraction_anomalies):
+    # Arrange
+    from src.app.models import univariate
+    df = pd.DataFrame({ "key": [str(i) for i in range(len(df_input))], "value": df_input })
+    # Act
+    small_input = is_small_input(df)
+    (df_arrays, weights, details_arrays) = detect_univariate_statistical(df.copy(), sensitivity_score, max_fraction_anomalies)
+    monkeypatch.setattr(univariate, "SMALL_INPUT_ROWS", 0)
+    (df_frame, weights, details_frame) = detect_univariate_statistical(df.copy(), sensitivity_score, max_fraction_anomalies)
+    # Assert
+    assert(small_input == True)
+    pd.testing.assert_frame_equal(df_arrays, df_frame, check_exact=True)
+    assert(details_arrays == details_frame)
+
+@pytest.mark.parametrize("df_input, index, expected", [
+    ([1.0, 2.0, 3.0], None, True),
+    ([1, 2, 3], None, False),
+    ([1.0, None, 3.0], None, False),
+    ([1.0, 2.0, 3.0], [2, 1, 0], False),
+    ([1.0] * 201, None, False),
+])
+def test_is_small_input(df_input, index, expected):
+    # Arrange
+    df = pd.DataFrame({ "value": df_input }, index=index)
+    # Act
+    small_input = is_small_input(df)
+    # Assert
+    assert(small_input == expected)
+
+def test_detect_univariate_statistical_group_matches_separate_calls():
+    # Arrange:  small inputs with different settings, one too short to test, and one too large to group.
+    calls = [
+        (pd.DataFrame({ "key": ["a", "b", "c", "d", "e", "f", "g", "h", "i", "j", "k"], "value": [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0, 19.4] }), { "sensitivity_score": 50.0, "max_fraction_anomalies": 1.0 }),
+        (pd.DataFrame({ "key": [str(i) for i in range(len(anomalous_sample))], "value": [float(v) for v in anomalous_sample] }), { "sensitivity_score": 100.0, "max_fraction_anomalies": 0.2 }),
+        (pd.DataFrame({ "key": ["a", "b"], "value": [1.0, 2.0] }), { "sensitivity_score": 50.0, "max_fraction_anomalies": 1.0 }),
+        (pd.DataFrame({ "key": [str(i) for i in range(30)], "value": [float(v % 7) for v in range(29)] + [40.0] }), { "sensitivity_score": 75.0, "max_fraction_anomalies": 0.1, "latency_budget_ms": 40.0 }),
+        (pd.DataFrame({ "key": [str(i) for i in range(250)], "value": [float(v % 13) for v in range(249)] + [90.0] }), { "sensitivity_score": 50.0, "max_fraction_anomalies": 1.0 }),
+    ]
+    # Act
+    grouped = detect_univariate_statistical_group([(df.copy(), keywords) for (df, keywords) in calls])
+    separate = [detect_univariate_statistical(df.copy(), **keywords) for (df, keywords) in calls]
+    # Assert
+    assert(len(grouped) == len(calls))
+    for ((df_grouped, weights_grouped, details_grouped), (df_separate, weights_separate, details_separate)) in zip(grouped, separate):
+        pd.testing.assert_frame_equal(df_grouped, df_separate, check_exact=True)
+        assert(weights_grouped == weights_separate)
+        assert(details_grouped == details_separate)
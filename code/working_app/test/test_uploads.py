@@ -0,0 +1,51 @@
+from src.app.uploads import *
+import io
+import numpy as np
+import pandas as pd
+import pytest
+
+def generate_csv(num_rows):
+    np.random.seed(0)
+    df = pd.DataFrame({
+        "Date": pd.date_range("2021-01-04", periods=num_rows, freq="D").strftime("%Y-%m-%d"),
+        "Open": np.random.normal(100, 5, num_rows).round(2),
+        "Close": np.random.normal(100, 5, num_rows).round(2),
+        "Ticker": ["GME", "AMC"] * (num_rows // 2)
+    })
+    return (df, io.BytesIO(df.to_csv(index=False).encode("utf-8")))
+
+@pytest.mark.parametrize("chunk_rows", [7, 100, CHUNK_ROWS])
+def test_read_csv_columns_maps_columns(chunk_rows):
+    # Arrange
+    (expected, file) = generate_csv(100)
+    # Act
+    df = read_csv_columns(file, { "key": "Date", "series_key": "Ticker", "dt": "Date", "value": "Close" }, chunk_rows)
+    # Assert
+    assert(list(df.columns) == ["key", "series_key", "dt", "value"])
+    assert(df["key"].tolist() == expected["Date"].tolist())
+    assert(df["dt"].iloc[-1] == pd.Timestamp(expected["Date"].iloc[-1], tz="UTC"))
+    assert(df["value"].dtype == np.float64)
+    assert(np.array_equal(df["value"].to_numpy(), expected["Close"].to_numpy()))
+
+def test_read_csv_columns_numbers_rows_without_key_column():
+    # Arrange
+    (expected, file) = generate_csv(10)
+    # Act
+    df = read_csv_columns(file, { "key": None, "vals": ["Open", "Close"] }, 3)
+    # Assert
+    assert(df["key"].tolist() == [str(i) for i in range(10)])
+    assert(np.array_equal(np.array(df["vals"].tolist()), expected[["Open", "Close"]].to_numpy()))
+
+@pytest.mark.parametrize("columns", [
+    { "dt": "Date", "value": "Price" },
+    { "dt": "Date", "value": "Ticker" },
+    { "dt": "Ticker", "value": "Close" },
+])
+def test_read_csv_columns_rejects_bad_mapping(columns):
+    # Arrange
+    (expected, file) = generate_csv(10)
+    # Act
+    with pytest.raises(HTTPException) as e:
+        read_csv_columns(file, columns)
+    # Assert
+    assert(e.value.status_code == 422)